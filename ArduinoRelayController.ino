@@ -1,7 +1,31 @@
 /*
 Control Code for Aduino - Determines the on/off of the relays 
+
+Two protocols are understood on the serial port:
+  Frame byte  1 E S S S Z Y X  (bit 7 set)
+    E      1 = relays energized with the polarity in Z Y X, 0 = all relays off
+    S S S  sequence number chosen by the host
+    Z Y X  polarity of each axis, 1 = negative
+    The byte is echoed back once the relays have switched so the host knows the command took effect.
+  Old per-axis characters 'f'..'l' (no acknowledgement)
+    'f'/'g' x positive/negative, 'h'/'i' y positive/negative, 'j'/'k' z positive/negative, 'l' all off
  */
 
+// Must match DEFAULT_BAUD in RelayLink.py
+#define RELAY_BAUD 115200
+// Time the relay contacts need to settle after switching before the frame is acknowledged
+#define RELAY_SETTLE_MS 10
+
+#define FRAME_FLAG 0x80
+#define ENABLE_FLAG 0x40
+
+// Relay pins for each axis, the first pin is pulled LOW for a positive field and the second for a negative one
+const int positivePins[3] = {9, 11, 13};
+const int negativePins[3] = {8, 10, 12};
+
+// Last state that was applied, so the relays are only waited on when they actually move
+int lastFrameState = -1;
+
 // the setup routine runs once when you press reset:
 void setup() 
 {
@@ -9,43 +33,61 @@ void setup()
   for(i = 8; i < 14; i++){
     pinMode(i, OUTPUT);
   }
-  // initialize serial communication at 9600 bits per second:
-  Serial.begin(9600);
-  digitalWrite(9, HIGH);
-  digitalWrite(8, HIGH);
-  digitalWrite(11, HIGH);
-  digitalWrite(10, HIGH);
-  digitalWrite(13, HIGH);
-  digitalWrite(12, HIGH);
+  // initialize serial communication at RELAY_BAUD bits per second:
+  Serial.begin(RELAY_BAUD);
+  allOff();
  }
 
- void loop(){
-  char command = Serial.read();
-  if(command == 'f'){
-    digitalWrite(9, LOW);
-    digitalWrite(8, HIGH);}
-  else if(command == 'g'){ 
-    digitalWrite(8, LOW);
-    digitalWrite(9, HIGH);} 
-  else if(command == 'h'){
-    digitalWrite(11, LOW);
-    digitalWrite(10, HIGH);}
-  else if(command == 'i'){ 
-    digitalWrite(10, LOW);
-    digitalWrite(11, HIGH);} 
-  else if(command == 'j'){
-    digitalWrite(13, LOW);
-    digitalWrite(12, HIGH);}
-  else if(command == 'k'){ 
-    digitalWrite(12, LOW);
-    digitalWrite(13, HIGH);} 
-  else if(command == 'l'){
-    digitalWrite(13, HIGH);
-    digitalWrite(12, HIGH);
-    digitalWrite(11, HIGH);
-    digitalWrite(10, HIGH);
-    digitalWrite(9, HIGH);
-    digitalWrite(8, HIGH);}
+// Sets one axis' relay pair, sign 0 = positive and 1 = negative
+void setAxis(int axis, int sign){
+  if(sign){
+    digitalWrite(negativePins[axis], LOW);
+    digitalWrite(positivePins[axis], HIGH);}
+  else{
+    digitalWrite(positivePins[axis], LOW);
+    digitalWrite(negativePins[axis], HIGH);}
+  }
+
+void allOff(){
+  int i;
+  for(i = 8; i < 14; i++){
+    digitalWrite(i, HIGH);
+  }
   }
 
+// Applies a frame byte and echoes it back
+void applyFrame(int frame){
+  int state = frame & (ENABLE_FLAG | 0x07);
+  int axis;
+  if(state != lastFrameState){
+    if(frame & ENABLE_FLAG){
+      for(axis = 0; axis < 3; axis++){
+        setAxis(axis, (frame >> axis) & 1);
+      }
+    }
+    else{
+      allOff();
+    }
+    lastFrameState = state;
+    delay(RELAY_SETTLE_MS);
+  }
+  Serial.write((uint8_t)frame);
+  }
 
+ void loop(){
+  if(Serial.available() <= 0) return;
+  int command = Serial.read();
+  if(command & FRAME_FLAG){
+    applyFrame(command);
+    return;
+  }
+  // Old per-axis protocol, the relays may no longer match the last frame
+  lastFrameState = -1;
+  if(command == 'f') setAxis(0, 0);
+  else if(command == 'g') setAxis(0, 1);
+  else if(command == 'h') setAxis(1, 0);
+  else if(command == 'i') setAxis(1, 1);
+  else if(command == 'j') setAxis(2, 0);
+  else if(command == 'k') setAxis(2, 1);
+  else if(command == 'l') allOff();
+  }
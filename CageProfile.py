@@ -0,0 +1,200 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Cage Profile (CageProfile.py)
+#   Description:            Array backed magnetic field profile. Holds one float column per axis for the field,
+#                           the currents and polarity bits computed from it, and builds the PSU commands on demand.
+#   Inputs/Resources:       B-field samples (nT) for the x, y and z axes
+#   Output/Created files:   Currents (A), polarity bits and APPL commands for each step
+#
+#   Notes:                  Polarity bit 0/1/2 is set when the x/y/z field is negative, which is what the
+#                           relays on the Arduino use to flip the coil direction.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import sys
+import time
+import threading
+import numpy as np
+
+AXES = ('x', 'y', 'z')
+
+# The number 613647 is from the constant values from the equations for the cage
+CAGE_CONSTANT = 613647
+# X Middle Coil 1.4492, Y Small Coil 1.3984, Z Large Coil 1.5
+COIL_CONSTANTS = (1.4492, 1.3984, 1.5)
+# Number of turns on each coil
+COIL_TURNS = 35
+
+DEFAULT_VOLTAGE = 30
+
+#=============================================================================#
+#                                 Cage Profile                                #
+#=============================================================================#
+
+class CageProfile:
+
+    # bfield is an (N, 3) array-like of x, y, z field samples in nT. A profile created with
+    # complete=False is still being loaded; samples are added with append() until finish() is called.
+    def __init__(self, bfield=(), complete=True):
+        bfield = np.asarray(bfield, dtype=np.float64).reshape(-1, 3)
+        self.size = len(bfield)
+        self._bfield = np.array(bfield, dtype=np.float64, order='C')
+        self._currents = None
+        self._polarity = None
+        self.settings = None
+        self.calibration = None # Calibration.Calibration the currents were compiled with, None for the coil constants
+        self.voltage = DEFAULT_VOLTAGE
+        self.voltage_text = str(DEFAULT_VOLTAGE)
+        self.compile_time = 0.0
+        self.complete = complete
+        self.error = None
+        self.guard = None # ProfileValidation.LimitGuard checking the chunks appended while a run plays
+        self.meta = {}
+        self.ready = threading.Condition()
+
+    # Wraps already compiled columns (e.g. memory-mapped from the profile cache) without copying them
+    @classmethod
+    def fromArrays(cls, bfield, currents=None, polarity=None, offsets=(0, 0, 0), voltage=DEFAULT_VOLTAGE, coil_constants=COIL_CONSTANTS, calibration=None):
+        profile = cls()
+        profile._bfield = bfield
+        profile.size = len(bfield)
+        if currents is not None:
+            profile._currents = currents
+            profile._polarity = polarity
+            profile.settings = (np.asarray(offsets, dtype=np.float64), np.asarray(coil_constants, dtype=np.float64))
+            profile.calibration = calibration
+            profile.voltage = voltage
+            profile.voltage_text = str(voltage)
+        return profile
+
+    def __len__(self): return self.size
+
+    @property
+    def bfield(self): return self._bfield[:self.size]
+
+    @property
+    def currents(self): return None if self._currents is None else self._currents[:self.size]
+
+    @property
+    def polarity(self): return None if self._polarity is None else self._polarity[:self.size]
+
+    # Computes the currents and polarity bits for the whole profile in a single pass.
+    # offsets are the x, y, z field offsets in nT. Samples appended later are compiled with the same settings.
+    # A calibration replaces the coil constants with its coupling matrix and bias, see Calibration.py.
+    def compile(self, offsets=(0, 0, 0), voltage=DEFAULT_VOLTAGE, coil_constants=COIL_CONSTANTS, calibration=None):
+        start = time.perf_counter()
+        with self.ready:
+            self.settings = (np.asarray(offsets, dtype=np.float64), np.asarray(coil_constants, dtype=np.float64))
+            self.calibration = calibration
+            self._currents = np.empty_like(self._bfield)
+            self._polarity = np.empty(len(self._bfield), dtype=np.uint8)
+            self.compileRange(0, self.size)
+            self.voltage = voltage
+            self.voltage_text = str(voltage)
+        self.compile_time = time.perf_counter() - start
+        return self
+
+    def compileRange(self, start, stop):
+        offsets, coil_constants = self.settings
+        bfield = self._bfield[start:stop]
+        if self.calibration is not None:
+            # With coupling a coil's current can have the other sign than its axis' field, the relays follow the current
+            currents = np.round(self.calibration.currents(bfield, offsets), 2)
+            self._currents[start:stop] = currents
+            self._polarity[start:stop] = np.packbits(currents < 0, axis=1, bitorder='little').ravel()
+            return
+        self._currents[start:stop] = np.round(CAGE_CONSTANT*(bfield*.000000001 + .000000001*offsets)*coil_constants/COIL_TURNS, 2)
+        self._polarity[start:stop] = np.packbits(bfield < 0, axis=1, bitorder='little').ravel()
+
+#=============================================================================#
+#                              Streaming Support                              #
+#=============================================================================#
+
+    # Adds a chunk of (n, 3) samples to a profile that is still loading, compiling them if compile() was already called
+    def append(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64).reshape(-1, 3)
+        with self.ready:
+            start, stop = self.size, self.size + len(chunk)
+            if stop > len(self._bfield): self.reserve(max(stop, 2*len(self._bfield)))
+            self._bfield[start:stop] = chunk
+            if self.settings is not None:
+                self.compileRange(start, stop)
+                # A chunk that breaks a hard limit is never made playable, the exception ends the load
+                if self.guard is not None: self.guard.check(self._currents[start:stop], self._polarity[start:stop], start)
+            self.size = stop
+            self.ready.notify_all()
+
+    # Checks the steps loaded since the profile was validated, then every chunk appended from now on.
+    # Raises like the guard's check if the steps already loaded break a limit.
+    def watch(self, guard):
+        with self.ready:
+            guard.begin(self._polarity)
+            guard.check(self._currents[guard.checked:self.size], self._polarity[guard.checked:self.size], guard.checked)
+            self.guard = guard
+
+    # Grows the arrays so that a given number of samples fit without copying again
+    def reserve(self, capacity):
+        with self.ready:
+            if capacity <= len(self._bfield): return
+            bfield = np.empty((capacity, 3), dtype=np.float64)
+            bfield[:self.size] = self._bfield[:self.size]
+            self._bfield = bfield
+            if self._currents is not None:
+                currents = np.empty((capacity, 3), dtype=np.float64)
+                currents[:self.size] = self._currents[:self.size]
+                polarity = np.empty(capacity, dtype=np.uint8)
+                polarity[:self.size] = self._polarity[:self.size]
+                self._currents, self._polarity = currents, polarity
+
+    # Marks the profile as fully loaded, or as failed if an error is given
+    def finish(self, error=None):
+        with self.ready:
+            self.error = error
+            self.complete = True
+            self.ready.notify_all()
+
+    # Waits until a step is loaded. Returns False if the profile finished loading without it or the timeout ran out.
+    def waitFor(self, index, timeout=None):
+        with self.ready:
+            if index >= self.size and not self.complete: self.ready.wait(timeout)
+            return index < self.size
+
+    # Returns the sign bit (1 for negative) of an axis at a given step
+    def sign(self, index, axis): return (int(self._polarity[index]) >> axis) & 1
+
+    # Builds the APPL command for an axis at a given step. Commands are only encoded when they are sent.
+    def command(self, index, axis):
+        return 'APPL ' + self.voltage_text + ',' + str(float(self._currents[index, axis]))
+
+    # Bytes held by the profile arrays
+    @property
+    def nbytes(self):
+        size = self._bfield.nbytes
+        if self._currents is not None: size += self._currents.nbytes + self._polarity.nbytes
+        return size
+
+    # Bytes per data point and compile time, for comparing with the list based path
+    def report(self):
+        if not len(self): return 'empty profile'
+        return ('%.1f bytes/point (lists: %.0f), compiled in %.1f ms'
+            % (self.nbytes/len(self), legacyBytesPerPoint(), self.compile_time*1000))
+
+#=============================================================================#
+#                                 Comparison                                  #
+#=============================================================================#
+
+# Measures what one data point costs in the bfield_data / V_data / I_data / sim_data lists this replaced
+def legacyBytesPerPoint(bfield=(-12345.678, 23456.789, -34567.891)):
+    # Small ints (signs, the 30 V) are shared by Python so only their list slot is counted
+    def deepsize(item):
+        if isinstance(item, int): return 0
+        size = sys.getsizeof(item)
+        if isinstance(item, list): size += sum(deepsize(value) for value in item)
+        return size
+    currents = [round(CAGE_CONSTANT*(value*.000000001)*k/COIL_TURNS, 2) for value, k in zip(bfield, COIL_CONSTANTS)]
+    row_b = [float(value) for value in bfield] + [int(value < 0) for value in bfield]
+    row_v = [DEFAULT_VOLTAGE]*3
+    row_s = ['APPL ' + str(DEFAULT_VOLTAGE) + ',' + str(value) for value in currents]
+    # Each row also costs a pointer in its outer list
+    return sum(deepsize(row) for row in (row_b, row_v, currents, row_s)) + 4*8
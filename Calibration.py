@@ -0,0 +1,235 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Calibration (Calibration.py)
+#   Description:            Field model of the cage: a 3x3 coupling matrix from the coil currents to the field plus a
+#                           bias (ambient) field, fitted by least squares from a current sweep measured with the
+#                           magnetometer, and saved as numbered versions per cage.
+#   Inputs/Resources:       Sweep data: signed coil currents (A) and the field measured at each point (nT)
+#   Output/Created files:   ~/.HelmholtzCage/calibrations/<cage>-v<version>.json, .npz sweep recordings
+#
+#   Notes:                  field = matrix @ currents + bias. Profiles are compiled with the precomputed inverse,
+#                           currents = inverse @ (field + offsets - bias), as one matrix product over the whole profile.
+#                           Without a calibration the per-axis coil constants are used as before.
+#                           python Calibration.py --simulate sweeps simulated instruments with a known coupling and
+#                           checks the fit against it. python Calibration.py --fit sweep.npz fits a recorded sweep.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import os
+import glob
+import json
+import time
+import hashlib
+import itertools
+import numpy as np
+from CageProfile import CAGE_CONSTANT, COIL_CONSTANTS, COIL_TURNS
+
+CALIBRATION_VERSION = 1
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.HelmholtzCage', 'calibrations')
+DEFAULT_CAGE = 'cage'
+SWEEP_LEVELS = (-1.5, 0.0, 1.5)  # Currents each axis is swept through (A), every combination is measured
+SETTLE_TIME = 0.05              # Wait after setting the currents, several coil L/R time constants (seconds)
+SAMPLES_PER_POINT = 10          # Magnetometer samples averaged at each point
+SAMPLE_TIMEOUT = 2.0
+
+#=============================================================================#
+#                                  Calibration                                #
+#=============================================================================#
+
+class Calibration:
+
+    # matrix is nT per amp, column j is the field coil j makes. bias is the field with the coils off (nT).
+    def __init__(self, matrix, bias=(0.0, 0.0, 0.0), cage=DEFAULT_CAGE, version=0, created=None, residual=None, points=0):
+        self.matrix = np.asarray(matrix, dtype=np.float64).reshape(3, 3)
+        self.bias = np.asarray(bias, dtype=np.float64).reshape(3)
+        if np.linalg.cond(self.matrix) > 1e12: raise Exception('Singular Calibration')
+        self.inverse = np.linalg.inv(self.matrix)
+        self.cage = cage
+        self.version = version
+        self.created = created if created is not None else time.time()
+        self.residual = None if residual is None else np.asarray(residual, dtype=np.float64) # RMS fit error per axis (nT)
+        self.points = points
+
+    # The open loop formula as a calibration: no coupling and no bias
+    @classmethod
+    def nominal(cls, coil_constants=COIL_CONSTANTS, cage=DEFAULT_CAGE):
+        return cls(np.diag([COIL_TURNS/(CAGE_CONSTANT*1e-9*k) for k in coil_constants]), cage=cage)
+
+    # Signed currents (A) for (n, 3) field samples, with the field offsets added first
+    def currents(self, bfield, offsets=(0.0, 0.0, 0.0)): return (bfield + (np.asarray(offsets) - self.bias)) @ self.inverse.T
+
+    # Field (nT) the cage makes with (n, 3) or 3 signed currents
+    def field(self, currents): return np.asarray(currents, dtype=np.float64) @ self.matrix.T + self.bias
+
+    # Identifies the numbers, for keying compiled profiles
+    def key(self): return hashlib.sha256(json.dumps([self.matrix.tolist(), self.bias.tolist()]).encode('UTF-8')).hexdigest()
+
+    # Largest field one coil makes on another axis, as a share of what it makes on its own
+    def coupling(self):
+        diagonal = np.abs(np.diag(self.matrix))
+        return float((np.abs(self.matrix - np.diag(np.diag(self.matrix)))/diagonal[None, :]).max())
+
+    def toDict(self):
+        return {'format': CALIBRATION_VERSION, 'cage': self.cage, 'version': self.version, 'created': self.created,
+            'matrix': self.matrix.tolist(), 'bias': self.bias.tolist(), 'points': self.points,
+            'residual': None if self.residual is None else self.residual.tolist()}
+
+    @classmethod
+    def fromDict(cls, values):
+        if values.get('format') != CALIBRATION_VERSION: raise Exception('Unsupported Calibration Version')
+        return cls(values['matrix'], values['bias'], values['cage'], values['version'], values['created'], values['residual'], values['points'])
+
+    def report(self):
+        report = ('calibration %s v%d, coupling up to %.1f%%, bias %s nT'
+            % (self.cage, self.version, self.coupling()*100, '/'.join('%.0f' % value for value in self.bias)))
+        if self.residual is not None: report += ', fit rms %s nT over %d points' % ('/'.join('%.1f' % value for value in self.residual), self.points)
+        return report
+
+#=============================================================================#
+#                                    Fitting                                  #
+#=============================================================================#
+
+# Least squares fit of field = matrix @ currents + bias over every point of a sweep at once.
+# currents and fields are (n, 3); the sweep has to move every axis independently.
+def fitCalibration(currents, fields, cage=DEFAULT_CAGE):
+    currents = np.asarray(currents, dtype=np.float64).reshape(-1, 3)
+    fields = np.asarray(fields, dtype=np.float64).reshape(-1, 3)
+    if len(currents) != len(fields): raise Exception('Unbalanced Data')
+    design = np.column_stack([currents, np.ones(len(currents))])
+    solution, _residuals, rank, _singular = np.linalg.lstsq(design, fields, rcond=None)
+    if rank < 4: raise Exception('Sweep Does Not Span Every Axis')
+    residual = np.sqrt(((design @ solution - fields)**2).mean(axis=0))
+    return Calibration(solution[:3].T, solution[3], cage, residual=residual, points=len(currents))
+
+# Currents of a sweep: every combination of levels on the three axes
+def sweepPoints(levels=SWEEP_LEVELS): return np.array(list(itertools.product(levels, repeat=3)), dtype=np.float64)
+
+def saveSweep(filename, currents, fields):
+    np.savez(filename, currents=np.asarray(currents, dtype=np.float64), fields=np.asarray(fields, dtype=np.float64))
+
+def loadSweep(filename):
+    with np.load(filename) as sweep: return sweep['currents'], sweep['fields']
+
+#=============================================================================#
+#                                     Sweep                                   #
+#=============================================================================#
+
+# Sets each point's currents on a connected engine and averages the magnetometer once the coils have settled.
+# Returns the currents and the measured fields, both (n, 3). The coils are cleared afterwards.
+def runSweep(engine, points=None, settle=SETTLE_TIME, samples=SAMPLES_PER_POINT, timeout=SAMPLE_TIMEOUT):
+    if engine.magnetometer is None: raise Exception('No Magnetometer Communication')
+    if engine.isRunning(): raise Exception('Run In Progress')
+    points = sweepPoints() if points is None else np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    fields = np.empty_like(points)
+    engine.coalescer.invalidate()
+    try:
+        for index, currents in enumerate(points):
+            engine.setCurrents(currents)
+            time.sleep(settle)
+            fields[index] = averageField(engine.magnetometer, samples, timeout)
+    finally: engine.clearOutputs()
+    return points, fields
+
+# Mean of the next samples magnetometer readings that arrive, Exception('No Magnetometer Data') if they don't
+def averageField(magnetometer, samples, timeout=SAMPLE_TIMEOUT):
+    deadline = magnetometer.clock() + timeout
+    last = magnetometer.newest[1] if magnetometer.newest is not None else None
+    readings = []
+    while len(readings) < samples:
+        newest = magnetometer.newest
+        if newest is not None and newest[1] != last:
+            readings.append(newest[0])
+            last = newest[1]
+        elif magnetometer.clock() > deadline: raise Exception('No Magnetometer Data')
+        else: time.sleep(0.0005)
+    return np.mean(readings, axis=0)
+
+#=============================================================================#
+#                                    Storage                                  #
+#=============================================================================#
+
+# Calibrations of one cage, each saved as a new version so an older one can be gone back to
+class CalibrationStore:
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, cage=DEFAULT_CAGE):
+        self.directory = directory
+        self.cage = cage
+
+    def filename(self, version): return os.path.join(self.directory, '%s-v%d.json' % (self.cage, version))
+
+    def versions(self):
+        versions = []
+        for filename in glob.glob(os.path.join(self.directory, glob.escape(self.cage) + '-v*.json')):
+            try: versions.append(int(os.path.basename(filename)[len(self.cage) + 2:-5]))
+            except ValueError: pass
+        return sorted(versions)
+
+    # Saves a calibration as the next version and returns its file name
+    def save(self, calibration):
+        os.makedirs(self.directory, exist_ok=True)
+        calibration.cage = self.cage
+        calibration.version = max(self.versions(), default=0) + 1
+        filename = self.filename(calibration.version)
+        temporary = filename + '.tmp'
+        with open(temporary, 'w') as file: json.dump(calibration.toDict(), file, indent=1)
+        os.replace(temporary, filename)
+        return filename
+
+    # The newest calibration, or a given version. None if nothing was saved yet.
+    def load(self, version=None):
+        if version is None: version = max(self.versions(), default=None)
+        if version is None: return None
+        return loadCalibration(self.filename(version))
+
+def loadCalibration(filename):
+    try:
+        with open(filename, 'r') as file: values = json.load(file)
+    except (OSError, ValueError) as error: raise Exception('Cannot Read Calibration', error)
+    return Calibration.fromDict(values)
+
+#=============================================================================#
+#                                 Command Line                                #
+#=============================================================================#
+
+# Sweeps simulated instruments whose coils couple by a known matrix and compares the fit with it
+def simulateCalibration(coupling_share=0.05, ambient=(20000.0, -5000.0, 40000.0), noise=5.0, levels=SWEEP_LEVELS, samples=SAMPLES_PER_POINT):
+    from SimulatedInstruments import SimulatedBackend, CoilModel
+    from HelmholtzCageEngine import CageEngine
+    nominal = Calibration.nominal().matrix
+    rng = np.random.default_rng(0)
+    coupling = nominal + coupling_share*rng.uniform(-1, 1, (3, 3))*np.diag(nominal)[None, :]*(1 - np.eye(3))
+    backend = SimulatedBackend(coil=CoilModel(inductance=0.005))
+    backend.addMagnetometer('MAG', ['X', 'Y', 'Z'], 'SIM', ambient=ambient, noise=noise, rate=1000.0, coupling=coupling, seed=0)
+    engine = CageEngine(use_cache=False, backend=backend)
+    engine.telemetry_rate = 0
+    engine.connect('SIM', ['X', 'Y', 'Z'])
+    engine.connectMagnetometer('MAG')
+    try:
+        start = time.perf_counter()
+        currents, fields = runSweep(engine, sweepPoints(levels), settle=0.01, samples=samples)
+        sweep_time = time.perf_counter() - start
+        start = time.perf_counter()
+        calibration = fitCalibration(currents, fields)
+        fit_time = time.perf_counter() - start
+    finally: engine.disconnect()
+    return calibration, coupling, np.asarray(ambient), sweep_time, fit_time
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Fits the cage calibration from a current sweep.')
+    parser.add_argument('--fit', help='.npz sweep recording (currents, fields) to fit and save')
+    parser.add_argument('--simulate', action='store_true', help='sweep simulated instruments with a known coupling and check the fit')
+    parser.add_argument('--cage', default=DEFAULT_CAGE, help='name the calibration is saved under')
+    parser.add_argument('--directory', default=DEFAULT_DIRECTORY, help='where calibrations are saved')
+    arguments = parser.parse_args()
+    if arguments.simulate:
+        calibration, coupling, ambient, sweep_time, fit_time = simulateCalibration()
+        print(calibration.report())
+        print('sweep %.2f s, fit %.3f ms, matrix error %.2f%%, bias error %.1f nT' % (sweep_time, fit_time*1e3,
+            100*np.abs(calibration.matrix - coupling).max()/np.abs(coupling).max(), np.abs(calibration.bias - ambient).max()))
+    elif arguments.fit:
+        calibration = fitCalibration(*loadSweep(arguments.fit), cage=arguments.cage)
+        print(CalibrationStore(arguments.directory, arguments.cage).save(calibration))
+        print(calibration.report())
+    else: parser.error('give --fit or --simulate')
@@ -0,0 +1,84 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Command Coalescer (CommandCoalescer.py)
+#   Description:            Sits between the profile and the instruments and only lets through the setpoints and
+#                           relay states that differ from what the instruments last acknowledged.
+#   Inputs/Resources:       The rounded currents and polarity mask of each step
+#   Output/Created files:   Counts of sent and suppressed writes
+#
+#   Notes:                  State is only updated once a write went through, so a failed write is retried on the
+#                           next step. Anything that changes the outputs behind its back (clearSim, pause,
+#                           reconnects) must call invalidate().
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import time
+
+# Unchanged setpoints are still re-sent this often (seconds) in case an instrument missed one. 0 turns it off.
+DEFAULT_KEEPALIVE = 5.0
+
+#=============================================================================#
+#                              Command Coalescer                              #
+#=============================================================================#
+
+class CommandCoalescer:
+
+    def __init__(self, axes=3, keepalive=DEFAULT_KEEPALIVE, clock=time.perf_counter):
+        self.axes = axes
+        self.keepalive = keepalive
+        self.clock = clock
+        self.currents = [None]*axes     # Last acknowledged current per PSU, None = unknown
+        self.current_time = [0.0]*axes
+        self.mask = None                # Last acknowledged relay polarity mask
+        self.mask_time = 0.0
+        self.psu_sent = 0
+        self.psu_suppressed = 0
+        self.relay_sent = 0
+        self.relay_suppressed = 0
+
+    # Forgets the tracked state so that everything is sent again on the next step
+    def invalidate(self):
+        self.currents = [None]*self.axes
+        self.mask = None
+
+    def stale(self, sent_time, now): return self.keepalive > 0 and now - sent_time >= self.keepalive
+
+    # Returns one flag per axis, True where the setpoint has to be sent
+    def changedAxes(self, currents):
+        now = self.clock()
+        changed = [self.currents[axis] is None or self.currents[axis] != currents[axis] or self.stale(self.current_time[axis], now)
+            for axis in range(self.axes)]
+        sent = sum(changed)
+        self.psu_sent += sent
+        self.psu_suppressed += self.axes - sent
+        return changed
+
+    # Whether the relay mask has to be sent
+    def relayChanged(self, mask):
+        if self.mask is None or self.mask != mask or self.stale(self.mask_time, self.clock()):
+            self.relay_sent += 1
+            return True
+        self.relay_suppressed += 1
+        return False
+
+    # Records the setpoints of the axes that were just written
+    def confirmCurrents(self, currents, changed):
+        now = self.clock()
+        for axis in range(self.axes):
+            if changed[axis]:
+                self.currents[axis] = currents[axis]
+                self.current_time[axis] = now
+
+    # Records the relay mask that was just acknowledged
+    def confirmRelay(self, mask):
+        self.mask = mask
+        self.mask_time = self.clock()
+
+    def resetCounts(self):
+        self.psu_sent = self.psu_suppressed = self.relay_sent = self.relay_suppressed = 0
+
+    # Writes suppressed so far, for the status box
+    def report(self):
+        return ('%d/%d PSU writes and %d/%d relay frames suppressed'
+            % (self.psu_suppressed, self.psu_sent + self.psu_suppressed, self.relay_suppressed, self.relay_sent + self.relay_suppressed))
@@ -0,0 +1,113 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Field Feedback (FieldFeedback.py)
+#   Description:            Closed loop field tracking. Each step the open loop current from the compiled profile is
+#                           used as feedforward and a per-axis PI correction is added from the magnetometer reading,
+#                           which takes out ambient field drift and anything the coil constants get wrong.
+#   Inputs/Resources:       A compiled CageProfile and the newest magnetometer sample (nT)
+#   Output/Created files:   Corrected signed currents (A), loop period, compute time and tracking error statistics
+#
+#   Notes:                  The error is converted to amps with the same gain the profile is compiled with, so the gains
+#                           are dimensionless (kp) and per second (ki). The integral is clamped to integral_limit amps and
+#                           the output to current_limit amps. If the sample is too old the correction is held.
+#                           Plain floats are used instead of numpy, a 3 element update is faster that way.
+#                           The RMS error and the largest compute time cover the whole run; the period and compute
+#                           percentiles cover the last RING_CAPACITY updates so a long run doesn't grow the memory.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import time
+from CageProfile import CAGE_CONSTANT, COIL_CONSTANTS, COIL_TURNS
+from PlaybackEngine import StepTimingStats
+from Instrumentation import SampleRing
+
+DEFAULT_KP = 0.3
+DEFAULT_KI = 2.0
+INTEGRAL_LIMIT = 1.0    # amps
+CURRENT_LIMIT = 5.0     # amps
+
+# Amps per nT of each axis, the open loop formula's slope
+def coilGains(coil_constants=COIL_CONSTANTS): return [CAGE_CONSTANT*1e-9*k/COIL_TURNS for k in coil_constants]
+
+#=============================================================================#
+#                             Feedback Controller                             #
+#=============================================================================#
+
+class FeedbackController:
+
+    def __init__(self, profile, kp=DEFAULT_KP, ki=DEFAULT_KI, integral_limit=INTEGRAL_LIMIT, current_limit=CURRENT_LIMIT, clock=time.perf_counter):
+        self.profile = profile
+        coil_constants = profile.settings[1] if profile.settings is not None else COIL_CONSTANTS
+        # With a calibration the error is converted with its inverse, ignoring the coupling between axes
+        if profile.calibration is not None: self.gains = [float(gain) for gain in profile.calibration.inverse.diagonal()]
+        else: self.gains = coilGains(coil_constants)
+        self.kp = kp
+        self.ki = ki
+        self.integral_limit = integral_limit
+        self.current_limit = current_limit
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        self.integral = [0.0, 0.0, 0.0]
+        self.last_update = None
+        self.periods = SampleRing()
+        self.compute = SampleRing()
+        self.compute_max = 0.0
+        self.squared_error = [0.0, 0.0, 0.0] # Sum of the squared tracking error (nT) per axis over updates with a fresh sample
+        self.fresh = 0
+        self.stale = 0
+
+    # Returns the corrected currents for a step. measured is [x, y, z] in nT, or None if there is no fresh sample.
+    def update(self, index, measured):
+        start = self.clock()
+        dt = 0.0 if self.last_update is None else start - self.last_update
+        if self.last_update is not None: self.periods.append(dt)
+        self.last_update = start
+        feedforward = self.profile.currents[index]
+        currents = [0.0, 0.0, 0.0]
+        if measured is None: self.stale += 1
+        else:
+            target = self.profile.bfield[index]
+            self.fresh += 1
+        for axis in range(3):
+            correction = self.integral[axis]
+            if measured is not None:
+                error = float(target[axis]) - measured[axis]
+                self.squared_error[axis] += error*error
+                amps = error*self.gains[axis]
+                integral = self.integral[axis] + self.ki*amps*dt
+                self.integral[axis] = max(-self.integral_limit, min(self.integral_limit, integral))
+                correction = self.kp*amps + self.integral[axis]
+            current = float(feedforward[axis]) + correction
+            currents[axis] = round(max(-self.current_limit, min(self.current_limit, current)), 2)
+        elapsed = self.clock() - start
+        self.compute.append(elapsed)
+        if elapsed > self.compute_max: self.compute_max = elapsed
+        return currents
+
+    # RMS tracking error per axis in nT
+    def rmsError(self):
+        if not self.fresh: return [0.0, 0.0, 0.0]
+        return [(squared/self.fresh)**0.5 for squared in self.squared_error]
+
+    def summary(self):
+        percentile = StepTimingStats.percentile
+        rms = self.rmsError()
+        return {
+            'updates': self.compute.count,
+            'stale': self.stale,
+            'period_p50': percentile(self.periods, 50),
+            'period_p99': percentile(self.periods, 99),
+            'compute_p50': percentile(self.compute, 50),
+            'compute_p99': percentile(self.compute, 99),
+            'compute_max': self.compute_max,
+            'error_rms_x': rms[0], 'error_rms_y': rms[1], 'error_rms_z': rms[2],
+        }
+
+    def report(self):
+        s = self.summary()
+        return ('feedback period p50/p99 %.2f/%.2f ms, compute p99/max %.3f/%.3f ms, rms error %.0f/%.0f/%.0f nT, %d stale'
+            % (s['period_p50']*1e3, s['period_p99']*1e3, s['compute_p99']*1e3, s['compute_max']*1e3,
+            s['error_rms_x'], s['error_rms_y'], s['error_rms_z'], s['stale']))
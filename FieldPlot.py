@@ -0,0 +1,104 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Field Plot (FieldPlot.py)
+#   Description:            Live plot of the commanded and measured field on each axis for the controller window.
+#   Inputs/Resources:       The profile's field column and measurements taken while it plays (nT)
+#   Output/Created files:   None
+#
+#   Notes:                  The profile is reduced to a min/max pair per pixel column once, when it is set, and
+#                           measurements are folded into the same columns, so painting costs the same for a
+#                           thousand or ten million points. Drawn with QPainter, no plotting library needed.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import numpy as np
+from PyQt5 import QtGui, QtWidgets, QtCore
+
+AXIS_COLORS = ((200, 60, 60), (40, 150, 40), (50, 90, 210))
+MARGIN = 4
+
+# Splits values (N, ...) into columns equal buckets and returns the min and max of each bucket
+def minMaxEnvelope(values, columns):
+    values = np.asarray(values)
+    if len(values) <= columns: return values.copy(), values.copy()
+    starts = (np.arange(columns)*len(values))//columns
+    return np.minimum.reduceat(values, starts, axis=0), np.maximum.reduceat(values, starts, axis=0)
+
+#=============================================================================#
+#                                  Field Plot                                 #
+#=============================================================================#
+
+class FieldPlot(QtWidgets.QWidget):
+
+    def __init__(self, parent=None):
+        QtWidgets.QWidget.__init__(self, parent)
+        self.bfield = None
+        self.length = 0
+        self.position = -1
+        self.setProfile(None)
+
+    def columns(self): return max(1, self.width() - 2*MARGIN)
+
+    # Takes the field column of a profile, (N, 3) nT. Costs one pass over the data.
+    def setProfile(self, bfield):
+        self.bfield = bfield
+        self.length = 0 if bfield is None else len(bfield)
+        columns = self.columns()
+        if self.length: self.low, self.high = minMaxEnvelope(bfield, columns)
+        else: self.low = self.high = np.zeros((0, 3))
+        self.measured_low = np.full((columns, 3), np.nan)
+        self.measured_high = np.full((columns, 3), np.nan)
+        self.position = -1
+        self.update()
+
+    # Column a step is drawn in
+    def column(self, index):
+        if self.length <= len(self.low): return index
+        return min(len(self.low) - 1, index*len(self.low)//self.length)
+
+    # Adds a measurement (x, y, z nT) taken while the step at index was playing
+    def addMeasurement(self, index, field):
+        if field is None or not self.length: return
+        column = self.column(index)
+        if column >= len(self.measured_low): return
+        self.measured_low[column] = np.fmin(self.measured_low[column], field)
+        self.measured_high[column] = np.fmax(self.measured_high[column], field)
+
+    def setPosition(self, index):
+        self.position = index
+        self.update()
+
+    def resizeEvent(self, event):
+        self.setProfile(self.bfield)
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), QtCore.Qt.white)
+        painter.setPen(QtGui.QColor(160, 160, 160))
+        painter.drawRect(self.rect().adjusted(0, 0, -1, -1))
+        if not len(self.low): return
+        bottom, top = float(np.min(self.low)), float(np.max(self.high))
+        if np.any(~np.isnan(self.measured_low)):
+            bottom, top = min(bottom, float(np.nanmin(self.measured_low))), max(top, float(np.nanmax(self.measured_high)))
+        if top <= bottom: top = bottom + 1.0
+        height = self.height() - 2*MARGIN
+        scale = height/(top - bottom)
+        def y(value): return MARGIN + (top - value)*scale
+        if bottom < 0 < top:
+            painter.drawLine(QtCore.QPointF(MARGIN, y(0.0)), QtCore.QPointF(self.width() - MARGIN, y(0.0)))
+        # Short profiles are spread over the width
+        x = MARGIN + np.arange(len(self.low))*(self.columns()/len(self.low))
+        for axis in range(3):
+            color = QtGui.QColor(*AXIS_COLORS[axis])
+            color.setAlpha(90)
+            painter.setPen(color)
+            painter.drawLines([QtCore.QLineF(x[i], y(self.low[i, axis]), x[i], y(self.high[i, axis]) + 0.5) for i in range(len(x))])
+            painter.setPen(QtGui.QPen(QtGui.QColor(*AXIS_COLORS[axis]).darker(150), 2))
+            measured = np.flatnonzero(~np.isnan(self.measured_low[:len(x), axis]))
+            if len(measured):
+                painter.drawLines([QtCore.QLineF(x[i], y(self.measured_low[i, axis]), x[i], y(self.measured_high[i, axis]) + 0.5) for i in measured])
+        if self.position >= 0:
+            painter.setPen(QtGui.QColor(0, 0, 0))
+            cursor = x[min(self.column(self.position), len(x) - 1)]
+            painter.drawLine(QtCore.QPointF(cursor, MARGIN), QtCore.QPointF(cursor, self.height() - MARGIN))
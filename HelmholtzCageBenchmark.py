@@ -0,0 +1,253 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Helmholtz Cage Benchmark (HelmholtzCageBenchmark.py)
+#   Description:            Measures how fast profiles are extracted and compiled, and what step rate the playback
+#                           path sustains against the simulated instruments. Runs on synthetic orbit profiles.
+#   Inputs/Resources:       None, profiles are generated in a temporary directory
+#   Output/Created files:   A JSON file of results that can be compared against one from another commit
+#
+#   Notes:                  python HelmholtzCageBenchmark.py --output after.json --compare before.json
+#                           --sizes picks the profile sizes, the default runs 10^3 to 10^7 rows (about 400 MB of csv
+#                           for the largest). Times are the best of --repeat runs.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+from ProfileIngest import ProfileReader
+from CageProfile import CageProfile
+from HelmholtzCageEngine import CageEngine
+from PlaybackEngine import PlaybackWorker
+from Instrumentation import measureOverhead
+from SimulatedInstruments import SimulatedBackend, LatencyModel
+from STKExport import writeMagFieldCSV, exportField, DipoleProvider
+from Calibration import Calibration, simulateCalibration
+
+DEFAULT_SIZES = (10**3, 10**4, 10**5, 10**6, 10**7)
+ORBIT_PERIOD = 5400.0 # seconds, roughly a low earth orbit
+
+#=============================================================================#
+#                              Synthetic Profiles                             #
+#=============================================================================#
+
+# Field seen along a tilted circular orbit through a dipole, one row per step seconds (nT)
+def syntheticOrbit(rows, step=1.0, seed=0):
+    phase = 2*np.pi*np.arange(rows)*step/ORBIT_PERIOD
+    latitude = np.sin(phase)*np.radians(51.6)
+    strength = 30000.0*np.sqrt(1 + 3*np.sin(latitude)**2)
+    noise = np.random.default_rng(seed).normal(0.0, 50.0, (rows, 3))
+    bfield = np.empty((rows, 3))
+    bfield[:,0] = strength*np.cos(latitude)*np.cos(3*phase)
+    bfield[:,1] = strength*np.cos(latitude)*np.sin(3*phase)
+    bfield[:,2] = -2*strength*np.sin(latitude)
+    return bfield + noise
+
+def writeProfileCSV(path, bfield):
+    np.savetxt(path, bfield, fmt='%.3f', delimiter=',', header='x (nT),y (nT),z (nT)', comments='')
+    return path
+
+# Stands in for the STK data provider, which hands back one tuple of floats per axis
+class StandInProvider:
+
+    def __init__(self, rows): self.bfield = syntheticOrbit(rows)
+
+    def GetValues(self, axis): return tuple(self.bfield[:,axis].tolist())
+
+#=============================================================================#
+#                                  Benchmarks                                 #
+#=============================================================================#
+
+# Runs function repeat times and returns the shortest time and the last result
+def best(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+# Extract: csv to a profile. Peak memory is measured on a separate run so tracing doesn't slow the timed ones.
+def benchIngest(path, repeat):
+    seconds, profile = best(lambda: ProfileReader(path).read(), repeat)
+    tracemalloc.start()
+    ProfileReader(path).read()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    size = os.path.getsize(path)
+    return profile, {
+        'rows': len(profile),
+        'seconds': seconds,
+        'rows_per_second': len(profile)/seconds,
+        'mb_per_second': size/seconds/1e6,
+        'peak_mb': peak/1e6,
+        'peak_bytes_per_row': peak/max(len(profile), 1),
+    }
+
+# setupSim: currents, polarity and commands for the whole profile, with the coil constants and with a calibration
+def benchCompile(profile, repeat):
+    seconds, _ = best(lambda: profile.compile((10.0, -20.0, 30.0)), repeat)
+    calibration = Calibration.nominal()
+    calibrated, _ = best(lambda: profile.compile((10.0, -20.0, 30.0), calibration=calibration), repeat)
+    return {'seconds': seconds, 'seconds_per_million': seconds*1e6/len(profile), 'calibrated_seconds': calibrated}
+
+# A scheduled run against simulated instruments: scheduling lateness, jitter and dispatch skew
+def benchDispatch(profile, period, latency, jitter):
+    engine = CageEngine(use_cache=False, backend=SimulatedBackend(LatencyModel(latency, jitter)))
+    engine.connect('SIM', ['X', 'Y', 'Z'])
+    engine.profile = profile
+    engine.start(period)
+    engine.wait()
+    results = dict(engine.worker.scheduler.stats.summary())
+    results.update(('psu_' + key, value) for key, value in engine.psu.summary().items())
+    results['period'] = period
+    engine.disconnect()
+    return results
+
+# Steps played back to back with every setpoint sent, which is the fastest the profile can be stepped
+def benchMaxRate(profile, steps, latency, jitter):
+    engine = CageEngine(use_cache=False, backend=SimulatedBackend(LatencyModel(latency, jitter)))
+    engine.connect('SIM', ['X', 'Y', 'Z'])
+    engine.profile = profile
+    start = time.perf_counter()
+    for index in range(steps):
+        engine.coalescer.invalidate()
+        engine.playStep(index)
+    seconds = time.perf_counter() - start
+    engine.disconnect()
+    return {'steps': steps, 'seconds': seconds, 'max_steps_per_second': steps/seconds}
+
+# What the stage timers add to each step: the cost of one observation, and the instrumented wrapper around a
+# step that does nothing, as a share of a 1 ms step. step_seconds is a real playStep for comparison.
+def benchInstrumentation(profile, steps, repeat=3):
+    engine = CageEngine(use_cache=False, backend=SimulatedBackend(LatencyModel(0.0, 0.0)))
+    engine.connect('SIM', ['X', 'Y', 'Z'])
+    engine.profile = profile
+    engine.worker = PlaybackWorker(steps, 0.001, engine.playStep, engine.clearOutputs)
+    engine.worker.scheduler.start()
+    def play(step):
+        start = time.perf_counter()
+        for index in range(steps): step(index)
+        return (time.perf_counter() - start)/steps
+    nothing = lambda index: None
+    wrapped = engine.instrumented(nothing)
+    overhead = min(play(wrapped) for _run in range(repeat)) - min(play(nothing) for _run in range(repeat))
+    step_seconds = min(play(engine.playStep) for _run in range(repeat))
+    engine.disconnect()
+    return {'observe_seconds': measureOverhead(), 'step_seconds': step_seconds,
+        'overhead_seconds': overhead, 'overhead_at_1khz': overhead/0.001}
+
+# STKMagGeneration's csv writer fed from the stand-in provider
+def benchSTKWriter(rows, directory, repeat):
+    provider = StandInProvider(rows)
+    magx, magy, magz = provider.GetValues(0), provider.GetValues(1), provider.GetValues(2)
+    path = os.path.join(directory, 'stk_%d.csv' % rows)
+    seconds, _ = best(lambda: writeMagFieldCSV(path, magx, magy, magz), repeat)
+    return {'rows': rows, 'seconds': seconds, 'rows_per_second': rows/seconds}
+
+# STKMagGeneration's windowed export from the dipole provider straight to a compiled profile
+def benchSTKExport(rows, directory, repeat):
+    export = lambda: exportField(DipoleProvider('bench', rows - 1), 1.0, directory)
+    seconds, filename = best(export, repeat)
+    tracemalloc.start()
+    export()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    os.remove(filename)
+    return {'rows': rows, 'seconds': seconds, 'rows_per_second': rows/seconds, 'peak_mb': peak/1e6}
+
+# Sweep of the simulated instruments with a known coupling, the fit and how far it is from the coupling
+def benchCalibration():
+    calibration, coupling, ambient, sweep_seconds, fit_seconds = simulateCalibration()
+    return {'sweep_seconds': sweep_seconds, 'fit_seconds': fit_seconds, 'points': calibration.points,
+        'matrix_error': float(np.abs(calibration.matrix - coupling).max()/np.abs(coupling).max()),
+        'bias_error_nt': float(np.abs(calibration.bias - ambient).max())}
+
+#=============================================================================#
+#                                    Results                                  #
+#=============================================================================#
+
+def commitHash():
+    try: return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+# Nested results as {'ingest.1000.seconds': value}
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict): flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool): flat[prefix + key] = value
+    return flat
+
+# Prints every number next to the baseline's and the ratio between them
+def compare(results, baseline):
+    current, previous = flatten(results), flatten(baseline)
+    print('%-48s %14s %14s %8s' % ('metric', baseline['meta'].get('commit'), results['meta'].get('commit'), 'ratio'))
+    for key in sorted(current):
+        if key.startswith('meta.') or key not in previous: continue
+        ratio = current[key]/previous[key] if previous[key] else float('nan')
+        print('%-48s %14.6g %14.6g %8.3f' % (key, previous[key], current[key], ratio))
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks profile ingest, compilation and playback.')
+    parser.add_argument('--sizes', nargs='+', type=float, default=DEFAULT_SIZES, help='profile sizes in rows')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timing, the best is kept')
+    parser.add_argument('--steps', type=int, default=2000, help='steps for the playback benchmarks')
+    parser.add_argument('--period', type=float, default=0.005, help='step period of the scheduled run in seconds')
+    parser.add_argument('--latency', type=float, default=0.0005, help='simulated PSU write latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0001, help='simulated PSU write latency standard deviation in seconds')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file from an earlier run to compare against')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    arguments = parseArguments(argv)
+    results = {
+        'meta': {'commit': commitHash(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'ingest': {}, 'compile': {}, 'stk_writer': {}, 'stk_export': {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in sorted(int(size) for size in arguments.sizes):
+            path = writeProfileCSV(os.path.join(directory, 'profile_%d.csv' % rows), syntheticOrbit(rows))
+            profile, results['ingest'][str(rows)] = benchIngest(path, arguments.repeat)
+            results['compile'][str(rows)] = benchCompile(profile, arguments.repeat)
+            os.remove(path)
+            del profile
+            print('%d rows: ingest %.3f s, compile %.3f s (%.3f s calibrated)' % (rows, results['ingest'][str(rows)]['seconds'],
+                results['compile'][str(rows)]['seconds'], results['compile'][str(rows)]['calibrated_seconds']))
+            if rows <= 10**6: results['stk_writer'][str(rows)] = benchSTKWriter(rows, directory, arguments.repeat)
+            results['stk_export'][str(rows)] = benchSTKExport(rows, directory, arguments.repeat)
+
+        profile = CageProfile(syntheticOrbit(arguments.steps))
+        profile.compile()
+        results['dispatch'] = benchDispatch(profile, arguments.period, arguments.latency, arguments.jitter)
+        results['max_rate'] = benchMaxRate(profile, arguments.steps, arguments.latency, arguments.jitter)
+        results['instrumentation'] = benchInstrumentation(profile, arguments.steps)
+        results['calibration'] = benchCalibration()
+    print('dispatch: lateness p99 %.3f ms, jitter p99 %.3f ms, %d skipped; max rate %.0f steps/s' % (
+        results['dispatch']['lateness_p99']*1e3, results['dispatch']['jitter_p99']*1e3, results['dispatch']['skipped'],
+        results['max_rate']['max_steps_per_second']))
+    print('instrumentation: %.2f us per observation, %.2f%% of a 1 ms step' % (
+        results['instrumentation']['observe_seconds']*1e6, results['instrumentation']['overhead_at_1khz']*100))
+    print('calibration: sweep %.2f s, fit %.3f ms, matrix error %.2f%%, bias error %.1f nT' % (
+        results['calibration']['sweep_seconds'], results['calibration']['fit_seconds']*1e3,
+        results['calibration']['matrix_error']*100, results['calibration']['bias_error_nt']))
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output: json.dump(results, output, indent=2)
+    if arguments.compare:
+        with open(arguments.compare) as baseline: compare(results, json.load(baseline))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
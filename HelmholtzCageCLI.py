@@ -0,0 +1,236 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Helmholtz Cage CLI (HelmholtzCageCLI.py)
+#   Description:            Runs a profile on the cage from the command line, without the GUI or PyQt.
+#   Inputs/Resources:       A .csv file, the Arduino port and the three PSU VISA resources
+#   Output/Created files:   Arduino Mega with 8-Relays
+#                           3x Keithley 2260B PSU
+#
+#   Notes:                  python HelmholtzCageCLI.py profile.csv --arduino COM3 --psu X_RES Y_RES Z_RES --rate 1 --unit s
+#                           --simulate runs against SimulatedInstruments instead of the hardware.
+#                           Several profiles, or --queue campaign.json, play them back to back (RunQueue.py). Profiles
+#                           given with --queue are added to it with this --rate, --unit and --offsets; running again
+#                           with just --queue resumes the campaign where it stopped.
+#                           Ctrl-C stops the run and clears the coils. The timing report is printed at the end.
+#                           --calibrate --magnetometer PORT sweeps the coils and saves a new calibration (Calibration.py)
+#                           instead of running a profile. Profiles are compiled with the newest saved calibration.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import sys
+import argparse
+import threading
+from PlaybackEngine import CATCHUP_POLICIES
+from HelmholtzCageEngine import CageEngine, convertUnit
+from FieldFeedback import DEFAULT_KP, DEFAULT_KI
+from Instrumentation import PROFILE_MODES
+from Calibration import CalibrationStore, loadCalibration
+
+# Short names for the GUI's rate of change units
+TIME_UNITS = {'ms': 'millisecond(s)', 's': 'second(s)', 'min': 'minute(s)'}
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description='Plays a magnetic field profile on the Helmholtz cage.')
+    parser.add_argument('profile', nargs='*', help='csv files with the x, y, z field columns')
+    parser.add_argument('--arduino', required=True, help='serial port of the relay Arduino, e.g. COM3')
+    parser.add_argument('--psu', nargs=3, required=True, metavar=('X', 'Y', 'Z'), help='VISA resources of the x, y and z PSUs')
+    parser.add_argument('--rate', type=float, help='time between steps')
+    parser.add_argument('--unit', choices=sorted(TIME_UNITS), default='s', help='unit of --rate (default s)')
+    parser.add_argument('--offsets', nargs=3, type=float, default=(0.0, 0.0, 0.0), metavar=('X', 'Y', 'Z'), help='field offsets in nT')
+    parser.add_argument('--voltage', type=float, default=30, help='PSU voltage limit')
+    parser.add_argument('--policy', choices=CATCHUP_POLICIES, default='skip', help='what to do when a step overruns')
+    parser.add_argument('--mode', choices=('stream', 'sequence'), default='stream', help='stream steps or upload them to the PSU lists')
+    parser.add_argument('--lead-in', type=float, default=1.0, help='seconds between connecting and the first step')
+    parser.add_argument('--debug', action='store_true', help="don't switch the relays")
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the compiled profile cache")
+    parser.add_argument('--resample', type=float, help='resample the profile to a step every RESAMPLE --unit, --rate is then the time between rows of the file')
+    parser.add_argument('--method', choices=('linear', 'cubic'), default='linear', help='resampling interpolation')
+    parser.add_argument('--max-slew', type=float, help='limit on each coil current change in A/s (needs --resample)')
+    parser.add_argument('--telemetry', type=float, default=10.0, help='PSU readback rate in Hz, 0 turns it off')
+    parser.add_argument('--magnetometer', help='serial port of the magnetometer, enables closed loop control')
+    parser.add_argument('--magnetometer-scale', type=float, default=1.0, help='factor from magnetometer units to nT')
+    parser.add_argument('--kp', type=float, default=DEFAULT_KP, help='closed loop proportional gain')
+    parser.add_argument('--ki', type=float, default=DEFAULT_KI, help='closed loop integral gain (1/s)')
+    parser.add_argument('--ambient', nargs=3, type=float, default=(0.0, 0.0, 0.0), metavar=('X', 'Y', 'Z'), help='simulated ambient field in nT')
+    parser.add_argument('--journal', metavar='DIR', help='journal every command and readback of the run into DIR (see RunJournal.py)')
+    parser.add_argument('--metrics-port', type=int, help='serve stage timings for Prometheus on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--profile-run', choices=PROFILE_MODES, help='profile the playback thread with cProfile or by sampling its stack')
+    parser.add_argument('--profile-output', default='helmholtz-run', help='file name the run profile is written to, without the extension')
+    parser.add_argument('--queue', help='campaign file the profiles are queued in, saved as the campaign runs')
+    parser.add_argument('--restart', action='store_true', help='play every entry of --queue again from the start')
+    parser.add_argument('--calibrate', action='store_true', help='sweep the coils, fit and save a calibration (needs --magnetometer)')
+    parser.add_argument('--sweep-record', help='save the calibration sweep to this .npz file')
+    parser.add_argument('--calibration', help='calibration .json to compile with instead of the newest saved one')
+    parser.add_argument('--no-calibration', action='store_true', help='compile with the coil constants only')
+    parser.add_argument('--simulate', action='store_true', help='use simulated PSUs and Arduino instead of the hardware')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated write latency in ms')
+    parser.add_argument('--jitter', type=float, default=0.0, help='simulated write latency standard deviation in ms')
+    arguments = parser.parse_args(argv)
+    if arguments.calibrate:
+        if not arguments.magnetometer: parser.error('--calibrate needs --magnetometer')
+        return arguments
+    if not arguments.profile and arguments.queue is None: parser.error('a profile or --queue is needed')
+    if arguments.rate is None or arguments.rate <= 0: parser.error('--rate must be above 0')
+    if arguments.resample is not None and arguments.resample <= 0: parser.error('--resample must be above 0')
+    if arguments.max_slew is not None and arguments.resample is None: parser.error('--max-slew needs --resample')
+    return arguments
+
+#=============================================================================#
+#                                     Run                                     #
+#=============================================================================#
+
+def main(argv=None):
+    arguments = parseArguments(argv)
+    backend = None
+    if arguments.simulate:
+        from SimulatedInstruments import SimulatedBackend, LatencyModel
+        backend = SimulatedBackend(LatencyModel(arguments.latency/1000, arguments.jitter/1000))
+        if arguments.magnetometer: backend.addMagnetometer(arguments.magnetometer, arguments.psu, arguments.arduino, ambient=arguments.ambient)
+    engine = CageEngine(arguments.voltage, arguments.policy, arguments.mode, use_cache=not arguments.no_cache, backend=backend)
+    engine.telemetry_rate = arguments.telemetry
+    engine.journal_directory = arguments.journal
+    engine.profile_mode = arguments.profile_run
+    engine.profile_output = arguments.profile_output
+    if arguments.metrics_port is not None:
+        try: print('Metrics on http://127.0.0.1:%d/metrics' % engine.serveMetrics(arguments.metrics_port))
+        except OSError as error: print('Metrics not served: ' + str(error))
+    if arguments.calibrate: return calibrate(engine, arguments)
+    try:
+        if arguments.calibration is not None: engine.calibration = loadCalibration(arguments.calibration)
+        elif not arguments.no_calibration: engine.calibration = CalibrationStore().load()
+    except Exception as etype:
+        print('Error: ' + str(etype.args[0]))
+        return 1
+    if engine.calibration is not None: print('Using ' + engine.calibration.report())
+    period = convertUnit(TIME_UNITS[arguments.unit])*arguments.rate/1000
+    if arguments.resample is not None:
+        from Resample import Resampler
+        step_period = convertUnit(TIME_UNITS[arguments.unit])*arguments.resample/1000
+        engine.resampler = Resampler(period, step_period, arguments.method, arguments.max_slew)
+        period = step_period
+    engine.closed_loop = arguments.magnetometer is not None
+    engine.feedback_gains = (arguments.kp, arguments.ki)
+    if arguments.queue is not None or len(arguments.profile) > 1: return runQueue(engine, arguments)
+    loaded = threading.Event()
+    load_error = []
+
+    def loadFinished(error):
+        if error is not None:
+            load_error.append(error)
+            engine.stop()
+        loaded.set()
+
+    try:
+        engine.openProfile(arguments.profile[0])
+        profile, cached = engine.loadProfile(on_done=loadFinished)
+        if cached: loaded.set()
+    except Exception as etype:
+        print('Error: ' + str(etype.args[0]))
+        return 1
+
+    try:
+        engine.connect(arguments.arduino, arguments.psu)
+        if arguments.magnetometer: engine.connectMagnetometer(arguments.magnetometer, scale=arguments.magnetometer_scale)
+    except Exception as etype:
+        print('Error: ' + str(etype.args[0]))
+        return 1
+
+    # Validating before the loader has parsed anything would check nothing, so wait for the first chunk
+    while not engine.profile.waitFor(0, 0.1) and not engine.profile.complete: pass
+
+    report = None
+    try:
+        profile = engine.compileProfile(arguments.offsets)
+        validation = engine.validate(period)
+        print(validation.report())
+        if validation.blocked:
+            print('Run blocked: ' + validation.summary())
+            return 1
+        print('Running ' + arguments.profile[0] + ' (' + profile.report() + ')')
+        engine.start(period, on_state=lambda state: print('Simulation ' + state), lead_in=arguments.lead_in, debug=arguments.debug)
+        # Joining in short slices keeps Ctrl-C responsive
+        while engine.isRunning(): engine.wait(0.2)
+    except KeyboardInterrupt:
+        engine.stop()
+        engine.wait()
+    except Exception as etype:
+        # A load that failed before the run is reported below with the ones that fail during it
+        if etype is not engine.profile.error: raise
+    finally:
+        loaded.wait(5)
+        if loaded.is_set() and not load_error: engine.profileLoaded()
+        if engine.worker is not None and not engine.isRunning(): report = engine.report()
+        engine.disconnect()
+
+    if load_error:
+        print('Error: ' + ' - '.join(str(arg) for arg in load_error[0].args))
+        return 1
+    if engine.worker is not None and engine.worker.error is not None:
+        print('Error: ' + str(engine.worker.error))
+        return 1
+    if report is not None: print(report)
+    return 0
+
+# Sweeps the coils with the magnetometer connected and saves the fitted calibration as a new version
+def calibrate(engine, arguments):
+    store = CalibrationStore()
+    try:
+        engine.connect(arguments.arduino, arguments.psu)
+        engine.connectMagnetometer(arguments.magnetometer, scale=arguments.magnetometer_scale)
+        calibration = engine.calibrate(store, arguments.sweep_record)
+    except Exception as etype:
+        print('Error: ' + str(etype.args[0]))
+        return 1
+    finally: engine.disconnect()
+    print('Saved ' + store.filename(calibration.version))
+    print(calibration.report())
+    return 0
+
+# Plays the profiles of a campaign back to back without disconnecting in between
+def runQueue(engine, arguments):
+    from RunQueue import RunQueue, QueueRunner
+    try:
+        queue = RunQueue.load(arguments.queue) if arguments.queue is not None else RunQueue()
+        if arguments.restart: queue.reset()
+        # Resampled files play a step every --resample, the rate of the queue entry
+        rate = arguments.rate if arguments.resample is None else arguments.resample
+        for path in arguments.profile: queue.add(path, arguments.offsets, rate, TIME_UNITS[arguments.unit])
+    except Exception as etype:
+        print('Error: ' + str(etype.args[0]))
+        return 1
+    if not queue.remaining():
+        print('Nothing left to run: ' + queue.report())
+        return 0
+
+    try:
+        engine.connect(arguments.arduino, arguments.psu)
+        if arguments.magnetometer: engine.connectMagnetometer(arguments.magnetometer, scale=arguments.magnetometer_scale)
+    except Exception as etype:
+        print('Error: ' + str(etype.args[0]))
+        return 1
+
+    def entryStarted(index, entry):
+        print('Running %d/%d %s (%s)' % (index + 1, len(queue), entry.path, engine.profile.report()))
+
+    runner = QueueRunner(engine, queue, arguments.lead_in, arguments.debug, on_entry=entryStarted)
+    try:
+        runner.start()
+        while runner.is_alive(): runner.join(0.2)
+    except KeyboardInterrupt:
+        runner.stop()
+        runner.join()
+    finally:
+        engine.disconnect()
+
+    for entry in queue.entries:
+        if entry.status == 'failed' or entry.error: print('Error: %s - %s' % (entry.path, entry.error))
+    for report in runner.reports: print(report)
+    print(runner.report())
+    if runner.error is not None:
+        print('Error: ' + str(runner.error))
+        return 1
+    return 0 if not queue.remaining() and all(entry.status == 'done' for entry in queue.entries) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
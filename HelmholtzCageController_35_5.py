@@ -29,20 +29,43 @@
 #=============================================================================#
 #                                     Setup                                   #
 #=============================================================================#
+import time
+IMPORT_START = time.perf_counter() # With --startup-timing the startup time is printed once the window is up
 import sys
-import csv
 import os
-import serial
-import time
-import visa
-from PyQt5 import QtGui, uic, QtWidgets, QtCore
+from HelmholtzCageEngine import CageEngine, convertUnit
+from UiModules import loadUiType
+from FieldPlot import FieldPlot
+from RunQueue import RunQueue, QueueRunner
+from PyQt5 import QtWidgets, QtCore
 QtWidgets.QApplication.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling, True)
 
 qtCreatorFile = "HelmholtzCageController.ui"
 qtSTKWizard = "STKWizard.ui"
 
-Ui_MainWindow, QtBaseClass = uic.loadUiType(qtCreatorFile)
-Wiz_form, Wiz_base = uic.loadUiType(qtSTKWizard)
+# Pregenerated modules are used unless the .ui file was edited since. The STK wizard's form is loaded when it's first opened.
+Ui_MainWindow, QtBaseClass = loadUiType(qtCreatorFile)
+IMPORT_TIME = time.perf_counter() - IMPORT_START
+
+# The display is refreshed at this interval however fast the steps are played (ms)
+DISPLAY_REFRESH_MS = 50
+PLOT_HEIGHT = 160
+QUEUE_HEIGHT = 30
+# The run queue is kept here so a campaign can be resumed after the controller is restarted
+QUEUE_FILE = os.path.join(os.path.expanduser('~'), '.HelmholtzCage', 'queue.json')
+# Every run is journaled here so its timing can be looked at or replayed afterwards (RunJournal.py)
+JOURNAL_DIRECTORY = os.path.join(os.path.expanduser('~'), '.HelmholtzCage', 'journals')
+
+# Carries the playback worker's notifications over to the GUI thread (queued connections)
+class SimulationSignals(QtCore.QObject):
+    stateChanged = QtCore.pyqtSignal(str)
+    entryStarted = QtCore.pyqtSignal(int)
+    queueFinished = QtCore.pyqtSignal()
+
+# Carries the profile loader's progress over to the GUI thread
+class ExtractSignals(QtCore.QObject):
+    chunkLoaded = QtCore.pyqtSignal(int, int, int)
+    loadFinished = QtCore.pyqtSignal(object)
 
 class MyApp(QtWidgets.QMainWindow, Ui_MainWindow):
 
@@ -50,28 +73,42 @@ class MyApp(QtWidgets.QMainWindow, Ui_MainWindow):
 #                                Initialization                               #
 #=============================================================================#
 
-    # Initializes the GUI and setups some class variables
-    def __init__(self):
+    # Initializes the GUI and setups some class variables. backend replaces the instruments with simulated ones.
+    def __init__(self, backend=None):
     # WARNING - Edits here can break the program!
         QtWidgets.QMainWindow.__init__(self)
         Ui_MainWindow.__init__(self)
         self.setupUi(self)
         self.setFixedSize(self.size())
-        self.wizard_window = Wizard()
+        self.wizard_window = None # Built the first time the STK wizard is launched
         self.path = None
-        self.bfield_data = []
-        self.sim_data = []
-        self.V_data = []
-        self.I_data = []
-
-        self.rm = None
-        self.keithleyX = None
-        self.keithleyY = None
-        self.keithleyZ = None
-        self.Arduino = None
-
-        self.voltage = 30;
-        self.stop_flag = 0
+        self.engine = CageEngine(backend=backend) # Profile, instruments and playback, shared with HelmholtzCageCLI.py
+        self.engine.journal_directory = JOURNAL_DIRECTORY
+        self.calibration_loaded = False # The saved calibration is looked up the first time a profile is compiled
+        # Stage timings for Prometheus on http://127.0.0.1:9464/metrics, left off if another controller has the port
+        try: self.engine.serveMetrics()
+        except OSError: pass
+        self.display_timer = self.engine.metrics.histogram('helmholtz_stage_seconds', stage='display')
+        self.extract_signals = ExtractSignals()
+        self.extract_signals.chunkLoaded.connect(self.extractProgress)
+        self.extract_signals.loadFinished.connect(self.extractFinished)
+
+        self.sim_worker = None
+        self.sim_signals = SimulationSignals()
+        self.sim_signals.stateChanged.connect(self.simStateChanged)
+        self.sim_signals.entryStarted.connect(self.queueEntryStarted)
+        self.sim_signals.queueFinished.connect(self.queueFinished)
+
+        # The display samples the engine on a timer instead of being pushed every step
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.setInterval(DISPLAY_REFRESH_MS)
+        self.refresh_timer.timeout.connect(self.refreshDisplay)
+        self.plot_time = 0.0
+        self.addFieldPlot()
+        try: self.run_queue = RunQueue.load(QUEUE_FILE)
+        except Exception: self.run_queue = RunQueue(QUEUE_FILE)
+        self.queue_runner = None
+        self.addQueueControls()
 
         self.roc_line.textChanged.connect(self.setRoC)
         self.arduino_line.textChanged.connect(self.checkArduino)
@@ -88,28 +125,42 @@ class MyApp(QtWidgets.QMainWindow, Ui_MainWindow):
         self.disconnect_button.clicked.connect(self.Disconnect)
         self.run_button.clicked.connect(self.activateSim)
         self.STKWizard_button.clicked.connect(self.launchWizard)
+        self.pause_button.toggled.connect(self.pauseSim)
+        self.stop_button.clicked.connect(self.stopSim)
 
         #test this out
         self.roc_unit_combobox.activated.connect(self.setRoC)
         
+    # Adds the commanded vs measured field plot under the existing controls and grows the window to fit it
+    def addFieldPlot(self):
+        central = self.centralWidget()
+        bottom = max(child.geometry().bottom() for child in central.children() if isinstance(child, QtWidgets.QWidget))
+        self.field_plot = FieldPlot(central)
+        self.field_plot.setGeometry(10, bottom + 10, central.width() - 20, PLOT_HEIGHT)
+        self.setFixedSize(self.width(), self.height() + PLOT_HEIGHT + 10)
+
+    # Adds the run queue buttons under the plot
+    def addQueueControls(self):
+        central = self.centralWidget()
+        top = self.field_plot.geometry().bottom() + 10
+        self.queue_add_button = QtWidgets.QPushButton('Add to Queue', central)
+        self.queue_run_button = QtWidgets.QPushButton('Run Queue', central)
+        self.queue_clear_button = QtWidgets.QPushButton('Clear Queue', central)
+        self.queue_label = QtWidgets.QLabel(central)
+        for column, button in enumerate((self.queue_add_button, self.queue_run_button, self.queue_clear_button)):
+            button.setGeometry(10 + column*110, top, 100, QUEUE_HEIGHT - 4)
+        self.queue_label.setGeometry(340, top, central.width() - 350, QUEUE_HEIGHT - 4)
+        self.queue_add_button.clicked.connect(self.addToQueue)
+        self.queue_run_button.clicked.connect(self.runQueue)
+        self.queue_clear_button.clicked.connect(self.clearQueue)
+        self.setFixedSize(self.width(), self.height() + QUEUE_HEIGHT + 10)
+        self.showQueue()
+
 #=============================================================================#
 #                                General Methods                              #
 #=============================================================================#
     # Converts the string into an interger based on the unit given relative to the base unit
-    def ConvertUnit(self,unit_name):
-        # Base units are milliseconds and nanoTeslas
-        if unit_name == 'nT': return 1
-        elif unit_name == 'T': return 10^9
-        elif unit_name == 'G': return 10^5
-        elif unit_name == 'second(s)': return 1000
-        elif unit_name == 'millisecond(s)': return 1
-        elif unit_name == 'minute(s)': return 60000
-        else: return -1
-
-    # Check if a number is negative
-    def isNegative(self,number):
-        if number >= 0: return 0
-        else: return 1
+    def ConvertUnit(self,unit_name): return convertUnit(unit_name)
 
     def isfloat(self, value):
         try:
@@ -217,10 +268,6 @@ class MyApp(QtWidgets.QMainWindow, Ui_MainWindow):
         elif (flag == 'clear') and (state == False): 
             for index in range(1,13): self.setFlag(index,False)
 
-    # Writes to the Arduino a command type and the command itself before delaying for a specific amount of time and returning what the Arduino replys
-    def ArduinoComm(self,command,state):
-        if not self.debug_flag_checkbox.isChecked(): self.Arduino.write(chr(command+state+100).encode('UTF-8'))
-
 #=============================================================================#
 #                                Data Extraction                              #
 #=============================================================================#
@@ -229,38 +276,17 @@ class MyApp(QtWidgets.QMainWindow, Ui_MainWindow):
     # Lets user select file path and disables or enables extract button based on if the file is valid
         self.path = QtWidgets.QFileDialog.getOpenFileName(self)
         self.path = self.path[0]
-        axis_r = ['x','y','z']
-        axis = ['','','']
-        unit = ['','','']
-        coordiSystem = ['','','']
         try:
-            _basefilename , ext = os.path.splitext(os.path.basename(self.path))
-            if '.csv' != ext: raise Exception('Incorrect File Type')
-            with open(os.path.relpath(self.path), 'r', encoding='UTF-8') as file: header = next(csv.reader(file))
-            # Checks the headers
-            for i in range(0,3):
-                trans = str.maketrans('','','-=+,.~`*&^%$#@!{}[]()')
-                string = header[i].translate(trans)
-                string = string.replace('_', ' ')
-                string = string.replace('  ', ' ')
-                array = string.split()
-                #if len(array) != 5: raise Exception('Incorrect Header or Data Order')
-                if len(array) != 2: raise Exception('Incorrect Header or Data Order')
-                #coordiSystem[i] = array[2]
-                unit[i] = array[1]
-                axis[i] = array[0]
-                string = string.replace(' ', '')
-                #if string != ('BField'+coordiSystem[i]+axis_r[i]+unit[i]): raise Exception('Incorrect Header or Data Order')
-            if (unit[0] != unit[1] or unit[0] != unit[2] or not(unit[0] != 'nT' or unit[0] != 'T' or unit[0] != 'G')): raise Exception('Incorrect Units')
-            #if (coordiSystem[0] != coordiSystem[1] or coordiSystem[0] != coordiSystem[2] or not(coordiSystem[0] != 'ECF' or coordiSystem[0] != 'ECI')): raise Exception('Incorrect Coordinate System')
+            # Checks the file type and the headers. The reader remembers where the data starts for Extract.
+            self.engine.openProfile(self.path)
             self.setStatus('File is supported')
-            #self.coordinate_system_box.setText(coordiSystem[0])
             self.path_box.setText(os.path.basename(self.path))
             self.setFlag(1,True)
 
         except Exception as etype:
+            self.engine.reader = None
             error = ''
-            if etype.args[0] == 'Incorrect File Type': error = 'Error: ' + etype.args[0] + ' - File must be a csv file'
+            if etype.args[0] == 'Incorrect File Type': error = 'Error: ' + etype.args[0] + ' - File must be a csv file or a compiled profile (.hhcp)'
             elif etype.args[0] == 'Incorrect Header or Data Order': error = 'Error: ' + etype.args[0] + ' - The each column in the first row of the file must have something similar to "B Field - ECF x (nT)" or "B Field - ECI z (G) and must be ordered as x, y and z"'
             elif etype.args[0] == 'Incorrect Units': error = 'Error: ' + etype.args[0] + ' - The only supported units are nT, T and G'
             elif etype.args[0] == 'Incorrect Coordinate System':  error = 'Error: ' + etype.args[0] + ' - The only supported coordinate systems are ECI and ECF'
@@ -270,6 +296,7 @@ class MyApp(QtWidgets.QMainWindow, Ui_MainWindow):
             self.path_box.setText("")
             self.setFlag(1,False)
         except:
+            self.engine.reader = None
             self.setStatus("Error: Unknown")
             self.coordinate_system_box.setText("N/A")
             self.path_box.setText("")
@@ -277,35 +304,57 @@ class MyApp(QtWidgets.QMainWindow, Ui_MainWindow):
 
     # Setups the extract button
     def Extract(self):
-    # Creates variables with the data of the field after extracting the data from the file
+    # Streams the data of the field from the file on a background thread. Run is enabled as soon as the first chunk is in.
         try:
-            with open(os.path.relpath(self.path), 'r', encoding='UTF-8') as file:
-                fileData = csv.reader(file);
-                next(fileData) # Throws away header data since we already know it
-                self.bfield_data[:] = []
-                for currentline in fileData:
-                    if currentline != []:
-                        if '' in currentline: raise Exception('Unbalanced Data')
-                        self.bfield_data.append([float(currentline[0]), float(currentline[1]), float(currentline[2]),
-                        self.isNegative(float(currentline[0])), self.isNegative(float(currentline[1])), self.isNegative(float(currentline[2]))])
-            self.num_of_data_points_box.setText(str(len(self.bfield_data)))
-            self.setStatus("Data extracted!")
-            self.setFlag(2,True)
-        except Exception as etype:
-            error = ''
-            if etype.args[0] == 'Unbalanced Data': error = 'Error: ' + etype.args[0] + ' - The amount of data for each axis is unbalanced'
-            self.setStatus(error)
-            self.coordinate_system_box.setText("N/A")
-            self.path_box.setText("")
-            self.setFlag(1,False)
+            # A file that was compiled before is mapped straight from the cache instead of being parsed again
+            profile, cached = self.engine.loadProfile(self.path, self.extract_signals.chunkLoaded.emit, self.extract_signals.loadFinished.emit)
+            if cached:
+                self.num_of_data_points_box.setText(str(len(profile)))
+                self.setStatus("Data extracted! (cached)")
+                self.setFlag(2,True)
+                return
+            self.setStatus("Extracting data...")
+        except Exception as etype: self.extractFailed(etype)
         except: self.setStatus("Error: Unknown - Retry extraction or reselect a file")
 
+    # Shows the extraction progress after every chunk
+    def extractProgress(self, rows, bytes_read, total_bytes):
+        self.num_of_data_points_box.setText(str(rows))
+        if not self.extract_flag_checkbox.isChecked(): self.setFlag(2,True)
+        if self.sim_worker is None or not self.sim_worker.is_alive():
+            self.setStatus("Extracting data... %d%%" % (100*bytes_read/max(total_bytes, 1)))
+
+    # Called once the whole file has been read
+    def extractFinished(self, error):
+        if error is not None:
+            self.stopSim()
+            self.extractFailed(error)
+            return
+        self.num_of_data_points_box.setText(str(len(self.engine.profile)))
+        # If the run already started while loading, the profile is compiled now and can be cached
+        self.engine.profileLoaded()
+        if self.sim_worker is None or not self.sim_worker.is_alive(): self.setStatus("Data extracted!")
+        self.setFlag(2,True)
+
+    def extractFailed(self, etype):
+        error = ''
+        if etype.args[0] == 'Unbalanced Data': error = 'Error: ' + etype.args[0] + ' - The amount of data for each axis is unbalanced'
+        elif etype.args[0] == 'Invalid Data': error = 'Error: ' + etype.args[0] + ' - The file contains values that are not numbers'
+        elif etype.args[0] == 'Safety Limit Exceeded': error = 'Error: ' + etype.args[-1] + ' - The rest of the profile was not loaded'
+        else: error = 'Error: ' + str(etype.args[0])
+        self.setStatus(error)
+        self.coordinate_system_box.setText("N/A")
+        self.path_box.setText("")
+        self.setFlag(2,False)
+        self.setFlag(1,False)
+
 #=============================================================================#
 #                       Data transfer directly from STK                       #
 #=============================================================================#
 
     # Wrapper for Gavin's function. Interacts with the STK Wizard
     def launchWizard(self):
+        if self.wizard_window is None: self.wizard_window = Wizard()
         self.wizard_window.exec_()
         name = self.wizard_window.getName()
         size = self.wizard_window.getSize()
@@ -318,55 +367,13 @@ class MyApp(QtWidgets.QMainWindow, Ui_MainWindow):
             self.Extract()
 
     # Written by Gavin Brown - gavinb11@vt.edu
+    # Several satellites can be given separated by commas, they are exported at the same time. Each one is
+    # written to a compiled profile, which Extract maps directly, and to a .csv. Returns the first one's profile.
     def STKMagGeneration(self, nameSat, dataStepSize):
-        # Imports
-        import comtypes
-        from comtypes.client import GetActiveObject
-
-        # Getting Open STK Application
-        app = GetActiveObject("STK11.Application")
-        
-        
-        app.Visible=True
-        app.UserControl= True
-        root=app.Personality2
-
-        from comtypes.gen import STKObjects
-
-
-        # Getting Current STK Scenario
-        sc=root.CurrentScenario
-        sc2=sc.QueryInterface(STKObjects.IAgScenario)
-        root.Rewind();
-
-        # Getting Satellite from STK
-        sat = sc.Children.Item(nameSat)
-
-        # Magnetic Field Data for the Satellite
-        rptElements =['Time','x','y','z']
-        magfieldWMMTimeVar=sat.DataProviders.GetDataPrvTimeVarFromPath("Vectors(VNC)//MagField(WMM)")
-        magResults=magfieldWMMTimeVar.ExecElements(sc2.StartTime,sc2.StopTime,dataStepSize,rptElements)
-        #magtime=magResults.DataSets.Item(0).GetValues()
-        magx=magResults.DataSets.Item(1).GetValues()
-        magy=magResults.DataSets.Item(2).GetValues()
-        magz=magResults.DataSets.Item(3).GetValues()
-
-        # Exporting Magnetic Field Data to a CSV File
-        csvFileName = sc.InstanceName + '_MagFieldData.csv'
-        #rowColumnTitle = ['Mag x (nT)', 'Mag y (nT)', 'Mag z (nT)']
-        rowColumnTitle = ['x (nT)', 'y (nT)', 'z (nT)']
-
-        with open(csvFileName, "w", newline='') as csvfile:
-            filewriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            filewriter.writerow(rowColumnTitle)
-            for i, value in enumerate(magx):
-                magxcurr = magx[i]
-                magycurr = magy[i]
-                magzcurr = magz[i]
-                rowcurr = [str(magxcurr), str(magycurr), str(magzcurr)]
-                filewriter.writerow(rowcurr)
-
-        return csvFileName
+        # The STK backends are only imported once the wizard has been used
+        from STKExport import STKProvider, exportSatellites
+        providers = [STKProvider(name.strip()) for name in nameSat.split(',') if name.strip()]
+        return exportSatellites(providers, dataStepSize, csv_file=True, voltage=self.engine.voltage)[0]
 
 #=============================================================================#
 #                           PSU Connection Controls                           #
@@ -382,29 +389,14 @@ class MyApp(QtWidgets.QMainWindow, Ui_MainWindow):
     def Connect(self):
     # Connects to the PSUs and Arduino via ports.
         try:
-
-            self.Arduino = serial.Serial(self.arduino_line.text(), 9600, timeout=0.1)
-            time.sleep(.25)
-            self.ArduinoComm(2,1)
-            self.rm = visa.ResourceManager()
-            
-            self.keithleyX = self.rm.open_resource(self.PSUX_line.text())
-            self.keithleyY = self.rm.open_resource(self.PSUY_line.text())
-            self.keithleyZ = self.rm.open_resource(self.PSUZ_line.text())
-            
-            self.keithleyX.write("ABORt ; SYST:PRES ; DISPlay:MENU:NAME 3") # Makes it so the PSU_connect_portdata shows values for what V/I is currently being outputted
-            self.keithleyY.write("ABORt ; SYST:PRES ; DISPlay:MENU:NAME 3")
-            self.keithleyZ.write("ABORt ; SYST:PRES ; DISPlay:MENU:NAME 3")
-            
-            self.keithleyX.write("OUTP:STAT ON")
-            self.keithleyY.write("OUTP:STAT ON")
-            self.keithleyZ.write("OUTP:STAT ON")
-            
+            self.engine.connect(self.arduino_line.text(), [self.PSUX_line.text(), self.PSUY_line.text(), self.PSUZ_line.text()])
             self.setStatus("Connection active!")
             self.setFlag(7, True)
         
-        except serial.SerialTimeoutException:
-            self.setStatus("Error: No Arduino Communication or Unknown - Make sure the Arduino is connected to the right port")
+        except Exception as etype:
+            if etype.args and etype.args[0] == 'No Arduino Communication':
+                self.setStatus("Error: No Arduino Communication or Unknown - Make sure the Arduino is connected to the right port")
+            else: self.setStatus("Error: No Communication or Unknown - Make sure the ports are correct via Device Manager")
             self.setFlag(7, False)
 
         except:
@@ -412,16 +404,11 @@ class MyApp(QtWidgets.QMainWindow, Ui_MainWindow):
             self.setFlag(7, False)
 
     
-    # Disconnects the computer from the PSUs
+    # Disconnects the computer from the PSUs and the Arduino
     def Disconnect(self):
-    # The connection isn't taken from the Arduino but the port can be changed and restarted
         try:
             self.setFlag(7, False)
-            
-            self.keithleyX.close()
-            self.keithleyY.close()
-            self.keithleyZ.close()
-            
+            self.engine.disconnect()
             self.setStatus("Connection no longer active!")
         except:
             self.setStatus("Error: Unknown")
@@ -455,100 +442,126 @@ class MyApp(QtWidgets.QMainWindow, Ui_MainWindow):
         if self.isfloat(self.zoffset_line.text()): self.setFlag(10, abs(float(self.zoffset_line.text()))>=0)
         else: self.setFlag(10, False)
    
+    # Profiles are compiled with the newest calibration saved by HelmholtzCageCLI.py --calibrate, if there is one.
+    # Looked up when the first profile is compiled so Calibration isn't imported at launch. A file that can't be
+    # read raises 'Cannot Read Calibration' and is tried again on the next run.
+    def loadCalibration(self):
+        if self.calibration_loaded: return
+        from Calibration import CalibrationStore
+        self.engine.calibration = CalibrationStore().load()
+        self.calibration_loaded = True
+
+    # Shows why a run couldn't start or stopped
+    def runFailed(self, etype):
+        if not etype.args: error = 'Error: Unknown - ' + type(etype).__name__
+        elif etype.args[0] == 'Cannot Read Calibration': error = 'Error: ' + etype.args[0] + ' - Fix or remove the newest calibration file'
+        else: error = 'Error: ' + str(etype.args[0])
+        self.setStatus(error)
+        self.setFlag(12, False)
+
+    # Computes the currents and polarity bits for the whole profile from the offsets
     def setupSim(self):
-        self.V_data[:] = []
-        self.I_data[:] = []
-        self.sim_data[:] = []
-
-        for x in range(0,int(self.num_of_data_points_box.text())):
-            # The number 613647 is from the constant values from the equations for the cage.
-            IvalueX = 613647*(self.bfield_data[x][0]*.000000001 +.000000001*float(self.xoffset_line.text()))*1.4492/35; #X Middle Coil 1.4492 35 Coils
-            IvalueY = 613647*(self.bfield_data[x][1]*.000000001 +.000000001*float(self.yoffset_line.text()))*1.3984/35; #Y Small Coil 1.3984 35 Coils
-            IvalueZ = 613647*(self.bfield_data[x][2]*.000000001 +.000000001*float(self.zoffset_line.text()))*1.5/35;    #Z Large Coil 1.5 35 Coils
-            self.V_data.append([self.voltage,self.voltage,self.voltage])
-            self.I_data.append([round(IvalueX,2),round(IvalueY,2),round(IvalueZ,2)])
-            self.sim_data.append([('APPL '+str(self.V_data[x][0])+','+str(self.I_data[x][0])),('APPL '+str(self.V_data[x][1])+','+str(self.I_data[x][1])),('APPL '+str(self.V_data[x][2])+','+str(self.I_data[x][2]))])
-    # Activates the simulation. Also is used to resume the simulation
+        self.loadCalibration()
+        offsets = (float(self.xoffset_line.text()), float(self.yoffset_line.text()), float(self.zoffset_line.text()))
+        return self.engine.compileProfile(offsets)
+
+    # Activates the simulation. The steps are played by a worker thread so the GUI stays responsive.
     def activateSim(self):
         try: # Sets up the simluation
 
             delay = self.ConvertUnit(self.roc_unit_combobox.currentText())*float(self.roc_line.text())
-            self.setupSim()
-            self.setStatus("Simulation about to begin! Keep away from open wires!")
-            time.sleep(1);
+            profile = self.setupSim()
+            # Hard limits (current, voltage, relay switching) block the run before anything is sent
+            validation = self.engine.validate(delay/1000)
+            self.sim_time_box.setText(str(format(validation.stats.get('duration', 0.0), '5.2f')))
+            if validation.blocked:
+                self.setStatus(validation.summary())
+                print(validation.report())
+                return
+            self.setStatus("Simulation about to begin! Keep away from open wires! (" + profile.report() + ") " + validation.summary())
             self.setFlag(12, True)
-            try: # Starts the simulation
-                self.setStatus("Simulation is Running! Keep away from open wires!")
-                for x in range (0,int(self.num_of_data_points_box.text())):
-                    
-                    for y in range(0,3): self.ArduinoComm((y+1)*2,self.bfield_data[x][y+3])
-
-                    self.keithleyX.write(self.sim_data[x][0])
-                    self.keithleyY.write(self.sim_data[x][1])
-                    self.keithleyZ.write(self.sim_data[x][2])
-
-                    self.xfield_box.setText(str(round(self.bfield_data[x][0])))
-                    self.yfield_box.setText(str(round(self.bfield_data[x][1])))
-                    self.zfield_box.setText(str(round(self.bfield_data[x][2])))
-
-                    self.xcurrent_box.setText(str(self.I_data[x][0]))
-                    self.ycurrent_box.setText(str(self.I_data[x][1]))
-                    self.zcurrent_box.setText(str(self.I_data[x][2]))
-
-                    delay_raw = delay
-                    while delay_raw > 100:
-                        if not self.stop_button.isChecked():
-                            time.sleep(.1)
-                            delay_raw = delay_raw - 100
-                        else:
-                            self.stop_flag = 1
-                            break
-                        x = self.pauseSim(x)
-                    x = self.pauseSim(x)
-
-                    if self.stop_button.isChecked() or self.stop_flag:
-                        self.stop_flag = 0
-                        self.clearSim()
-                        self.setStatus("Simulation Stopped!")
-                        self.progress_bar.reset()
-                        self.setFlag(12, False)
-                        break
-                    time.sleep(delay_raw/1000)
-                    self.progress_bar.setValue(100*x/int(self.num_of_data_points_box.text()))
-                self.setStatus("Simulation Complete!")
-                self.clearSim()
-                self.progress_bar.reset()
-                self.setFlag(12, False)
-            except:
-                self.setStatus("Error: Unknown - 1")
-                self.setFlag(12, False)
-        except Exception as e:
-            self.setStatus("Error: Unknown - 2")
-            self.setFlag(12, False)
-            print(e)
-
-
-    def pauseSim(self, index):
-        if self.pause_button.isChecked():
-            self.pause_button.setEnabled(False)
-            self.clearSim()
-            self.setStatus("Simulation Paused!")
+            # The debug flag is read when the run starts rather than from the checkbox on the worker thread
+            self.field_plot.setProfile(profile.bfield)
+            self.plot_time = time.perf_counter()
+            self.sim_worker = self.engine.start(delay/1000, on_state=self.sim_signals.stateChanged.emit,
+                lead_in=1.0, debug=self.debug_flag_checkbox.isChecked())
+        except Exception as etype: self.runFailed(etype)
+
+    # Called by the refresh timer: shows the step the worker played last and adds the measured field to the plot
+    def refreshDisplay(self):
+        if self.sim_worker is None or self.sim_worker.last_played < 0: return
+        start = time.perf_counter()
+        x = self.sim_worker.last_played
+        self.showStep(x)
+        profile = self.engine.profile
+        # While the file is still loading the plot is redone at most once a second
+        if len(profile) != self.field_plot.length and time.perf_counter() - self.plot_time > 1.0:
+            self.field_plot.setProfile(profile.bfield)
+            self.plot_time = time.perf_counter()
+        self.field_plot.addMeasurement(x, self.engine.measuredField())
+        self.field_plot.setPosition(x)
+        self.display_timer.observe(time.perf_counter() - start)
+
+    # Shows a step of the profile
+    def showStep(self, x):
+        profile = self.engine.profile
+        self.xfield_box.setText(str(round(profile.bfield[x,0])))
+        self.yfield_box.setText(str(round(profile.bfield[x,1])))
+        self.zfield_box.setText(str(round(profile.bfield[x,2])))
+
+        self.xcurrent_box.setText(str(profile.currents[x,0]))
+        self.ycurrent_box.setText(str(profile.currents[x,1]))
+        self.zcurrent_box.setText(str(profile.currents[x,2]))
+
+        # Voltages are what the PSUs last reported, not what was commanded
+        latest = self.engine.telemetry.latest() if self.engine.telemetry is not None else None
+        if latest is not None:
+            self.xvoltage_box.setText(str(round(latest[2][0], 2)))
+            self.yvoltage_box.setText(str(round(latest[2][1], 2)))
+            self.zvoltage_box.setText(str(round(latest[2][2], 2)))
+        self.progress_bar.setValue(min(100, int(100*x/max(self.sim_worker.num_steps, 1))))
+
+    # Updates the GUI whenever the worker starts, pauses or finishes
+    def simStateChanged(self, state):
+        self.sim_worker = self.engine.worker
+        # Between queued profiles the display keeps going, queueFinished tidies up at the end
+        if self.queueRunning() and state == 'complete': return
+        if state == 'running':
+            self.setStatus("Simulation is Running! Keep away from open wires!")
+            self.setFlag(13, False)
+            self.refresh_timer.start()
+            return
+        self.refresh_timer.stop()
+        self.clearDisplay()
+        if state == 'paused':
+            self.setStatus("Simulation Paused! Cleared in %.1f ms" % (1000*self.sim_worker.lastClearLatency()))
             self.setFlag(13, True)
-            index = index - 1
-            while self.pause_button.isChecked():
-                if self.stop_button.isChecked():
-                    self.stop_flag = 1
-                time.sleep(1)
-            self.pause_button.setEnabled(True)
-        return index
-
-
-    def clearSim(self):
-         #self.ArduinoComm('0','0') #Pins 8:13
-        self.ArduinoComm(4,4) #Pins 8:13
-        self.keithleyX.write('APPL 0.00,0.00')
-        self.keithleyY.write('APPL 0.00,0.00')
-        self.keithleyZ.write('APPL 0.00,0.00')
+            return
+        if state == 'complete': self.setStatus("Simulation Complete! " + self.engine.report())
+        elif state == 'stopped': self.setStatus("Simulation Stopped! Cleared in %.1f ms" % (1000*self.sim_worker.lastClearLatency()))
+        elif self.sim_worker.error is not None and self.sim_worker.error.args and self.sim_worker.error.args[0] == 'Reconnect Failed':
+            self.setStatus("Error: Lost the instruments mid-run and could not reconnect - Check the cables and connect again")
+            self.setFlag(7, False)
+        elif self.sim_worker.error is not None and self.sim_worker.error.args and self.sim_worker.error.args[0] == 'Safety Limit Exceeded':
+            self.setStatus("Error: " + self.sim_worker.error.args[-1] + " - Run stopped while the profile was loading")
+        elif self.sim_worker.error is not None and self.sim_worker.error.args and self.sim_worker.error.args[0] == 'No Arduino Acknowledgement':
+            self.setStatus("Error: The Arduino did not confirm a relay change - Run stopped before the PSUs were set")
+        elif self.sim_worker.error is not None: self.runFailed(self.sim_worker.error)
+        self.progress_bar.reset()
+        self.pause_button.setChecked(False)
+        self.setFlag(12, False)
+
+    # Pauses or resumes the worker when the pause button is toggled
+    def pauseSim(self, checked):
+        if checked: self.engine.pause()
+        else: self.engine.resume()
+
+    # Stops the worker, the coils are cleared as soon as the current step's writes are done
+    def stopSim(self):
+        if self.queueRunning(): self.queue_runner.stop()
+        else: self.engine.stop()
+
+    def clearDisplay(self):
         self.xfield_box.setText('0')
         self.yfield_box.setText('0')
         self.zfield_box.setText('0')
@@ -559,32 +572,114 @@ class MyApp(QtWidgets.QMainWindow, Ui_MainWindow):
         self.ycurrent_box.setText('0')
         self.zcurrent_box.setText('0')
 
+#=============================================================================#
+#                                  Run Queue                                  #
+#=============================================================================#
+
+    def showQueue(self):
+        self.queue_label.setText('Queue: %d entries%s' % (len(self.run_queue), (' - ' + self.run_queue.report()) if len(self.run_queue) else ''))
+
+    # Queues the selected file with the offsets and rate of change currently entered
+    def addToQueue(self):
+        try:
+            if not self.path: raise Exception('No File Selected')
+            offsets = (float(self.xoffset_line.text()), float(self.yoffset_line.text()), float(self.zoffset_line.text()))
+            self.run_queue.add(self.path, offsets, float(self.roc_line.text()), self.roc_unit_combobox.currentText())
+            self.setStatus('Queued ' + os.path.basename(self.path))
+        except Exception as etype: self.setStatus('Error: ' + str(etype.args[0]) + ' - Select a file and enter the offsets and rate of change first')
+        self.showQueue()
+
+    def clearQueue(self):
+        if self.queue_runner is not None and self.queue_runner.is_alive(): return
+        self.run_queue.entries = []
+        self.run_queue.save()
+        self.showQueue()
+
+    # Plays the queued profiles back to back. The next file is compiled while the current one plays.
+    def runQueue(self):
+        if not self.connect_flag_checkbox.isChecked():
+            self.setStatus('Error: Not Connected - Connect to the PSUs and Arduino first')
+            return
+        if self.engine.isRunning() or (self.queue_runner is not None and self.queue_runner.is_alive()): return
+        if not self.run_queue.remaining(): self.run_queue.reset()
+        if not self.run_queue.remaining():
+            self.setStatus('Error: The queue is empty')
+            return
+        try: self.loadCalibration()
+        except Exception as etype:
+            self.runFailed(etype)
+            return
+        self.setFlag(12, True)
+        self.queue_runner = QueueRunner(self.engine, self.run_queue, lead_in=1.0, debug=self.debug_flag_checkbox.isChecked(),
+            on_entry=lambda index, entry: self.sim_signals.entryStarted.emit(index),
+            on_state=self.sim_signals.stateChanged.emit, on_done=self.sim_signals.queueFinished.emit)
+        self.queue_runner.start()
+
+    def queueEntryStarted(self, index):
+        self.field_plot.setProfile(self.engine.profile.bfield)
+        self.plot_time = time.perf_counter()
+        self.setStatus('Queue %d/%d: %s - Keep away from open wires!' % (index + 1, len(self.run_queue), os.path.basename(self.run_queue.entries[index].path)))
+        self.showQueue()
+
+    def queueFinished(self):
+        self.refresh_timer.stop()
+        self.clearDisplay()
+        failed = [entry for entry in self.run_queue.entries if entry.error]
+        status = 'Queue Finished! ' + self.queue_runner.report()
+        if failed: status += ' - Error: ' + os.path.basename(failed[0].path) + ': ' + failed[0].error
+        self.setStatus(status)
+        self.progress_bar.reset()
+        self.pause_button.setChecked(False)
+        self.setFlag(12, False)
+        self.showQueue()
+
+    def queueRunning(self): return self.queue_runner is not None and self.queue_runner.is_alive()
+
+    # Makes sure the coils are cleared if the window is closed mid-run
+    def closeEvent(self, event):
+        if self.queueRunning(): self.queue_runner.stop()
+        if self.engine.isRunning():
+            self.engine.stop()
+            self.engine.wait(5)
+        self.engine.stopMetrics()
+        event.accept()
+
 
 #=============================================================================#
 #                               UI Classes                                    #
 #=============================================================================#
 
 
-class Wizard(Wiz_base, Wiz_form):
-    def __init__(self):
-        super(Wiz_base,self).__init__()
-        self.setupUi(self)
-        self.satelliteName = None
-        self.stepSize = None
-        self.autofill = True
-        self.open = True
-        self.submit_button.clicked.connect(self.setInfo)
-
-    def setInfo(self):
-        self.satelliteName = self.satNameInput.toPlainText()
-        #TO DO: Install try catch
-        self.stepSize = int(self.stepSizeInput.toPlainText())
-        self.autofill = self.autofillInput.isChecked()
-        self.close()
-    
-    def getName(self): return self.satelliteName
-    def getSize(self): return self.stepSize
-    def getFill(self): return self.autofill
+# Creates the STK wizard dialog, its form is only loaded the first time
+def Wizard():
+    global WizardDialog
+    if WizardDialog is None:
+        Wiz_form, Wiz_base = loadUiType(qtSTKWizard)
+
+        class WizardDialog(Wiz_base, Wiz_form):
+            def __init__(self):
+                super(Wiz_base,self).__init__()
+                self.setupUi(self)
+                self.satelliteName = None
+                self.stepSize = None
+                self.autofill = True
+                self.open = True
+                self.submit_button.clicked.connect(self.setInfo)
+
+            def setInfo(self):
+                self.satelliteName = self.satNameInput.toPlainText()
+                #TO DO: Install try catch
+                self.stepSize = int(self.stepSizeInput.toPlainText())
+                self.autofill = self.autofillInput.isChecked()
+                self.close()
+            
+            def getName(self): return self.satelliteName
+            def getSize(self): return self.stepSize
+            def getFill(self): return self.autofill
+
+    return WizardDialog()
+
+WizardDialog = None
 
 
 
@@ -596,7 +691,14 @@ class Wizard(Wiz_base, Wiz_form):
 if __name__ == "__main__":
 # WARNING - Editting this can break the code!
     app = QtWidgets.QApplication(sys.argv)
-    window = MyApp()
+    window_start = time.perf_counter()
+    # --simulate runs the GUI against SimulatedInstruments, any port and resource names connect
+    backend = None
+    if '--simulate' in sys.argv:
+        from SimulatedInstruments import SimulatedBackend
+        backend = SimulatedBackend()
+    window = MyApp(backend)
     window.show()
+    if '--startup-timing' in sys.argv: print('Startup: imports %.0f ms, window %.0f ms' % (1000*IMPORT_TIME, 1000*(time.perf_counter() - window_start)))
     sys.exit(app.exec_())
     #sys.exit(shutDown())
\ No newline at end of file
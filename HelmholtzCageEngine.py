@@ -0,0 +1,512 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Helmholtz Cage Engine (HelmholtzCageEngine.py)
+#   Description:            Everything needed to run a profile on the cage without Qt: loading and compiling the
+#                           profile, the instrument connections, and the playback worker. The GUI and the command
+#                           line runner (HelmholtzCageCLI.py) are both thin clients of CageEngine.
+#   Inputs/Resources:       A .csv file, the Arduino port and the three PSU VISA resources
+#   Output/Created files:   Arduino Mega with 8-Relays
+#                           3x Keithley 2260B PSU
+#
+#   Notes:                  Errors are raised as Exception('<reason>') like the rest of the controller, so callers
+#                           can match on args[0].
+#                           backend swaps the instruments for simulated ones (SimulatedInstruments.SimulatedBackend),
+#                           anything with resourceManager() and serial(port, baudrate, timeout) works.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import os
+import time
+from PlaybackEngine import PlaybackWorker
+from ProfileIngest import ProfileLoader, openReader
+from ProfileCache import ProfileCache
+from InstrumentConnections import ConnectionManager
+from CommandCoalescer import CommandCoalescer
+from SequenceMode import SequencePlayer
+from PSUTelemetry import TelemetrySampler
+from FieldFeedback import FeedbackController, DEFAULT_KP, DEFAULT_KI, coilGains
+from ProfileValidation import SafetyLimits, LimitGuard, analyzeProfile
+from RunJournal import RunJournal, EXTENSION as JOURNAL_EXTENSION
+from Instrumentation import MetricsRegistry, MetricsServer, RunProfiler, DEFAULT_PORT as METRICS_PORT
+from CageProfile import CageProfile, DEFAULT_VOLTAGE, AXES
+
+# Converts the string into an interger based on the unit given relative to the base unit
+def convertUnit(unit_name):
+    # Base units are milliseconds and nanoTeslas
+    if unit_name == 'nT': return 1
+    elif unit_name == 'T': return 10**9
+    elif unit_name == 'G': return 10**5
+    elif unit_name == 'second(s)': return 1000
+    elif unit_name == 'millisecond(s)': return 1
+    elif unit_name == 'minute(s)': return 60000
+    else: return -1
+
+#=============================================================================#
+#                                 Cage Engine                                 #
+#=============================================================================#
+
+class CageEngine:
+
+    def __init__(self, voltage=DEFAULT_VOLTAGE, catchup_policy='skip', execution_mode='stream', use_cache=True, backend=None):
+        self.voltage = voltage
+        self.backend = backend
+        self.catchup_policy = catchup_policy  # What the scheduler does when a step overruns: 'skip', 'compress' or 'hold'
+        self.execution_mode = execution_mode  # 'stream' sends every step from the PC, 'sequence' uploads windows into the PSUs' list memory
+
+        self.path = None
+        self.reader = None
+        self.loader = None
+        self.profile = None
+        self.resampler = None # Resample.Resampler applied between reading and compiling, the step period becomes its target_period
+        self.offsets = (0.0, 0.0, 0.0)
+        self.calibration = None # Calibration.Calibration the profiles are compiled with, None uses the coil constants
+        self.limits = SafetyLimits()
+        self.validation = None
+        self.validated = None # (profile, steps, period) the validation is for
+        self.cache = None
+        if use_cache:
+            try: self.cache = ProfileCache() # Compiled profiles from earlier runs, keyed by file contents and settings
+            except OSError: self.cache = None
+
+        self.connections = ConnectionManager(backend) # Kept open between runs, reopens instruments that drop out mid-run
+        self.psu = None     # Sends the x, y, z commands to the three PSUs concurrently
+        self.relays = None  # Sets all three relay pairs with one acknowledged frame
+        self.debug_mode = False
+        self.coalescer = CommandCoalescer() # Drops setpoints and relay states that haven't changed since the last step
+        self.sequence_player = None
+        self.worker = None
+        self.telemetry = None # Reads back what the PSUs actually output while connected
+        self.telemetry_rate = 10.0
+        self.magnetometer = None
+        self.closed_loop = False    # Corrects the open loop currents from the magnetometer every step, always streamed
+        self.feedback_gains = (DEFAULT_KP, DEFAULT_KI)
+        self.max_sample_age = 0.05  # Older magnetometer samples aren't used for correction (seconds)
+        self.feedback = None
+        self.journal_directory = None # Every run is journaled into a file here (RunJournal.py), None turns it off
+        self.journal = None
+        self.journal_report = None
+        self.metrics = MetricsRegistry() # Stage timings and run state, served for Prometheus by serveMetrics
+        self.metrics_server = None
+        self.stage_timers = {stage: self.metrics.histogram('helmholtz_stage_seconds', 'Time spent in each stage of getting ready and playing', stage=stage)
+            for stage in ('compile', 'validate', 'connect', 'reconnect', 'step', 'relay')}
+        self.lateness_timer = self.metrics.histogram('helmholtz_step_lateness_seconds', 'How long after its deadline each step started')
+        self.gap_timer = self.metrics.histogram('helmholtz_sequence_gap_seconds', 'Time the coils hold a finished list window while the next is uploaded and triggered')
+        self.addGauges()
+        self.profile_mode = None # 'cprofile' or 'sample' profiles the playback thread of every run (Instrumentation.RunProfiler)
+        self.profile_output = 'helmholtz-run' # The run's start time and the profile's extension are added
+        self.profiler = None
+        self.profiler_report = None
+
+#=============================================================================#
+#                                   Profiles                                  #
+#=============================================================================#
+
+    # Checks the file type and header. The reader remembers where the data starts for loadProfile.
+    def openProfile(self, path):
+        self.reader = openReader(path)
+        self.path = path
+        return self.reader
+
+    # Loads a profile, mapping it from the cache if it was compiled before. With background=True the file is
+    # streamed on a loader thread and the returned profile fills up as it goes; on_chunk and on_done are
+    # called from that thread. Returns the profile and whether it came from the cache.
+    def loadProfile(self, path=None, on_chunk=None, on_done=None, background=True):
+        if path is None: path = self.path
+        if self.reader is None or self.reader.path != path: self.openProfile(path)
+        if self.loader is not None: self.loader.cancel()
+        self.loader = None
+        cache = self.profileCache()
+        cached = cache.loadSamples(path) if cache is not None else None
+        if cached is not None:
+            self.profile = cached
+            return self.profile, True
+        # Compiled profiles are mapped like cache entries, unless they have to be resampled
+        if self.reader.compiled and self.resampler is None:
+            self.profile = self.reader.read()
+            return self.profile, True
+        if background:
+            self.loader = ProfileLoader(self.reader, on_chunk, on_done, cache=cache, transform=self.resampler)
+            self.profile = self.loader.profile
+            self.loader.start()
+        else:
+            self.profile = self.readProfile(self.reader)
+            if cache is not None: cache.sourceHash(path)
+        return self.profile, False
+
+    # Reads a whole file on the calling thread, through the resampler if there is one
+    def readProfile(self, reader):
+        if self.resampler is None: return reader.read()
+        profile = CageProfile(complete=False)
+        for chunk in self.resampler(reader.chunks()): profile.append(chunk)
+        profile.finish()
+        return profile
+
+    # The cache is keyed by the source file, so resampled profiles aren't cached. Compiled profiles are
+    # mapped from their own file instead.
+    def profileCache(self, reader=None):
+        reader = reader or self.reader
+        if self.resampler is not None or (reader is not None and reader.compiled): return None
+        return self.cache
+
+    # Computes the currents and polarity bits for the whole profile from the offsets (nT)
+    def compileProfile(self, offsets):
+        # The steps before a bad row aren't the profile that was asked for
+        if self.profile.error is not None: raise self.profile.error
+        start = time.perf_counter()
+        self.offsets = tuple(offsets)
+        self.validation = self.validated = None
+        if self.profileCache() is not None: self.profile = self.cache.compile(self.profile, self.path, self.reader.unit, offsets, self.voltage, calibration=self.calibration)
+        else: self.profile.compile(offsets, self.voltage, calibration=self.calibration)
+        self.stage_timers['compile'].observe(time.perf_counter() - start)
+        return self.profile
+
+    # Checks the compiled profile against the safety limits. start() refuses to run a profile with errors.
+    def validate(self, period):
+        key = (self.profile, len(self.profile), period)
+        if self.validated != key:
+            self.validation = analyzeProfile(self.profile, period, self.limits, self.offsets)
+            self.validated = key
+            self.stage_timers['validate'].observe(self.validation.analysis_time)
+        return self.validation
+
+    # Loads, compiles and validates a profile without touching the current one, so the next run can be got
+    # ready on another thread while this one plays. Returns (reader, profile, validation) for useProfile.
+    def prepareProfile(self, path, offsets, period):
+        reader = openReader(path)
+        cache = self.profileCache(reader)
+        profile = cache.loadSamples(path) if cache is not None else None
+        if profile is None: profile = self.readProfile(reader)
+        if cache is not None: profile = cache.compile(profile, path, reader.unit, offsets, self.voltage, calibration=self.calibration)
+        else: profile.compile(offsets, self.voltage, calibration=self.calibration)
+        return reader, profile, analyzeProfile(profile, period, self.limits, offsets)
+
+    # Makes a profile from prepareProfile the one start() plays
+    def useProfile(self, reader, profile, offsets, period, validation):
+        if self.loader is not None: self.loader.cancel()
+        self.loader = None
+        self.reader = reader
+        self.path = reader.path
+        self.profile = profile
+        self.offsets = tuple(offsets)
+        self.validation = validation
+        self.validated = (profile, len(profile), period)
+
+    # Stores a profile that was compiled while it was still loading
+    def profileLoaded(self):
+        if self.profileCache() is not None and self.profile.settings is not None: self.cache.store(self.profile, self.path, self.reader.unit)
+
+    # Number of steps, or an estimate while the profile is still loading
+    def profileLength(self):
+        if self.profile.complete: return len(self.profile)
+        return max(len(self.profile), int(self.reader.estimateRows()*(1 if self.resampler is None else self.resampler.scale)))
+
+#=============================================================================#
+#                                 Instruments                                 #
+#=============================================================================#
+
+    # Connects to the Arduino and the three PSUs. psu_resources are the x, y, z VISA resource names.
+    # All four are opened at once and waited on until they answer. Connecting to the instruments that are
+    # already open keeps their sessions.
+    def connect(self, arduino_port, psu_resources):
+        if not self.connections.open(arduino_port, psu_resources): return
+        self.stopTelemetry()
+        self.relays = self.connections.relays
+        self.psu = self.connections.dispatcher
+        self.psu.instrument(self.metrics)
+        self.stage_timers['connect'].observe(self.connections.connect_time)
+        for name in (arduino_port,) + tuple(psu_resources):
+            self.metrics.histogram('helmholtz_connect_seconds', 'Time until each instrument answered when connecting',
+                instrument=name).observe(self.connections.connect_times[name])
+        self.coalescer.invalidate()
+        if self.telemetry_rate > 0:
+            self.telemetry = TelemetrySampler(self.psu, self.telemetry_rate, commanded=self.commandedCurrents)
+            self.telemetry.start()
+
+    # Starts reading the magnetometer. scale converts its readings to nT.
+    def connectMagnetometer(self, port, baud=None, scale=1.0):
+        from Magnetometer import MagnetometerLink, DEFAULT_BAUD
+        if self.magnetometer is not None: self.magnetometer.close()
+        factory = {} if self.backend is None else {'serial_factory': self.backend.serial}
+        try: self.magnetometer = MagnetometerLink(port, baud or DEFAULT_BAUD, scale, **factory).open()
+        except Exception:
+            self.magnetometer = None
+            raise Exception('No Magnetometer Communication')
+
+    def stopTelemetry(self):
+        if self.telemetry is not None:
+            self.telemetry.stop()
+            self.telemetry.join(1)
+        self.telemetry = None
+
+    # Closes the PSU sessions and the Arduino's port so either can be connected again
+    def disconnect(self):
+        self.closeJournal()
+        if self.magnetometer is not None: self.magnetometer.close()
+        self.magnetometer = None
+        self.stopTelemetry()
+        self.connections.close()
+        self.psu = None
+        self.relays = None
+
+#=============================================================================#
+#                                 Calibration                                 #
+#=============================================================================#
+
+    # Sweeps the coil currents, fits a calibration to what the magnetometer measured and compiles with it from
+    # now on. store (Calibration.CalibrationStore) saves it as the next version and record saves the sweep
+    # to an .npz file. sweep is passed on to Calibration.runSweep.
+    def calibrate(self, store=None, record=None, **sweep):
+        from Calibration import runSweep, fitCalibration, saveSweep, DEFAULT_CAGE
+        currents, fields = runSweep(self, **sweep)
+        if record is not None: saveSweep(record, currents, fields)
+        calibration = fitCalibration(currents, fields, DEFAULT_CAGE if store is None else store.cage)
+        if store is not None: store.save(calibration)
+        self.calibration = calibration
+        return calibration
+
+#=============================================================================#
+#                                   Playback                                  #
+#=============================================================================#
+
+    # Last current written to each PSU, NaN where it isn't known
+    def commandedCurrents(self): return [float('nan') if current is None else float(current) for current in self.coalescer.currents]
+
+    # Field the cage is making (nT): the magnetometer's reading if there is one, otherwise worked out from the
+    # PSUs' measured currents and the relay polarity. None if neither is available.
+    def measuredField(self):
+        if self.magnetometer is not None: return self.magnetometer.latest()
+        latest = self.telemetry.latest() if self.telemetry is not None else None
+        mask = self.coalescer.mask
+        if latest is None or mask is None or self.profile is None or self.profile.settings is None: return None
+        offsets, coil_constants = self.profile.settings
+        currents = [abs(latest[1][axis])*(-1 if (mask >> axis) & 1 else 1) for axis in range(3)]
+        if self.profile.calibration is not None: return (self.profile.calibration.field(currents) - offsets).tolist()
+        gains = coilGains(coil_constants)
+        return [currents[axis]/gains[axis] - offsets[axis] for axis in range(3)]
+
+    # Sets the polarity of all three axes at once, bit 0/1/2 set = x/y/z negative
+    # A missed acknowledgement gets the frame sent once more. If that is missed too the step is given up before
+    # the PSUs are written, so the coils never get the new current with the old polarity.
+    def setPolarity(self, mask):
+        if self.debug_mode: return True
+        try:
+            if self.sendRelays(mask) or self.sendRelays(mask): return True
+        except (IOError, OSError) as error: raise Exception('No Arduino Communication', error)
+        raise Exception('No Arduino Acknowledgement', mask)
+
+    # Sends a relay mask, or turns the relays off, and journals it
+    def sendRelays(self, mask, energized=True):
+        journal = self.journal
+        start = time.perf_counter()
+        acknowledged = self.relays.setPolarity(mask) if energized else self.relays.allOff()
+        end = time.perf_counter()
+        self.stage_timers['relay'].observe(end - start)
+        if journal is not None: journal.relay(start, end, mask, acknowledged, energized)
+        return acknowledged
+
+    # Wraps a step function so that an instrument dropping out is reopened and the step played again, which
+    # sends every setpoint and the relay mask afresh. Gives up with Exception('Reconnect Failed').
+    def recoverable(self, play_step):
+        def step(x):
+            try: return play_step(x)
+            except Exception as error:
+                if not error.args or error.args[0] not in ('No PSU Communication', 'No Arduino Communication'): raise
+                if self.journal is not None: self.journal.event('%s at step %d: %s' % (error.args[0], x, error.args[-1]))
+                if error.args[0] == 'No PSU Communication': latency = self.connections.reconnect(axes=error.args[1])
+                else: latency = self.connections.reconnect(relays=True)
+                self.stage_timers['reconnect'].observe(latency)
+                if self.journal is not None: self.journal.event('Reconnected in %.1f ms' % (latency*1e3))
+                self.coalescer.invalidate()
+                return play_step(x)
+        return step
+
+    # Sends a single step of the profile to the Arduino and the PSUs. Runs on the worker thread.
+    def playStep(self, x):
+        self.sendSetpoints(int(self.profile.polarity[x]), self.profile.currents[x], lambda axis: self.profile.command(x,axis))
+
+    # Closed loop version of playStep, the currents are corrected from the newest magnetometer sample
+    def playFeedbackStep(self, x):
+        currents = self.feedback.update(x, self.magnetometer.latest(self.max_sample_age))
+        mask = (currents[0] < 0) | (currents[1] < 0) << 1 | (currents[2] < 0) << 2
+        self.sendSetpoints(mask, currents, lambda axis: 'APPL ' + self.profile.voltage_text + ',' + str(currents[axis]))
+
+    # Sets signed coil currents (A) outside of a run, e.g. for a calibration sweep
+    def setCurrents(self, currents):
+        currents = [round(float(current), 2) for current in currents]
+        mask = (currents[0] < 0) | (currents[1] < 0) << 1 | (currents[2] < 0) << 2
+        self.sendSetpoints(mask, currents, lambda axis: 'APPL ' + str(self.voltage) + ',' + str(currents[axis]))
+
+    # Only what changed since the last acknowledged state is sent. command(axis) builds an axis' APPL command.
+    def sendSetpoints(self, mask, currents, command):
+        if self.coalescer.relayChanged(mask):
+            self.setPolarity(mask)
+            self.coalescer.confirmRelay(mask)
+
+        changed = self.coalescer.changedAxes(currents)
+        self.psu.write([command(axis) if changed[axis] else None for axis in range(0,3)])
+        self.coalescer.confirmCurrents(currents, changed)
+
+    # Turns the coils off. Called from the worker thread.
+    def clearOutputs(self):
+        self.coalescer.invalidate()
+        if self.sequence_player is not None and self.sequence_player.list_active: self.sequence_player.abort()
+        if not self.debug_mode: self.sendRelays(0, False) #Pins 8:13
+        self.psu.broadcast('APPL 0.00,0.00')
+
+    # Starts playing the compiled profile with a step every period seconds. on_step(index) and
+    # on_state(state) are called from the worker thread. With debug set the Arduino isn't written to.
+    # first_step and hold are passed on to PlaybackWorker, for resuming a run and running profiles back to back.
+    def start(self, period, on_step=None, on_state=None, lead_in=0.0, debug=False, first_step=0, hold=False):
+        validation = self.validate(period)
+        if validation.blocked: raise Exception('Safety Limit Exceeded')
+        # The steps that load after the check are checked as they are compiled, the run stops on one that breaks a limit
+        if not self.profile.complete: self.profile.watch(LimitGuard(period, self.limits, validation.checked_steps))
+        self.psu.reset()
+        self.debug_mode = debug
+        self.coalescer.invalidate()
+        self.coalescer.resetCounts()
+        play_step = self.playStep
+        if self.sequence_player is not None: self.sequence_player.shutdown()
+        self.sequence_player = None
+        self.feedback = None
+        if self.closed_loop:
+            if self.magnetometer is None: raise Exception('No Magnetometer Communication')
+            self.feedback = FeedbackController(self.profile, *self.feedback_gains)
+            play_step = self.playFeedbackStep
+        elif self.execution_mode == 'sequence':
+            # Falls back to playStep for anything the PSUs' lists can't express
+            self.sequence_player = SequencePlayer(self.profile, period, self.psu, self.playStep, self.setPolarity, invalidate=self.coalescer.invalidate,
+                gap_timer=self.gap_timer)
+            play_step = self.sequence_player.playStep
+        play_step = self.instrumented(self.recoverable(play_step))
+        self.journal_report = None
+        if self.journal_directory is not None:
+            self.openJournal(period)
+            play_step = self.journaled(play_step)
+        self.profiler = self.profiler_report = None
+        if self.profile_mode is not None: self.profiler = RunProfiler(self.profile_mode, self.profile_output + time.strftime('-%Y%m%d-%H%M%S'))
+        on_state = self.finishWhenDone(on_state)
+        # Every step is scheduled against an absolute deadline so the I/O time is never added on top of the delay.
+        # Playback can start while the rest of the file is still loading.
+        self.worker = PlaybackWorker(self.profileLength(), period, play_step, self.clearOutputs, self.catchup_policy,
+            on_step=on_step, on_state=on_state, lead_in=lead_in, source=self.profile, start=first_step, hold=hold)
+        self.worker.start()
+        return self.worker
+
+#=============================================================================#
+#                                   Journal                                   #
+#=============================================================================#
+
+    # Starts a journal for the run and hooks it into everything that talks to the instruments
+    def openJournal(self, period):
+        self.closeJournal()
+        now = time.time()
+        name = time.strftime('run-%Y%m%d-%H%M%S', time.localtime(now)) + '-%03d' % (int(now*1000) % 1000) + JOURNAL_EXTENSION
+        meta = {'profile': None if self.path is None else os.path.abspath(self.path), 'period': period, 'offsets': list(self.offsets),
+            'voltage': self.voltage, 'policy': self.catchup_policy, 'mode': self.execution_mode, 'closed_loop': self.closed_loop,
+            'debug': self.debug_mode, 'steps': self.profileLength()}
+        self.journal = RunJournal(os.path.join(self.journal_directory, name), meta)
+        self.psu.journal = self.journal
+        if self.telemetry is not None: self.telemetry.journal = self.journal
+        if self.magnetometer is not None: self.magnetometer.journal = self.journal
+
+    # Unhooks the journal and writes out the rest of it
+    def closeJournal(self):
+        journal = self.journal
+        if journal is None: return
+        self.journal = None
+        if self.psu is not None: self.psu.journal = None
+        if self.telemetry is not None: self.telemetry.journal = None
+        if self.magnetometer is not None: self.magnetometer.journal = None
+        journal.close()
+        self.journal_report = journal.report() + ' to ' + os.path.basename(journal.filename)
+
+    # Wraps a step function so every step's start and deadline are journaled before it is played
+    def journaled(self, play_step):
+        def step(x):
+            journal = self.journal
+            if journal is not None: journal.stepStarted(x, journal.clock(), self.worker.scheduler.deadline(x))
+            return play_step(x)
+        return step
+
+    # Wraps an on_state callback so the journal is closed and the profile written once the run is over.
+    # Runs on the worker thread, which cProfile has to be stopped from.
+    def finishWhenDone(self, on_state):
+        def stateChanged(state):
+            if state in ('complete', 'stopped', 'error'):
+                self.closeJournal()
+                self.endProfiler()
+            if on_state is not None: on_state(state)
+        return stateChanged
+
+    def pause(self):
+        if self.worker is not None: self.worker.pause()
+
+    def resume(self):
+        if self.worker is not None: self.worker.resume()
+
+    def stop(self):
+        if self.worker is not None: self.worker.stop()
+
+    def isRunning(self): return self.worker is not None and self.worker.is_alive()
+
+    # Waits for the run to finish
+    def wait(self, timeout=None):
+        if self.worker is not None: self.worker.join(timeout)
+
+    # Timing, dispatch and coalescing statistics of the last run
+    def report(self):
+        report = self.worker.scheduler.stats.report() + ", " + self.psu.report() + ", " + self.coalescer.report() + ", " + self.connections.report()
+        if self.sequence_player is not None: report += ", " + self.sequence_player.report()
+        if self.resampler is not None: report += ", " + self.resampler.report()
+        if self.telemetry is not None: report += ", " + self.telemetry.report()
+        if self.feedback is not None: report += ", " + self.feedback.report() + ", " + self.magnetometer.report()
+        if self.journal_report is not None: report += ", " + self.journal_report
+        if self.profiler_report is not None: report += ", " + self.profiler_report
+        return report + ", " + self.metrics.report()
+
+#=============================================================================#
+#                                   Metrics                                   #
+#=============================================================================#
+
+    # Wraps a step function to time it and how late it started, and starts the profiler on the worker thread.
+    # Costs two clock reads and two histogram updates a step, see Instrumentation.measureOverhead.
+    def instrumented(self, play_step):
+        step_timer, lateness_timer, clock = self.stage_timers['step'], self.lateness_timer, time.perf_counter
+        def step(x):
+            profiler = self.profiler
+            if profiler is not None and not profiler.started: profiler.begin()
+            start = clock()
+            lateness_timer.observe(max(0.0, start - self.worker.scheduler.deadline(x)))
+            try: return play_step(x)
+            finally: step_timer.observe(clock() - start)
+        return step
+
+    def endProfiler(self):
+        profiler = self.profiler
+        if profiler is None or not profiler.started: return
+        profiler.end()
+        self.profiler_report = profiler.report()
+
+    # Values read when the metrics are scraped, ones that can't be read yet are left out
+    def addGauges(self):
+        gauge = self.metrics.gauge
+        gauge('helmholtz_running', 'Whether a profile is playing', self.isRunning)
+        gauge('helmholtz_step', 'Step last played', lambda: self.worker.last_played)
+        gauge('helmholtz_steps', 'Steps in the profile being played', lambda: self.worker.num_steps)
+        gauge('helmholtz_skipped_steps', 'Steps skipped by the scheduler this run', lambda: self.worker.scheduler.stats.skipped)
+        gauge('helmholtz_failed_reconnects', 'Instruments that could not be reopened', lambda: self.connections.failed_reconnects)
+        for axis in range(3):
+            gauge('helmholtz_commanded_current_amps', 'Last current written to each PSU', lambda axis=axis: self.commandedCurrents()[axis], axis=AXES[axis])
+            gauge('helmholtz_measured_current_amps', 'Current each PSU last read back', lambda axis=axis: self.telemetry.latest()[1][axis], axis=AXES[axis])
+
+    # Serves the metrics on http://127.0.0.1:port/metrics. Returns the port, port=0 picks a free one.
+    def serveMetrics(self, port=METRICS_PORT):
+        self.stopMetrics()
+        self.metrics_server = MetricsServer(self.metrics, port)
+        return self.metrics_server.port
+
+    def stopMetrics(self):
+        if self.metrics_server is not None: self.metrics_server.close()
+        self.metrics_server = None
@@ -0,0 +1,191 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Instrument Connections (InstrumentConnections.py)
+#   Description:            Opens the Arduino and the three Keithley 2260B PSUs at the same time, waits until each one
+#                           answers instead of sleeping, and keeps the sessions open between runs. If an instrument
+#                           drops out mid-run it is reopened within a bounded time.
+#   Inputs/Resources:       The Arduino port and the x, y, z VISA resource names
+#   Output/Created files:   Open RelayLink, PSU sessions and PSUDispatcher, connect and reconnect timings
+#
+#   Notes:                  A PSU counts as ready once it answers *IDN? and, after the preset, *OPC?.
+#                           The Arduino counts as ready once it acknowledges a frame (RelayLink.open).
+#                           A PSU is reopened on its dispatcher thread, so nothing else uses the session meanwhile.
+#                           The caller restores the setpoints after a reconnect, this only brings the sessions back.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from PSUDispatch import PSUDispatcher
+from PlaybackEngine import StepTimingStats
+
+PRESET_COMMANDS = ("ABORt ; SYST:PRES ; DISPlay:MENU:NAME 3", "OUTP:STAT ON") # The menu makes the front panel show the V/I being output
+READY_TIMEOUT = 5.0     # How long an instrument has to answer when connecting (seconds)
+RECONNECT_TIMEOUT = 3.0 # How long a reconnect may take mid-run, the Arduino needs about 2 s to reset (seconds)
+RETRY_INTERVAL = 0.05
+
+# Opens the VISA resource manager, newer installs only have the pyvisa name
+def openResourceManager():
+    try: import pyvisa as visa
+    except ImportError: import visa
+    return visa.ResourceManager()
+
+#=============================================================================#
+#                              Connection Manager                             #
+#=============================================================================#
+
+class ConnectionManager:
+
+    # backend swaps the instruments for simulated ones, see SimulatedInstruments.SimulatedBackend
+    def __init__(self, backend=None, ready_timeout=READY_TIMEOUT, reconnect_timeout=RECONNECT_TIMEOUT, clock=time.perf_counter):
+        self.backend = backend
+        self.ready_timeout = ready_timeout
+        self.reconnect_timeout = reconnect_timeout
+        self.clock = clock
+        self.arduino_port = None
+        self.psu_resources = ()
+        self.rm = None
+        self.relays = None
+        self.psus = []
+        self.dispatcher = None
+        self.connect_time = 0.0
+        self.connect_times = {} # Seconds until each instrument was ready, by port or resource name
+        self.reconnect_latency = array('d')
+        self.failed_reconnects = 0
+
+    def isOpen(self): return self.dispatcher is not None
+
+    # Opens everything, or does nothing if the same instruments are already open. Returns whether it connected.
+    def open(self, arduino_port, psu_resources):
+        psu_resources = tuple(psu_resources)
+        if self.isOpen() and self.arduino_port == arduino_port and self.psu_resources == psu_resources: return False
+        self.close()
+        start = self.clock()
+        if self.rm is None: self.rm = openResourceManager() if self.backend is None else self.backend.resourceManager()
+        deadline = start + self.ready_timeout
+        with ThreadPoolExecutor(max_workers=1 + len(psu_resources), thread_name_prefix='Connect') as pool:
+            relays = pool.submit(self.timed, arduino_port, self.openRelays, arduino_port, deadline)
+            psus = [pool.submit(self.timed, resource, self.openPSU, resource, deadline, True) for resource in psu_resources]
+            # Waits for all of them so nothing is left half open behind an error
+            results = [future.exception() for future in [relays] + psus]
+        if any(error is not None for error in results):
+            for future in [relays] + psus:
+                if future.exception() is None: future.result().close()
+            if results[0] is not None: raise Exception('No Arduino Communication')
+            raise Exception('No PSU Communication', [axis for axis in range(len(psus)) if results[axis + 1] is not None])
+        self.relays = relays.result()
+        self.psus = [future.result() for future in psus]
+        self.dispatcher = PSUDispatcher(self.psus)
+        self.arduino_port = arduino_port
+        self.psu_resources = psu_resources
+        self.connect_time = self.clock() - start
+        return True
+
+    # Runs function(*args) and records how long it took under name
+    def timed(self, name, function, *args):
+        start = self.clock()
+        result = function(*args)
+        self.connect_times[name] = self.clock() - start
+        return result
+
+    # Opens the Arduino, falling back to the old protocol at 9600 baud for old firmware
+    def openRelays(self, port, deadline):
+        from RelayLink import RelayLink
+        factory = {} if self.backend is None else {'serial_factory': self.backend.serial}
+        return RelayLink(port, **factory).open(max(0.0, deadline - self.clock()))
+
+    # Opens a PSU session and waits until it answers. preset puts it back to its power on state first.
+    def openPSU(self, resource, deadline, preset=False):
+        session = self.rm.open_resource(resource)
+        try:
+            self.waitReady(session, '*IDN?', deadline)
+            if preset: session.write(PRESET_COMMANDS[0])
+            session.write(PRESET_COMMANDS[1])
+            self.waitReady(session, '*OPC?', deadline)
+        except Exception:
+            session.close()
+            raise
+        return session
+
+    # Repeats a query until it gets an answer or the deadline passes
+    def waitReady(self, session, query, deadline):
+        while True:
+            try:
+                if session.query(query).strip(): return
+            except Exception:
+                if self.clock() + RETRY_INTERVAL >= deadline: raise
+            if self.clock() + RETRY_INTERVAL >= deadline: raise Exception('Instrument Not Ready')
+            time.sleep(RETRY_INTERVAL)
+
+#=============================================================================#
+#                                  Reconnect                                  #
+#=============================================================================#
+
+    # Reopens the PSUs of the given axes and, if relays is set, the Arduino. The PSUs are reopened on their own
+    # dispatcher threads alongside the Arduino. Returns the time it took.
+    def reconnect(self, axes=(), relays=False):
+        start = self.clock()
+        deadline = start + self.reconnect_timeout
+        futures = [self.dispatcher.submit(axis, self.reopenPSU, axis, deadline) for axis in axes]
+        try:
+            if relays: self.reopenRelays(deadline)
+            for future in futures: future.result()
+        except Exception:
+            for future in futures: future.exception()
+            self.failed_reconnects += 1
+            raise Exception('Reconnect Failed')
+        latency = self.clock() - start
+        self.reconnect_latency.append(latency)
+        return latency
+
+    # Tries to reopen one PSU until the deadline. Runs on the axis' dispatcher thread.
+    def reopenPSU(self, axis, deadline):
+        try: self.psus[axis].close()
+        except Exception: pass
+        while True:
+            try: session = self.openPSU(self.psu_resources[axis], deadline)
+            except Exception:
+                if self.clock() + RETRY_INTERVAL >= deadline: raise
+                time.sleep(RETRY_INTERVAL)
+                continue
+            self.psus[axis] = self.dispatcher.instruments[axis] = session
+            return
+
+    def reopenRelays(self, deadline):
+        self.relays.close()
+        while True:
+            try: return self.relays.open(max(0.0, deadline - self.clock()))
+            except Exception:
+                self.relays.close()
+                if self.clock() + RETRY_INTERVAL >= deadline: raise
+                time.sleep(RETRY_INTERVAL)
+
+#=============================================================================#
+#                                    Close                                    #
+#=============================================================================#
+
+    # Closes every session including the Arduino's port, so the same ports can be opened again
+    def close(self):
+        if self.dispatcher is not None: self.dispatcher.shutdown()
+        self.dispatcher = None
+        for psu in self.psus:
+            try: psu.close()
+            except Exception: pass
+        self.psus = []
+        if self.relays is not None:
+            try: self.relays.close()
+            except Exception: pass
+        self.relays = None
+        self.arduino_port = None
+        self.psu_resources = ()
+
+    # Connect time and reconnect latency in milliseconds
+    def report(self):
+        report = 'connected in %.0f ms' % (self.connect_time*1e3)
+        if self.reconnect_latency or self.failed_reconnects:
+            report += (', %d reconnects p50/max %.0f/%.0f ms, %d failed'
+                % (len(self.reconnect_latency), StepTimingStats.percentile(self.reconnect_latency, 50)*1e3,
+                max(self.reconnect_latency, default=0.0)*1e3, self.failed_reconnects))
+        return report
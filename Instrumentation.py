@@ -0,0 +1,276 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Instrumentation (Instrumentation.py)
+#   Description:            Low overhead timers for the stages of a step and of connecting, kept as fixed bucket
+#                           histograms, a local HTTP endpoint serving them in the Prometheus text format, and a
+#                           profiler that captures a cProfile or sampled stack trace of the playback thread.
+#   Inputs/Resources:       Durations observed by the engine, the PSU dispatcher and the GUI
+#   Output/Created files:   http://127.0.0.1:<port>/metrics, <name>.prof (cProfile) or <name>.stacks (folded stacks)
+#
+#   Notes:                  A histogram is a fixed list of bucket counts, so memory doesn't grow with the run length.
+#                           Buckets are 1, 2, 5 per decade from 1 us to 10 s. Quantiles in the report are the upper
+#                           bound of the bucket they fall in.
+#                           The endpoint only listens on localhost. measureOverhead() times observe() so the cost of
+#                           the instrumentation per step can be checked against the step period.
+#                           The .stacks file is one "frame;frame;frame count" line per stack, which flamegraph tools read.
+#                           SampleRing keeps the last values of a series for exact percentiles, also in constant memory.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import sys
+import time
+import bisect
+import cProfile
+import threading
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 9464
+BUCKETS = tuple(mantissa*10.0**exponent for exponent in range(-6, 1) for mantissa in (1, 2, 5)) + (10.0,)
+PROFILE_MODES = ('cprofile', 'sample')
+SAMPLE_INTERVAL = 0.001
+RING_CAPACITY = 65536 # Values a SampleRing keeps, about a minute of a 1 kHz loop
+
+#=============================================================================#
+#                                  Histograms                                 #
+#=============================================================================#
+
+class Histogram:
+
+    def __init__(self, name, labels=(), bounds=BUCKETS):
+        self.name = name
+        self.labels = labels # (name, value) pairs
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds) + 1) # The last bucket is everything above the highest bound
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # Adds one duration in seconds. Called from the playback and PSU threads.
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    # Upper bound of the bucket the q quantile (0-1) falls in
+    def quantile(self, q):
+        with self.lock: counts, count = list(self.counts), self.count
+        if not count: return 0.0
+        target = q*count
+        total = 0
+        for index, bucket in enumerate(counts):
+            total += bucket
+            if total >= target: return self.bounds[index] if index < len(self.bounds) else float('inf')
+        return float('inf')
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0]*(len(self.bounds) + 1)
+            self.sum = 0.0
+            self.count = 0
+
+# The last capacity values of a series. Iterates like the array it replaces, so StepTimingStats.percentile
+# can be taken over it; the order of the values is lost once it wraps.
+class SampleRing:
+
+    def __init__(self, capacity=RING_CAPACITY):
+        self.capacity = capacity
+        self.values = array('d')
+        self.count = 0 # Values ever added
+
+    def append(self, value):
+        if len(self.values) < self.capacity: self.values.append(value)
+        else: self.values[self.count % self.capacity] = value
+        self.count += 1
+
+    def __len__(self): return len(self.values)
+
+    def __iter__(self): return iter(self.values)
+
+def formatLabels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs: return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+#=============================================================================#
+#                                   Registry                                  #
+#=============================================================================#
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}    # (name, labels) -> Histogram
+        self.gauges = {}        # (name, labels) -> function returning the value
+        self.help = {}
+        self.cost = None
+
+    # Seconds one timed stage costs, measured the first time it is asked for
+    @property
+    def observe_cost(self):
+        if self.cost is None: self.cost = measureOverhead()
+        return self.cost
+
+    # Returns the histogram with a name and labels, making it the first time
+    def histogram(self, name, help='', **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms: self.histograms[key] = Histogram(name, key[1])
+            if help: self.help[name] = help
+            return self.histograms[key]
+
+    # Registers a value that is read when the metrics are scraped
+    def gauge(self, name, help, function, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = function
+            self.help[name] = help
+
+    def reset(self):
+        with self.lock: histograms = list(self.histograms.values())
+        for histogram in histograms: histogram.reset()
+
+    # Prometheus text exposition format
+    def render(self):
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            gauges = sorted(self.gauges.items())
+        lines = []
+        described = set()
+        for (name, labels), histogram in histograms:
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, self.help.get(name, name)))
+                lines.append('# TYPE %s histogram' % name)
+            with histogram.lock: counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+            cumulative = 0
+            for bound, bucket in zip(histogram.bounds, counts):
+                cumulative += bucket
+                lines.append('%s_bucket%s %d' % (name, formatLabels(labels, [('le', '%g' % bound)]), cumulative))
+            lines.append('%s_bucket%s %d' % (name, formatLabels(labels, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %.9g' % (name, formatLabels(labels), total))
+            lines.append('%s_count%s %d' % (name, formatLabels(labels), count))
+        for (name, labels), function in gauges:
+            try: value = float(function())
+            except Exception: continue
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, self.help.get(name, name)))
+                lines.append('# TYPE %s gauge' % name)
+            lines.append('%s%s %s' % (name, formatLabels(labels), 'NaN' if value != value else '%.9g' % value))
+        return '\n'.join(lines) + '\n'
+
+    # p50/p99 of every histogram that has samples, in milliseconds
+    def report(self):
+        with self.lock: histograms = sorted(self.histograms.items())
+        parts = []
+        for (name, labels), histogram in histograms:
+            if not histogram.count: continue
+            label = ','.join(str(value) for _name, value in labels)
+            parts.append('%s%s p50/p99 %.3g/%.3g ms' % (name.replace('helmholtz_', '').replace('_seconds', ''),
+                '[' + label + ']' if label else '', histogram.quantile(0.5)*1e3, histogram.quantile(0.99)*1e3))
+        return ', '.join(parts) + (', %.2f us per observation' % (self.observe_cost*1e6))
+
+# Seconds one clock read and observe() take, the cost of timing one stage
+def measureOverhead(samples=20000):
+    histogram = Histogram('overhead')
+    clock = time.perf_counter
+    start = clock()
+    for _index in range(samples): histogram.observe(clock() - start)
+    return (clock() - start)/samples
+
+#=============================================================================#
+#                                   Endpoint                                  #
+#=============================================================================#
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): pass
+
+# Serves a registry on http://127.0.0.1:port/metrics from a thread of its own. port=0 picks a free port.
+class MetricsServer:
+
+    def __init__(self, registry, port=DEFAULT_PORT, host='127.0.0.1'):
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.registry = registry
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='MetricsServer', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+#=============================================================================#
+#                                   Profiler                                  #
+#=============================================================================#
+
+# Profiles the thread that calls begin() until end(). 'cprofile' writes <filename>.prof for pstats or snakeviz,
+# 'sample' looks at the thread's stack every SAMPLE_INTERVAL from another thread and writes <filename>.stacks.
+class RunProfiler:
+
+    def __init__(self, mode, filename):
+        if mode not in PROFILE_MODES: raise Exception('Unknown Profiling Mode')
+        self.mode = mode
+        self.filename = filename + ('.prof' if mode == 'cprofile' else '.stacks')
+        self.profile = None
+        self.sampler = None
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.started = False
+
+    # Called from the thread to be profiled
+    def begin(self):
+        if self.started: return
+        self.started = True
+        if self.mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.sampler = threading.Thread(target=self.sample, args=(threading.get_ident(),), name='Sampler', daemon=True)
+            self.sampler.start()
+
+    def sample(self, thread_id):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None: break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, code.co_filename.replace('\\', '/').split('/')[-1], code.co_firstlineno))
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    # Stops profiling and writes the file. cProfile has to be stopped from the profiled thread.
+    def end(self):
+        if not self.started: return
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.filename)
+        if self.sampler is not None:
+            self.stopped.set()
+            self.sampler.join()
+            with open(self.filename, 'w') as file:
+                for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]): file.write('%s %d\n' % (stack, count))
+        self.started = False
+
+    def report(self):
+        if self.mode == 'sample': return 'profile of %d samples written to %s' % (self.samples, self.filename)
+        return 'profile written to ' + self.filename
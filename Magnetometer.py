@@ -0,0 +1,101 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Magnetometer (Magnetometer.py)
+#   Description:            Reads the magnetometer in the cage over serial on a thread of its own and keeps the newest
+#                           sample, so the playback loop can use it without ever waiting on the port.
+#   Inputs/Resources:       A serial port streaming one "x,y,z" line per sample (or any pyserial URL)
+#   Output/Created files:   The latest field sample (nT) with its arrival time, sample rate statistics
+#
+#   Notes:                  Values are multiplied by scale to get nT, e.g. scale=100000 for a sensor reporting in G.
+#                           Lines that can't be parsed are counted and skipped.
+#                           The rate is taken from the first and newest sample, the interval percentile from the last
+#                           Instrumentation.RING_CAPACITY intervals, so a long run doesn't grow the memory.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import time
+import threading
+import serial
+from PlaybackEngine import StepTimingStats
+from Instrumentation import SampleRing
+
+DEFAULT_BAUD = 115200
+READ_TIMEOUT = 0.1
+
+# Returns the x, y, z values of a line, None if it isn't one
+def parseSample(line, scale=1.0):
+    try:
+        values = [float(value)*scale for value in line.decode('ascii', 'replace').strip().split(',')]
+    except ValueError: return None
+    return values if len(values) == 3 else None
+
+#=============================================================================#
+#                               Magnetometer Link                             #
+#=============================================================================#
+
+class MagnetometerLink(threading.Thread):
+
+    def __init__(self, port, baud=DEFAULT_BAUD, scale=1.0, serial_factory=serial.serial_for_url, clock=time.perf_counter):
+        threading.Thread.__init__(self, name='Magnetometer', daemon=True)
+        self.port = port
+        self.baud = baud
+        self.scale = scale
+        self.serial_factory = serial_factory
+        self.clock = clock
+        self.serial = None
+        self.newest = None      # ([x, y, z] in nT, arrival time) of the newest sample
+        self.samples = 0
+        self.bad_lines = 0
+        self.first_time = None # Arrival time of the first sample
+        self.intervals = SampleRing()
+        self.journal = None # RunJournal.RunJournal the samples are recorded in
+        self.stopped = threading.Event()
+
+    # Opens the port and starts reading
+    def open(self):
+        self.serial = self.serial_factory(self.port, baudrate=self.baud, timeout=READ_TIMEOUT)
+        self.start()
+        return self
+
+    def close(self):
+        self.stopped.set()
+        if self.is_alive(): self.join(1)
+        if self.serial is not None: self.serial.close()
+        self.serial = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            try: line = self.serial.readline()
+            except Exception:
+                if self.stopped.is_set(): break
+                raise
+            if not line: continue
+            sample = parseSample(line, self.scale)
+            if sample is None:
+                self.bad_lines += 1
+                continue
+            now = self.clock()
+            if self.newest is not None: self.intervals.append(now - self.newest[1])
+            else: self.first_time = now
+            # One assignment so a reader never sees a sample with the wrong time
+            self.newest = (sample, now)
+            self.samples += 1
+            journal = self.journal
+            if journal is not None: journal.field(now, sample)
+
+    # Newest sample if it is at most max_age seconds old, otherwise None
+    def latest(self, max_age=None):
+        newest = self.newest
+        if newest is None: return None
+        sample, sample_time = newest
+        if max_age is not None and self.clock() - sample_time > max_age: return None
+        return sample
+
+    def report(self):
+        percentile = StepTimingStats.percentile
+        newest = self.newest
+        span = newest[1] - self.first_time if newest is not None and self.first_time is not None else 0.0
+        rate = (self.samples - 1)/span if span > 0 else 0.0
+        return ('magnetometer %.0f Hz, interval p99 %.2f ms, %d bad lines'
+            % (rate, percentile(self.intervals, 99)*1e3, self.bad_lines))
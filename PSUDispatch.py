@@ -0,0 +1,110 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              PSU Dispatch (PSUDispatch.py)
+#   Description:            Sends the x, y and z commands to the three Keithley 2260B PSUs at the same time instead of
+#                           one after the other, and measures how far apart the axes changed.
+#   Inputs/Resources:       Three open VISA sessions (or anything with write/query/close)
+#   Output/Created files:   Inter-axis skew and dispatch latency statistics
+#
+#   Notes:                  Each PSU gets a thread of its own. A VISA session is never used from two threads at once,
+#                           so commands to the same PSU still go out in order.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from PlaybackEngine import StepTimingStats
+
+AXES = ('x', 'y', 'z')
+
+#=============================================================================#
+#                                PSU Dispatcher                               #
+#=============================================================================#
+
+class PSUDispatcher:
+
+    def __init__(self, instruments, clock=time.perf_counter):
+        self.instruments = list(instruments)
+        self.clock = clock
+        self.executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix='PSU' + AXES[i].upper())
+            for i in range(len(self.instruments))]
+        # Per dispatch: spread between the first and last axis finishing their write, and time until all three had
+        self.skew = array('d')
+        self.latency = array('d')
+        self.journal = None # RunJournal.RunJournal every write is recorded in
+        self.write_timers = None # Instrumentation.Histogram per axis for the write time, and one for the whole dispatch
+        self.dispatch_timer = None
+
+    # Times every write into histograms of an Instrumentation.MetricsRegistry
+    def instrument(self, registry):
+        self.write_timers = [registry.histogram('helmholtz_psu_write_seconds', 'Time to write one command to a PSU', axis=AXES[axis])
+            for axis in range(len(self.instruments))]
+        self.dispatch_timer = registry.histogram('helmholtz_dispatch_seconds', 'Time until every PSU of a step was written')
+
+    # Writes to one PSU and returns when the write started and finished
+    def timedWrite(self, axis, command):
+        start = self.clock()
+        self.instruments[axis].write(command)
+        end = self.clock()
+        journal = self.journal
+        if journal is not None: journal.command(axis, start, end, command)
+        timers = self.write_timers
+        if timers is not None: timers[axis].observe(end - start)
+        return start, end
+
+    # Sends one command per axis concurrently and waits for all of them. None skips an axis.
+    # Once every axis has finished, a failure is raised as Exception('No PSU Communication', failed axes, first error).
+    def write(self, commands):
+        start = self.clock()
+        futures = [(axis, self.executors[axis].submit(self.timedWrite, axis, command))
+            for axis, command in enumerate(commands) if command is not None]
+        if not futures: return
+        errors = [(axis, future.exception()) for axis, future in futures if future.exception() is not None]
+        if errors: raise Exception('No PSU Communication', [axis for axis, _error in errors], errors[0][1])
+        times = [future.result() for _axis, future in futures]
+        finished = [end for _start, end in times]
+        self.skew.append(max(finished) - min(finished))
+        self.latency.append(max(finished) - start)
+        if self.dispatch_timer is not None: self.dispatch_timer.observe(max(finished) - start)
+
+    # Sends the same command to all PSUs concurrently
+    def broadcast(self, command): self.write([command]*len(self.instruments))
+
+    # Runs function(*args) on one PSU's thread, after any writes already queued for it. Returns the future.
+    def submit(self, axis, function, *args): return self.executors[axis].submit(function, *args)
+
+    # Sends a query to all PSUs concurrently and returns the replies in axis order
+    def query(self, command):
+        futures = [self.executors[axis].submit(self.instruments[axis].query, command) for axis in range(len(self.instruments))]
+        return [future.result() for future in futures]
+
+    # Summary of the skew and latency in seconds
+    def summary(self):
+        percentile = StepTimingStats.percentile
+        return {
+            'dispatches': len(self.latency),
+            'skew_p50': percentile(self.skew, 50),
+            'skew_p99': percentile(self.skew, 99),
+            'skew_max': max(self.skew) if self.skew else 0.0,
+            'latency_p50': percentile(self.latency, 50),
+            'latency_p99': percentile(self.latency, 99),
+            'latency_max': max(self.latency) if self.latency else 0.0,
+        }
+
+    # Formats the summary in milliseconds for the status box
+    def report(self):
+        s = self.summary()
+        return ('PSU skew p50/p99/max %.2f/%.2f/%.2f ms, dispatch p50/p99/max %.2f/%.2f/%.2f ms'
+            % (s['skew_p50']*1e3, s['skew_p99']*1e3, s['skew_max']*1e3,
+            s['latency_p50']*1e3, s['latency_p99']*1e3, s['latency_max']*1e3))
+
+    # Forgets the statistics of earlier runs
+    def reset(self):
+        self.skew = array('d')
+        self.latency = array('d')
+
+    # Stops the PSU threads. The sessions themselves are left open for the caller to close.
+    def shutdown(self):
+        for executor in self.executors: executor.shutdown(wait=True)
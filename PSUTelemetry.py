@@ -0,0 +1,174 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              PSU Telemetry (PSUTelemetry.py)
+#   Description:            Reads back the current and voltage the three PSUs actually output, on its own schedule,
+#                           into a fixed size ring buffer next to the current that was commanded.
+#   Inputs/Resources:       A PSUDispatcher
+#   Output/Created files:   Measured current/voltage per axis, query latency and dropped sample statistics
+#
+#   Notes:                  The queries go through the dispatcher's per-PSU threads so a session is never used from
+#                           two threads. Only one query per PSU is ever outstanding: if the last one hasn't come back
+#                           when the next sample is due the axis is dropped for that sample instead of queueing up,
+#                           so a setpoint write waits behind at most one query.
+#                           Measured current is a magnitude (the relays set the sign), the error is measured - |commanded|.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import time
+import threading
+import numpy as np
+from array import array
+from PlaybackEngine import StepTimingStats
+
+# Both readings in one round trip, the reply is "<current>;<voltage>"
+TELEMETRY_QUERY = 'MEAS:CURR?;:MEAS:VOLT?'
+DEFAULT_RATE = 10.0     # samples per second
+DEFAULT_CAPACITY = 4096 # samples kept
+
+#=============================================================================#
+#                               Telemetry Buffer                              #
+#=============================================================================#
+
+# Preallocated ring buffer of samples. Axes that weren't read in a sample are NaN.
+class TelemetryBuffer:
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, axes=3):
+        self.capacity = capacity
+        self.time = np.zeros(capacity)
+        self.current = np.full((capacity, axes), np.nan)
+        self.voltage = np.full((capacity, axes), np.nan)
+        self.commanded = np.full((capacity, axes), np.nan)
+        self.count = 0 # Samples ever started, the newest is at (count - 1) % capacity
+        self.lock = threading.Lock()
+
+    # Starts a new sample and returns its slot
+    def begin(self, now, commanded):
+        with self.lock:
+            slot = self.count % self.capacity
+            self.time[slot] = now
+            self.current[slot] = np.nan
+            self.voltage[slot] = np.nan
+            self.commanded[slot] = commanded
+            self.count += 1
+            return self.count - 1
+
+    # Fills in one axis of a sample, unless the slot has been reused since
+    def store(self, sample, axis, current, voltage):
+        with self.lock:
+            if self.count - sample > self.capacity: return
+            slot = sample % self.capacity
+            self.current[slot, axis] = current
+            self.voltage[slot, axis] = voltage
+
+    def __len__(self): return min(self.count, self.capacity)
+
+    # Copies of the last n samples (all kept samples by default) in time order: time, current, voltage, commanded
+    def samples(self, n=None):
+        with self.lock:
+            kept = min(self.count, self.capacity)
+            n = kept if n is None else min(n, kept)
+            slots = np.arange(self.count - n, self.count) % self.capacity
+            return self.time[slots], self.current[slots], self.voltage[slots], self.commanded[slots]
+
+#=============================================================================#
+#                              Telemetry Sampler                              #
+#=============================================================================#
+
+class TelemetrySampler(threading.Thread):
+
+    # commanded() returns the current last sent to each axis, it is stored with every sample
+    def __init__(self, dispatcher, rate=DEFAULT_RATE, capacity=DEFAULT_CAPACITY, commanded=None, clock=time.perf_counter):
+        threading.Thread.__init__(self, name='PSUTelemetry', daemon=True)
+        self.dispatcher = dispatcher
+        self.period = 1.0/rate
+        self.commanded = commanded
+        self.clock = clock
+        self.axes = len(dispatcher.instruments)
+        self.buffer = TelemetryBuffer(capacity, self.axes)
+        self.outstanding = [None]*self.axes
+        self.stopped = threading.Event()
+        self.latency = array('d')
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.failed = 0
+        self.started = None
+        self.journal = None # RunJournal.RunJournal the readbacks are recorded in
+
+    def stop(self): self.stopped.set()
+
+    # Samples on absolute deadlines so query time doesn't stretch the sampling period
+    def run(self):
+        self.started = self.clock()
+        next_sample = self.started
+        while not self.stopped.is_set():
+            self.sample()
+            next_sample += self.period
+            now = self.clock()
+            if next_sample < now: next_sample = now # Don't try to make up missed samples
+            self.stopped.wait(next_sample - now)
+
+    # Sends the query to every PSU that has answered the last one
+    def sample(self):
+        now = self.clock()
+        commanded = self.commanded() if self.commanded is not None else np.nan
+        sample = self.buffer.begin(now, commanded)
+        for axis in range(self.axes):
+            if self.outstanding[axis] is not None and not self.outstanding[axis].done():
+                self.dropped += 1
+                continue
+            self.sent += 1
+            try: self.outstanding[axis] = self.dispatcher.submit(axis, self.query, axis, sample)
+            except RuntimeError: return # Dispatcher shut down
+
+    # Runs on the PSU's dispatcher thread
+    def query(self, axis, sample):
+        start = self.clock()
+        try: reply = self.dispatcher.instruments[axis].query(TELEMETRY_QUERY)
+        except Exception:
+            self.failed += 1
+            return
+        self.latency.append(self.clock() - start)
+        try: current, voltage = [float(value) for value in reply.split(';')[0:2]]
+        except ValueError:
+            self.failed += 1
+            return
+        self.buffer.store(sample, axis, current, voltage)
+        self.received += 1
+        journal = self.journal
+        if journal is not None: journal.readback(axis, start, self.clock(), current, voltage)
+
+    # Newest sample that has every axis filled in: time, current, voltage, commanded
+    def latest(self):
+        time_, current, voltage, commanded = self.buffer.samples(4)
+        complete = np.flatnonzero(~np.isnan(current).any(axis=1))
+        if not len(complete): return None
+        last = complete[-1]
+        return time_[last], current[last], voltage[last], commanded[last]
+
+    # Measured minus commanded current magnitude per axis in the newest complete sample
+    def error(self):
+        latest = self.latest()
+        if latest is None: return np.full(self.axes, np.nan)
+        return latest[1] - np.abs(latest[3])
+
+    def summary(self):
+        percentile = StepTimingStats.percentile
+        elapsed = (self.clock() - self.started) if self.started is not None else 0.0
+        return {
+            'rate': self.received/self.axes/elapsed if elapsed > 0 else 0.0,
+            'queries': self.sent,
+            'replies': self.received,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'latency_p50': percentile(self.latency, 50),
+            'latency_p99': percentile(self.latency, 99),
+            # Share of each PSU's time spent answering telemetry
+            'bus_share': sum(self.latency)/self.axes/elapsed if elapsed > 0 else 0.0,
+        }
+
+    def report(self):
+        s = self.summary()
+        return ('telemetry %.1f Hz, query p50/p99 %.2f/%.2f ms, %d dropped, %d failed, %.1f%% of bus'
+            % (s['rate'], s['latency_p50']*1e3, s['latency_p99']*1e3, s['dropped'], s['failed'], 100*s['bus_share']))
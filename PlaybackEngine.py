@@ -0,0 +1,288 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Playback Engine (PlaybackEngine.py)
+#   Description:            Paces the simulation steps against absolute deadlines on a monotonic clock
+#                           so that I/O time and sleep rounding never accumulate over a long profile.
+#                           The playback worker runs the steps on its own thread so the GUI never blocks.
+#   Inputs/Resources:       A step period (seconds) and a function that plays a single step
+#   Output/Created files:   Per-step lateness and jitter statistics
+#
+#   Notes:                  Step k is always due at t0 + k*period. The clock is never re-read to build
+#                           the next deadline, so a multi-hour profile stays locked to the STK timeline.
+#                           Pause and stop are events that cut the current wait short, they are never polled.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import time
+import threading
+from array import array
+
+# What to do when a step finishes after the next step was already due
+#   skip     - drop the steps that are already late and carry on with the one that is due now
+#   compress - play the late steps back to back without waiting until the timeline is caught up
+#   hold     - play every step, shifting the rest of the timeline back by the overrun
+CATCHUP_POLICIES = ('skip', 'compress', 'hold')
+
+# Time before a deadline at which sleeping stops and the scheduler spins on the clock instead.
+# OS sleeps routinely overshoot by a millisecond or more, which would show up directly as lateness.
+SPIN_WINDOW = 0.002
+
+#=============================================================================#
+#                              Timing Statistics                              #
+#=============================================================================#
+
+class StepTimingStats:
+
+    # Lateness is how far after its deadline a step actually started, jitter is how far the
+    # time between two consecutive step starts strayed from the period
+    def __init__(self, period):
+        self.period = period
+        self.lateness = array('d')
+        self.jitter = array('d')
+        self.skipped = 0
+        self.overruns = 0
+        self.last_start = None
+        self.last_index = None
+
+    # Records the start of a step that was due at the given deadline
+    def record(self, index, deadline, start):
+        self.lateness.append(start - deadline)
+        if self.last_start is not None:
+            self.jitter.append(abs((start - self.last_start) - (index - self.last_index)*self.period))
+        self.last_start = start
+        self.last_index = index
+
+    # Forgets the previous start so that a pause isn't counted as jitter
+    def reanchor(self): self.last_start = None
+
+    # Returns the value at a given percentile (0-100) of an array of samples
+    @staticmethod
+    def percentile(samples, pct):
+        if not samples: return 0.0
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, max(0, int(round(pct/100*(len(ordered) - 1)))))
+        return ordered[index]
+
+    # Returns a summary of the run in seconds
+    def summary(self):
+        return {
+            'steps': len(self.lateness),
+            'skipped': self.skipped,
+            'overruns': self.overruns,
+            'lateness_p50': self.percentile(self.lateness, 50),
+            'lateness_p99': self.percentile(self.lateness, 99),
+            'lateness_max': max(self.lateness) if self.lateness else 0.0,
+            'jitter_p50': self.percentile(self.jitter, 50),
+            'jitter_p99': self.percentile(self.jitter, 99),
+            'jitter_max': max(self.jitter) if self.jitter else 0.0,
+        }
+
+    # Formats the summary in milliseconds for the status box
+    def report(self):
+        s = self.summary()
+        return ('lateness p50/p99/max %.2f/%.2f/%.2f ms, jitter p50/p99/max %.2f/%.2f/%.2f ms, %d skipped'
+            % (s['lateness_p50']*1e3, s['lateness_p99']*1e3, s['lateness_max']*1e3,
+            s['jitter_p50']*1e3, s['jitter_p99']*1e3, s['jitter_max']*1e3, s['skipped']))
+
+#=============================================================================#
+#                              Deadline Scheduler                             #
+#=============================================================================#
+
+class DeadlineScheduler:
+
+    def __init__(self, period, policy='skip', clock=time.perf_counter):
+        if period <= 0: raise ValueError('Step period must be positive')
+        if policy not in CATCHUP_POLICIES: raise ValueError('Unknown catch-up policy: ' + str(policy))
+        self.period = period
+        self.policy = policy
+        self.clock = clock
+        self.t0 = None
+        self.stats = StepTimingStats(period)
+
+    # Anchors the timeline so that the given step is due right now. Also used after a pause.
+    def start(self, index=0):
+        self.t0 = self.clock() - index*self.period
+        self.stats.reanchor()
+
+    # Absolute time at which a given step is due
+    def deadline(self, index): return self.t0 + index*self.period
+
+    # Marks the start of a step and records how late it was
+    def begin(self, index):
+        self.stats.record(index, self.deadline(index), self.clock())
+
+    # Picks the next step to play after the given one finished, applying the catch-up policy
+    def advance(self, index):
+        next_index = index + 1
+        now = self.clock()
+        if now <= self.deadline(next_index): return next_index
+        # The next step is already late, so the last step overran its slot
+        self.stats.overruns += 1
+        if self.policy == 'skip':
+            due = max(next_index, int((now - self.t0)/self.period))
+            self.stats.skipped += due - next_index
+            return due
+        elif self.policy == 'hold':
+            self.t0 = now - next_index*self.period
+        return next_index
+
+    # Sleeps until the deadline, spinning for the last moments to avoid OS sleep overshoot.
+    # Returns False as soon as the interrupt event is set, without waiting for the deadline.
+    def waitUntil(self, deadline, interrupt=None):
+        if interrupt is None: interrupt = threading.Event()
+        while True:
+            if interrupt.is_set(): return False
+            remaining = deadline - self.clock()
+            if remaining <= 0: return True
+            if remaining > SPIN_WINDOW: interrupt.wait(remaining - SPIN_WINDOW)
+
+#=============================================================================#
+#                               Playback Worker                               #
+#=============================================================================#
+
+class PlaybackWorker(threading.Thread):
+
+    # play_step(index) sends a step to the instruments and clear() turns the coils off. Both are called
+    # from the worker thread, so neither may touch Qt widgets; on_step and on_state are for that.
+    # If a source that is still loading is given (see CageProfile.waitFor), num_steps is only an estimate
+    # and the run ends when the source runs out of steps.
+    # play_step may return the index of the next step to wait for when it handed several steps to the
+    # instruments at once (hardware timed lists); the steps in between are then taken as played on time.
+    # start is the first step played. With hold set a run that completes leaves the coils on its last step,
+    # so another run can follow it without a gap; stop, pause and errors still clear them.
+    def __init__(self, num_steps, period, play_step, clear, policy='skip', on_step=None, on_state=None, lead_in=0.0, source=None,
+            start=0, hold=False):
+        threading.Thread.__init__(self, name='PlaybackWorker', daemon=True)
+        self.scheduler = DeadlineScheduler(period, policy)
+        self.clock = self.scheduler.clock
+        self.num_steps = num_steps
+        self.play_step = play_step
+        self.clear = clear
+        self.on_step = on_step
+        self.on_state = on_state
+        self.lead_in = lead_in
+        self.source = source
+        self.hold = hold
+
+        self.index = start  # Next step to be played
+        self.last_played = -1 # Step play_step was last called with
+        self.offset = 0.0   # Time already spent on the previous step when the run was paused
+        self.state = 'idle'
+        self.error = None
+
+        self.lock = threading.Lock()
+        self.interrupt = threading.Event()
+        self.resumed = threading.Event()
+        self.pause_requested = False
+        self.stop_requested = False
+        self.request_time = None
+        self.clear_latency = array('d') # Seconds from a pause/stop request until the coils were cleared
+
+    # Requests a pause. The coils are cleared as soon as the current step's writes are done.
+    def pause(self):
+        with self.lock:
+            if self.state != 'running' or self.pause_requested: return
+            self.pause_requested = True
+            self.request_time = self.clock()
+            self.resumed.clear()
+            self.interrupt.set()
+
+    # Continues a paused run from the step and time offset it was paused at
+    def resume(self):
+        with self.lock:
+            self.pause_requested = False
+            self.resumed.set()
+
+    # Requests a stop. Also wakes a paused run so it can shut down.
+    def stop(self):
+        with self.lock:
+            if self.stop_requested: return
+            self.stop_requested = True
+            if not self.pause_requested: self.request_time = self.clock()
+            self.interrupt.set()
+            self.resumed.set()
+
+    # Returns the next step to be played and how far into the previous step the run was paused
+    def position(self): return self.index, self.offset
+
+    # Most recent pause/stop to cleared latency in seconds
+    def lastClearLatency(self): return self.clear_latency[-1] if self.clear_latency else 0.0
+
+    def setState(self, state):
+        self.state = state
+        if self.on_state is not None: self.on_state(state)
+
+    # Clears the coils and records how long it took since the pause or stop was requested
+    def clearOutputs(self):
+        self.clear()
+        if self.request_time is not None:
+            self.clear_latency.append(self.clock() - self.request_time)
+            self.request_time = None
+
+    def run(self):
+        scheduler = self.scheduler
+        try:
+            self.setState('running')
+            if self.lead_in > 0 and not scheduler.waitUntil(self.clock() + self.lead_in, self.interrupt): self.handleInterrupt()
+            scheduler.start(self.index)
+            while self.hasStep(self.index) and not self.stop_requested:
+                if not scheduler.waitUntil(scheduler.deadline(self.index), self.interrupt):
+                    self.handleInterrupt()
+                    continue
+                scheduler.begin(self.index)
+                next_index = self.play_step(self.index)
+                self.last_played = self.index
+                if self.on_step is not None: self.on_step(self.index)
+                self.index = scheduler.advance(self.index if next_index is None else next_index - 1)
+            # Hold the final step for its full period like every other step
+            if not self.stop_requested and not scheduler.waitUntil(scheduler.deadline(self.num_steps), self.interrupt):
+                self.handleInterrupt()
+            if self.stop_requested or not self.hold: self.clearOutputs()
+            self.setState('stopped' if self.stop_requested else 'complete')
+        except Exception as e:
+            self.error = e
+            try: self.clear()
+            except Exception: pass
+            self.setState('error')
+
+    # Whether a step exists, waiting for it if the source is still being loaded
+    def hasStep(self, index):
+        if self.source is None: return index < self.num_steps
+        while not self.source.waitFor(index, 0.05):
+            # A source that failed to load, e.g. on a chunk breaking a safety limit, ends the run in an error
+            if self.source.error is not None: raise self.source.error
+            if self.source.complete or self.stop_requested:
+                self.num_steps = len(self.source)
+                return False
+        if self.source.complete: self.num_steps = len(self.source)
+        return True
+
+    # Handles a wait that was cut short by pause or stop
+    def handleInterrupt(self):
+        scheduler = self.scheduler
+        self.interrupt.clear()
+        if self.stop_requested or not self.pause_requested: return
+        if self.index > 0:
+            # If the instruments were playing several steps on their own, work out which one they had reached
+            now = self.clock()
+            if self.index - 1 > self.last_played >= 0:
+                self.index = min(self.index, self.last_played + 1 + max(0, int((now - scheduler.deadline(self.last_played))/scheduler.period)))
+            self.offset = min(scheduler.period, max(0.0, now - scheduler.deadline(self.index - 1)))
+        self.clearOutputs()
+        self.setState('paused')
+        while self.pause_requested and not self.stop_requested: self.resumed.wait()
+        self.interrupt.clear()
+        if self.stop_requested: return
+        # Put the coils back on the step they were on and let it finish the rest of its period
+        if self.index > 0:
+            replayed = self.index - 1
+            next_index = self.play_step(replayed)
+            # A list window plays the step from its start and the ones after it on its own, carry on after the window
+            if next_index is not None and next_index > self.index:
+                self.offset = 0.0
+                self.index = next_index
+            scheduler.t0 = self.clock() - self.offset - replayed*scheduler.period
+            scheduler.stats.reanchor()
+        else: scheduler.start(0)
+        self.setState('running')
@@ -0,0 +1,274 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Profile Cache (ProfileCache.py)
+#   Description:            On-disk cache of compiled profiles. A compiled profile is a small header followed by the
+#                           raw field, current and polarity columns, so it can be memory-mapped instead of re-parsed.
+#   Inputs/Resources:       A CageProfile and the .csv file it came from
+#   Output/Created files:   <cache dir>/<source hash>-<settings hash>.hhcp files and an index.json
+#
+#   Notes:                  Entries are keyed by a SHA-256 of the .csv contents plus the unit, offsets, voltage and
+#                           coil constants or calibration. The least recently used entries are deleted once the cache grows
+#                           past its size limit.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import os
+import glob
+import json
+import hashlib
+import threading
+import numpy as np
+from CageProfile import CageProfile, COIL_CONSTANTS, DEFAULT_VOLTAGE
+
+MAGIC = b'HHCPROF1'
+FORMAT_VERSION = 2 # 2: T and G files are stored converted to nT, and the calibration is recorded
+# Columns start on this boundary so they can be mapped directly
+ALIGNMENT = 64
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.HelmholtzCage', 'profiles')
+DEFAULT_MAX_BYTES = 2*1024**3
+
+EXTENSION = '.hhcp'
+
+#=============================================================================#
+#                            Compiled Profile Format                          #
+#=============================================================================#
+
+# Writes a profile as  MAGIC | uint32 header length | JSON header | padding | columns.
+# The header lists each column's dtype, shape and byte offset. Uncompiled profiles only store the field column.
+def writeCompiledProfile(filename, profile, meta=None):
+    columns = [('bfield', profile.bfield)]
+    if profile.currents is not None: columns += [('currents', profile.currents), ('polarity', profile.polarity)]
+    header = {'version': FORMAT_VERSION, 'rows': len(profile), 'voltage': profile.voltage, 'meta': meta or {}, 'columns': {}}
+    if profile.settings is not None:
+        header['offsets'] = profile.settings[0].tolist()
+        header['coil_constants'] = profile.settings[1].tolist()
+    if profile.calibration is not None: header['calibration'] = profile.calibration.toDict()
+    encoded, end = layoutColumns(header, [(name, array.dtype, array.shape) for name, array in columns])
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as file:
+        writePreamble(file, encoded)
+        for name, array in columns:
+            file.seek(header['columns'][name]['offset'])
+            file.write(np.ascontiguousarray(array).tobytes())
+        file.truncate(end)
+    # Readers never see a half written file
+    os.replace(temporary, filename)
+
+# Fills in each column's dtype, shape and offset. columns are (name, dtype, shape).
+# Returns the encoded header and where the last column ends.
+def layoutColumns(header, columns):
+    # The offsets depend on the header length, so lay it out until it stops growing
+    offset = 0
+    while True:
+        start = offset
+        for name, dtype, shape in columns:
+            header['columns'][name] = {'dtype': np.dtype(dtype).str, 'shape': list(shape), 'offset': start}
+            start += -(-int(np.prod(shape))*np.dtype(dtype).itemsize//ALIGNMENT)*ALIGNMENT
+        encoded = json.dumps(header).encode('UTF-8')
+        data_start = -(-(len(MAGIC) + 4 + len(encoded))//ALIGNMENT)*ALIGNMENT
+        if data_start == offset: return encoded, start
+        offset = data_start
+
+def writePreamble(file, encoded):
+    file.seek(0)
+    file.write(MAGIC)
+    file.write(len(encoded).to_bytes(4, 'little'))
+    file.write(encoded)
+
+# Writes a compiled profile chunk by chunk, for profiles that are generated rather than read (STKExport.py).
+# The columns are laid out for up to rows samples; close() records how many were written.
+class CompiledProfileWriter:
+
+    def __init__(self, filename, rows, offsets=(0, 0, 0), voltage=DEFAULT_VOLTAGE, coil_constants=COIL_CONSTANTS, meta=None, calibration=None):
+        self.filename = filename
+        self.rows = 0
+        self.capacity = rows
+        self.settings = (np.asarray(offsets, dtype=np.float64), np.asarray(coil_constants, dtype=np.float64))
+        self.voltage = voltage
+        self.calibration = calibration
+        self.header = {'version': FORMAT_VERSION, 'rows': rows, 'voltage': voltage, 'meta': meta or {}, 'columns': {},
+            'offsets': self.settings[0].tolist(), 'coil_constants': self.settings[1].tolist()}
+        if calibration is not None: self.header['calibration'] = calibration.toDict()
+        self.columns = [('bfield', np.float64, (rows, 3)), ('currents', np.float64, (rows, 3)), ('polarity', np.uint8, (rows,))]
+        encoded, self.end = layoutColumns(self.header, self.columns)
+        self.header_bytes = len(encoded)
+        self.file = open(filename + '.tmp', 'wb')
+        writePreamble(self.file, encoded)
+
+    # Compiles a chunk of (n, 3) samples in nT and writes all three columns of it
+    def write(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64).reshape(-1, 3)[:self.capacity - self.rows]
+        if not len(chunk): return
+        compiled = CageProfile(chunk).compile(self.settings[0], self.voltage, self.settings[1], self.calibration)
+        for name, array in (('bfield', compiled.bfield), ('currents', compiled.currents), ('polarity', compiled.polarity)):
+            self.file.seek(self.header['columns'][name]['offset'] + self.rows*array[0:1].nbytes)
+            self.file.write(np.ascontiguousarray(array).tobytes())
+        self.rows += len(chunk)
+
+    # Records the rows written in the header and puts the file in place. Returns the file name.
+    def close(self):
+        self.header['rows'] = self.rows
+        for name, _dtype, shape in self.columns: self.header['columns'][name]['shape'] = [self.rows] + list(shape[1:])
+        # Fewer rows never makes the header longer, the space it frees is padding
+        encoded = json.dumps(self.header).encode('UTF-8')
+        writePreamble(self.file, encoded.ljust(self.header_bytes))
+        self.file.truncate(self.end)
+        self.file.close()
+        os.replace(self.filename + '.tmp', self.filename)
+        return self.filename
+
+    # Deletes the partly written file
+    def abort(self):
+        self.file.close()
+        try: os.remove(self.filename + '.tmp')
+        except OSError: pass
+
+# Reads just the header of a compiled profile
+def readHeader(filename):
+    with open(filename, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC: raise Exception('Not a compiled profile')
+        length = int.from_bytes(file.read(4), 'little')
+        header = json.loads(file.read(length).decode('UTF-8'))
+    if header['version'] != FORMAT_VERSION: raise Exception('Unsupported compiled profile version')
+    return header
+
+# Maps a compiled profile without reading its columns into memory
+def readCompiledProfile(filename):
+    header = readHeader(filename)
+    columns = {}
+    for name, column in header['columns'].items():
+        shape = tuple(column['shape'])
+        if not shape[0]: columns[name] = np.empty(shape, dtype=column['dtype'])
+        else: columns[name] = np.memmap(filename, dtype=column['dtype'], mode='r', offset=column['offset'], shape=shape)
+    calibration = None
+    if 'calibration' in header:
+        from Calibration import Calibration
+        calibration = Calibration.fromDict(header['calibration'])
+    profile = CageProfile.fromArrays(columns['bfield'], columns.get('currents'), columns.get('polarity'),
+        header.get('offsets', (0, 0, 0)), header['voltage'], header.get('coil_constants', COIL_CONSTANTS), calibration)
+    profile.meta = header['meta']
+    return profile
+
+#=============================================================================#
+#                                Profile Cache                                #
+#=============================================================================#
+
+class ProfileCache:
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, 'index.json')
+        try:
+            with open(self.index_path, 'r') as file: self.index = json.load(file)
+        except (OSError, ValueError): self.index = {}
+
+    # Content hash of a file if it was already hashed and hasn't changed since, without reading it
+    def knownHash(self, path):
+        path = os.path.abspath(path)
+        try: stat = os.stat(path)
+        except OSError: return None
+        entry = self.index.get(path)
+        if entry is not None and entry[0:2] == [stat.st_size, stat.st_mtime_ns]: return entry[2]
+        return None
+
+    # Content hash of a .csv file. Files that haven't changed size or modification time since they were
+    # last hashed are looked up in the index so reselecting a file doesn't have to read it again.
+    def sourceHash(self, path):
+        known = self.knownHash(path)
+        if known is not None: return known
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1024*1024), b''): digest.update(block)
+        with self.lock:
+            self.index[path] = stamp + [digest.hexdigest()]
+            self.saveIndex()
+        return digest.hexdigest()
+
+    def saveIndex(self):
+        temporary = self.index_path + '.tmp'
+        with open(temporary, 'w') as file: json.dump(self.index, file)
+        os.replace(temporary, self.index_path)
+
+    # Hash of everything besides the samples that the compiled currents depend on
+    @staticmethod
+    def settingsHash(unit, offsets, voltage=DEFAULT_VOLTAGE, coil_constants=COIL_CONSTANTS, calibration=None):
+        settings = [unit, [float(value) for value in offsets], float(voltage), [float(value) for value in coil_constants]]
+        if calibration is not None: settings.append(calibration.key())
+        settings = json.dumps(settings)
+        return hashlib.sha256(settings.encode('UTF-8')).hexdigest()
+
+    def filename(self, source_hash, settings_hash='samples'):
+        return os.path.join(self.directory, source_hash[:32] + '-' + settings_hash[:32] + EXTENSION)
+
+    # Maps a cached entry, marking it as recently used
+    def open(self, filename):
+        try:
+            profile = readCompiledProfile(filename)
+            os.utime(filename)
+            return profile
+        except Exception: return None
+
+    # Returns the field samples of a file that was compiled before with any settings, or None.
+    # Only files that were hashed before are looked up, so a miss never has to read the file.
+    def loadSamples(self, path):
+        source_hash = self.knownHash(path)
+        if source_hash is None: return None
+        for filename in glob.glob(os.path.join(self.directory, source_hash[:32] + '-*' + EXTENSION)):
+            profile = self.open(filename)
+            if profile is not None: return CageProfile.fromArrays(profile.bfield)
+        return None
+
+    # Returns the compiled profile for a file and its settings, or None
+    def load(self, path, unit, offsets, voltage=DEFAULT_VOLTAGE, coil_constants=COIL_CONSTANTS, calibration=None):
+        filename = self.filename(self.sourceHash(path), self.settingsHash(unit, offsets, voltage, coil_constants, calibration))
+        return self.open(filename) if os.path.exists(filename) else None
+
+    # Stores a compiled profile and returns its cache file name, or None for a profile that didn't load in full
+    def store(self, profile, path, unit):
+        # A load that stopped at a bad row, or found no rows, would come back from the cache as a good profile
+        if profile.error is not None or not profile.complete or not len(profile): return None
+        offsets, coil_constants = profile.settings
+        source_hash = self.sourceHash(path)
+        filename = self.filename(source_hash, self.settingsHash(unit, offsets, profile.voltage, coil_constants, profile.calibration))
+        writeCompiledProfile(filename, profile, {'source': os.path.abspath(path), 'sha256': source_hash, 'unit': unit})
+        self.evict()
+        return filename
+
+    # Returns the cached profile for these settings if there is one, otherwise compiles the profile and caches it.
+    # A profile that is still loading is compiled without looking: a cached entry can't match its length, and hashing
+    # the file here would read all of it on the caller's thread. The loader hashes it and profileLoaded stores it.
+    def compile(self, profile, path, unit, offsets, voltage=DEFAULT_VOLTAGE, coil_constants=COIL_CONSTANTS, calibration=None):
+        if not profile.complete:
+            profile.compile(offsets, voltage, coil_constants, calibration)
+            return profile
+        cached = self.load(path, unit, offsets, voltage, coil_constants, calibration)
+        if cached is not None and len(cached) == len(profile): return cached
+        profile.compile(offsets, voltage, coil_constants, calibration)
+        self.store(profile, path, unit)
+        return profile
+
+    # Deletes the least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        with self.lock:
+            entries = []
+            for filename in glob.glob(os.path.join(self.directory, '*' + EXTENSION)):
+                try:
+                    stat = os.stat(filename)
+                    entries.append((stat.st_mtime, stat.st_size, filename))
+                except OSError: pass
+            total = sum(entry[1] for entry in entries)
+            for _mtime, size, filename in sorted(entries):
+                if total <= self.max_bytes: break
+                try:
+                    os.remove(filename)
+                    total -= size
+                except OSError: pass
+            return total
@@ -0,0 +1,241 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Profile Ingest (ProfileIngest.py)
+#   Description:            Streams a B-field .csv file into typed arrays in large chunks. Each chunk is validated
+#                           and parsed in one vectorized pass instead of calling float() on every cell.
+#   Inputs/Resources:       A .csv file with a "x (nT), y (nT), z (nT)" style header
+#   Output/Created files:   (n, 3) float64 arrays of field samples, or a CageProfile filled in the background
+#
+#   Notes:                  The header is read once when the reader is created (Browse) and the data is
+#                           streamed from just after it (Extract), so the file is never parsed twice.
+#                           Files in T or G are converted to nT as they are read.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import os
+import csv
+import threading
+import numpy as np
+from CageProfile import CageProfile
+from ProfileCache import readCompiledProfile, EXTENSION as COMPILED_EXTENSION
+
+# Size of the blocks read from disk. Each one is parsed into an array in a single call.
+CHUNK_BYTES = 8*1024*1024
+
+# nT in one of each unit a file can be in, the samples are converted to nT as they are read
+UNIT_SCALE = {'nT': 1.0, 'T': 1e9, 'G': 1e5}
+SUPPORTED_UNITS = tuple(UNIT_SCALE)
+
+COMMA = ord(',')
+NEWLINE = ord('\n')
+
+# Characters that can't be next to a comma without leaving an empty field
+EMPTY_FIELD = np.frombuffer(b',\n\r', dtype=np.uint8)
+
+# Maps the field separators to whitespace so the whole block can go through numpy's text parser
+SEPARATORS = bytes.maketrans(b',\r', b'  ')
+
+#=============================================================================#
+#                                Header Parsing                               #
+#=============================================================================#
+
+# Checks the headers and returns the axis names, the unit and the number of columns.
+# Raises the same exceptions Browse reports to the user.
+def parseHeader(line):
+    header = line.rstrip('\r\n').split(',')
+    axis = ['','','']
+    unit = ['','','']
+    if len(header) < 3: raise Exception('Incorrect Header or Data Order')
+    for i in range(0,3):
+        trans = str.maketrans('','','-=+,.~`*&^%$#@!{}[]()')
+        string = header[i].translate(trans)
+        string = string.replace('_', ' ')
+        string = string.replace('  ', ' ')
+        array = string.split()
+        if len(array) != 2: raise Exception('Incorrect Header or Data Order')
+        unit[i] = array[1]
+        axis[i] = array[0]
+    if unit[0] != unit[1] or unit[0] != unit[2] or unit[0] not in SUPPORTED_UNITS: raise Exception('Incorrect Units')
+    return axis, unit[0], len(header)
+
+#=============================================================================#
+#                                Chunk Parsing                                #
+#=============================================================================#
+
+# Parses a block of complete lines into an (n, columns) array. Every non-blank line must have
+# exactly the given number of fields and none of them may be empty, otherwise 'Unbalanced Data' is raised.
+# A field that isn't a finite number raises 'Invalid Data'.
+def parseChunk(block, columns):
+    # Quoted fields or spaces around a comma don't fit the fast path, csv.reader decides those chunks and their errors
+    try: values = parseNumbers(block, columns)
+    except Exception: values = parseRows(block, columns)
+    if not np.isfinite(values).all(): raise Exception('Invalid Data')
+    return values
+
+# The fast path of parseChunk for plain unquoted numbers
+def parseNumbers(block, columns):
+    buf = np.frombuffer(block, dtype=np.uint8)
+    if not len(buf): return np.empty((0, columns))
+    # Everything is checked from the comma and newline positions so no full size temporaries are needed
+    commas = np.flatnonzero(buf == COMMA)
+    ends = np.flatnonzero(buf == NEWLINE)
+    if not len(ends) or ends[-1] != len(buf) - 1: ends = np.append(ends, len(buf))
+    # Empty fields: a comma at the start or end of a line, or two commas in a row
+    if len(commas):
+        if commas[0] == 0 or commas[-1] == len(buf) - 1: raise Exception('Unbalanced Data')
+        if np.any(np.isin(buf[commas - 1], EMPTY_FIELD)) or np.any(np.isin(buf[commas + 1], EMPTY_FIELD)):
+            raise Exception('Unbalanced Data')
+    # Commas per line. Lines without any are only allowed if they are blank.
+    per_line = np.bincount(np.searchsorted(ends, commas), minlength=len(ends))
+    bare = np.flatnonzero(per_line == 0)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    blank = np.array([not block[starts[i]:ends[i]].strip() for i in bare], dtype=bool)
+    if not np.all(blank) or np.any(per_line[per_line != 0] != columns - 1): raise Exception('Unbalanced Data')
+    rows = len(ends) - len(bare)
+    try: values = np.fromstring(block.translate(SEPARATORS).decode('ascii'), dtype=np.float64, sep=' ')
+    except ValueError: raise Exception('Invalid Data')
+    if len(values) != rows*columns: raise Exception('Invalid Data')
+    return values.reshape(rows, columns)
+
+# The slow path of parseChunk, one row at a time through csv.reader like Extract used to
+def parseRows(block, columns):
+    values = []
+    for row in csv.reader(block.decode('UTF-8').splitlines()):
+        if not ''.join(row).strip(): continue
+        if len(row) != columns or any(not field.strip() for field in row): raise Exception('Unbalanced Data')
+        try: values.append([float(field) for field in row])
+        except ValueError: raise Exception('Invalid Data')
+    return np.array(values, dtype=np.float64).reshape(len(values), columns)
+
+#=============================================================================#
+#                                Profile Reader                               #
+#=============================================================================#
+
+class ProfileReader:
+
+    compiled = False
+
+    # Opens the file only long enough to read and check the header
+    def __init__(self, path):
+        self.path = path
+        _basefilename, ext = os.path.splitext(os.path.basename(path))
+        if '.csv' != ext: raise Exception('Incorrect File Type')
+        with open(path, 'rb') as file:
+            header = file.readline()
+            self.data_offset = file.tell()
+        self.axis, self.unit, self.columns = parseHeader(header.decode('UTF-8-sig'))
+        self.scale = UNIT_SCALE[self.unit]
+        self.total_bytes = os.path.getsize(path)
+
+    # Yields (n, 3) arrays of x, y, z samples. progress(bytes_read, total_bytes) is called after every chunk.
+    def chunks(self, chunk_bytes=CHUNK_BYTES, progress=None):
+        with open(self.path, 'rb') as file:
+            file.seek(self.data_offset)
+            carry = b''
+            read = self.data_offset
+            while True:
+                block = file.read(chunk_bytes)
+                read += len(block)
+                if not block:
+                    # The last line may not end with a newline
+                    if carry.strip(): yield self.toNanotesla(parseChunk(carry, self.columns)[:, 0:3])
+                    break
+                block = carry + block
+                cut = block.rfind(b'\n') + 1
+                carry = block[cut:]
+                if cut: yield self.toNanotesla(parseChunk(block[:cut], self.columns)[:, 0:3])
+                if progress is not None: progress(read, self.total_bytes)
+
+    def toNanotesla(self, samples):
+        if self.scale != 1.0: samples *= self.scale
+        return samples
+
+    # Reads the whole file into a CageProfile
+    def read(self, chunk_bytes=CHUNK_BYTES):
+        profile = CageProfile(complete=False)
+        for chunk in self.chunks(chunk_bytes): profile.append(chunk)
+        profile.finish()
+        return profile
+
+    # Rough number of rows, from the size of the file and the length of the first lines
+    def estimateRows(self):
+        with open(self.path, 'rb') as file:
+            file.seek(self.data_offset)
+            sample = file.read(64*1024)
+        lines = sample.count(b'\n')
+        if not lines: return 1
+        return int((self.total_bytes - self.data_offset)*lines/len(sample))
+
+# Reads the field samples of a compiled profile (.hhcp), e.g. one written straight from STK by STKExport.py.
+# The columns are mapped, so chunks are slices of the file rather than parsed text.
+class CompiledProfileReader:
+
+    compiled = True
+
+    def __init__(self, path):
+        self.path = path
+        try: self.profile = readCompiledProfile(path)
+        except Exception: raise Exception('Incorrect File Type')
+        self.axis = ['x', 'y', 'z']
+        self.unit = 'nT'
+        self.data_offset = 0
+        self.total_bytes = len(self.profile)*self.profile.bfield.itemsize*3
+
+    def chunks(self, chunk_bytes=CHUNK_BYTES, progress=None):
+        bfield = self.profile.bfield
+        rows = max(1, chunk_bytes//(bfield.itemsize*3))
+        for start in range(0, len(bfield), rows):
+            yield np.array(bfield[start:start + rows])
+            if progress is not None: progress(min(start + rows, len(bfield))*bfield.itemsize*3, self.total_bytes)
+
+    # The samples without the compiled columns, the offsets and voltage are applied again by compile()
+    def read(self, chunk_bytes=CHUNK_BYTES): return CageProfile.fromArrays(self.profile.bfield)
+
+    def estimateRows(self): return len(self.profile)
+
+# Reader for a .csv or compiled profile file
+def openReader(path):
+    if os.path.splitext(path)[1] == COMPILED_EXTENSION: return CompiledProfileReader(path)
+    return ProfileReader(path)
+
+#=============================================================================#
+#                              Background Loader                              #
+#=============================================================================#
+
+class ProfileLoader(threading.Thread):
+
+    # Fills a CageProfile from the reader on a background thread so playback can start on the first chunk.
+    # on_chunk(rows_loaded, bytes_read, total_bytes) and on_done(error) are called from the loader thread.
+    # If a ProfileCache is given the file is also hashed on this thread so the profile can be cached later.
+    # transform(chunks) can wrap the chunk stream, e.g. a Resample.Resampler.
+    def __init__(self, reader, on_chunk=None, on_done=None, chunk_bytes=CHUNK_BYTES, cache=None, transform=None):
+        threading.Thread.__init__(self, name='ProfileLoader', daemon=True)
+        self.reader = reader
+        self.on_chunk = on_chunk
+        self.on_done = on_done
+        self.chunk_bytes = chunk_bytes
+        self.cache = cache
+        self.transform = transform
+        self.profile = CageProfile(complete=False)
+        self.profile.reserve(int(reader.estimateRows()*getattr(transform, 'scale', 1)))
+        self.bytes_read = 0
+        self.cancelled = False
+
+    def progress(self, read, total): self.bytes_read = read
+
+    def cancel(self): self.cancelled = True
+
+    def run(self):
+        error = None
+        try:
+            chunks = self.reader.chunks(self.chunk_bytes, self.progress)
+            if self.transform is not None: chunks = self.transform(chunks)
+            for chunk in chunks:
+                if self.cancelled: break
+                self.profile.append(chunk)
+                if self.on_chunk is not None: self.on_chunk(len(self.profile), self.bytes_read, self.reader.total_bytes)
+            if self.cache is not None and not self.cancelled: self.cache.sourceHash(self.reader.path)
+        except Exception as e: error = e
+        self.profile.finish(error)
+        if self.on_done is not None: self.on_done(error)
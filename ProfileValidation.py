@@ -0,0 +1,231 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Profile Validation (ProfileValidation.py)
+#   Description:            Checks a compiled profile before it is run: current and voltage limits, slew rate, relay
+#                           switching and wear, the energy put into each coil and how long the run takes.
+#   Inputs/Resources:       A compiled CageProfile, the step period and the field offsets
+#   Output/Created files:   A ValidationReport of errors, warnings and per-axis figures
+#
+#   Notes:                  Errors are hard limits and block the run, warnings are shown but don't.
+#                           A run started while the profile is still loading has the rest of it checked against the
+#                           hard limits chunk by chunk as it is compiled (LimitGuard), and stops at one that breaks them.
+#                           Everything is computed with whole-array numpy operations, a few million steps take a
+#                           fraction of a second. The coil figures are rough and should be measured on the cage.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import time
+import numpy as np
+from CageProfile import AXES
+
+#=============================================================================#
+#                                Safety Limits                                #
+#=============================================================================#
+
+class SafetyLimits:
+
+    # max_current       highest current a coil may be driven with (A), error
+    # max_voltage       highest voltage setting of the 2260B-30-36 (V), error
+    # max_slew          fastest current change the coils should see (A/s), warning
+    # min_relay_dwell   shortest time between two switches of the same relay (s), error below the contact settle time
+    # wear_dwell        relay switches closer together than this are counted as wearing (s), warning
+    # max_toggles       relay switches per axis before a warning
+    # resistance        coil resistance per axis (ohm), for the voltage needed and the heat put in
+    # inductance        coil inductance per axis (H), for the voltage needed while slewing
+    # max_power         continuous power per coil before a warning (W)
+    # max_offset        field offsets beyond this are most likely typos (nT), warning
+    def __init__(self, max_current=5.0, max_voltage=30.0, max_slew=50.0, min_relay_dwell=0.010, wear_dwell=0.5,
+            max_toggles=10000, resistance=(6.0, 6.0, 6.0), inductance=(0.05, 0.05, 0.05), max_power=60.0, max_offset=100000.0):
+        self.max_current = max_current
+        self.max_voltage = max_voltage
+        self.max_slew = max_slew
+        self.min_relay_dwell = min_relay_dwell
+        self.wear_dwell = wear_dwell
+        self.max_toggles = max_toggles
+        self.resistance = np.asarray(resistance, dtype=np.float64)
+        self.inductance = np.asarray(inductance, dtype=np.float64)
+        self.max_power = max_power
+        self.max_offset = max_offset
+
+#=============================================================================#
+#                              Validation Report                              #
+#=============================================================================#
+
+class ValidationReport:
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+        self.stats = {}
+        self.checked_steps = 0
+        self.analysis_time = 0.0
+
+    @property
+    def blocked(self): return len(self.errors) > 0
+
+    def error(self, message): self.errors.append(message)
+
+    def warning(self, message): self.warnings.append(message)
+
+    # One line for the status box
+    def summary(self):
+        if self.errors: return 'Error: ' + self.errors[0] + ('' if len(self.errors) == 1 else ' (+%d more)' % (len(self.errors) - 1))
+        text = 'Profile OK, run takes %s' % formatDuration(self.stats.get('duration', 0.0))
+        if self.warnings: text += ' - Warning: ' + '; '.join(self.warnings)
+        return text
+
+    def report(self):
+        lines = ['%d steps checked in %.1f ms' % (self.checked_steps, self.analysis_time*1000)]
+        lines += ['ERROR: ' + message for message in self.errors]
+        lines += ['warning: ' + message for message in self.warnings]
+        for key in sorted(self.stats):
+            value = self.stats[key]
+            lines.append('%s: %s' % (key, ', '.join('%.4g' % item for item in value) if np.ndim(value) else '%.4g' % value))
+        return '\n'.join(lines)
+
+def formatDuration(seconds):
+    hours, rest = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+#=============================================================================#
+#                                   Analysis                                  #
+#=============================================================================#
+
+# Checks a compiled profile played with a step every period seconds
+def analyzeProfile(profile, period, limits=None, offsets=(0, 0, 0)):
+    limits = limits or SafetyLimits()
+    report = ValidationReport()
+    start = time.perf_counter()
+    currents = profile.currents
+    steps = len(currents)
+    report.checked_steps = steps
+    if not profile.complete: report.warning('Profile still loading, the steps after the first %d are checked as they load' % steps)
+    # Nothing loaded yet isn't an error until the file turns out to be empty, validate() checks again once steps arrive
+    if not steps:
+        if profile.complete: report.error('Empty Profile')
+        return report
+    # One contiguous row per axis, reductions along an axis of the (N, 3) array are several times slower
+    columns = np.ascontiguousarray(currents.T)
+    magnitude = np.abs(columns)
+    stats = report.stats
+    stats['duration'] = steps*period
+
+    # A NaN compares false with every limit and hides an inf from max(), so they're caught before anything else
+    finite = np.isfinite(columns)
+    for axis in np.flatnonzero(~finite.all(axis=1)):
+        report.error('%s current is not a number (first at step %d)' % (AXES[axis], int(np.argmin(finite[axis]))))
+    if report.errors:
+        report.analysis_time = time.perf_counter() - start
+        return report
+
+    # Current and voltage
+    peak = magnitude.max(axis=1)
+    stats['peak_current'] = peak
+    for axis in np.flatnonzero(peak > limits.max_current):
+        first = int(np.argmax(magnitude[axis] > limits.max_current))
+        report.error('%s current %.2f A is above the %.2f A limit (first at step %d)' % (AXES[axis], peak[axis], limits.max_current, first))
+    if profile.voltage > limits.max_voltage:
+        report.error('Voltage setting %g V is above the PSU limit of %g V' % (profile.voltage, limits.max_voltage))
+
+    # Slew rate, and the voltage needed to drive it through the coil inductance
+    if steps > 1:
+        slew = np.abs(np.diff(columns, axis=1)).max(axis=1)/period
+        stats['peak_slew'] = slew
+        for axis in np.flatnonzero(slew > limits.max_slew):
+            report.warning('%s current changes at up to %.1f A/s (limit %.1f A/s)' % (AXES[axis], slew[axis], limits.max_slew))
+    else: slew = np.zeros(3)
+    needed = peak*limits.resistance + slew*limits.inductance
+    stats['peak_voltage_needed'] = needed
+    for axis in np.flatnonzero(needed > profile.voltage):
+        report.warning('%s coil needs up to %.1f V, more than the %g V setting, the current will lag' % (AXES[axis], needed[axis], profile.voltage))
+
+    # Relays: how often each one switches and how long it stays put
+    changed = profile.polarity[1:] ^ profile.polarity[:-1]
+    counts = np.zeros(3, dtype=np.int64)
+    min_dwell = np.full(3, np.inf)
+    for axis in range(3):
+        switches = np.flatnonzero(changed & (1 << axis))
+        counts[axis] = len(switches)
+        if len(switches) < 2: continue
+        dwell = np.diff(switches)*period
+        min_dwell[axis] = dwell.min()
+        wearing = int((dwell < limits.wear_dwell).sum())
+        if min_dwell[axis] < limits.min_relay_dwell:
+            first = int(switches[1:][np.argmax(dwell < limits.min_relay_dwell)]) + 1
+            report.error('%s relay switches again after %.1f ms, faster than the %.0f ms it needs (step %d)'
+                % (AXES[axis], min_dwell[axis]*1000, limits.min_relay_dwell*1000, first))
+        elif wearing: report.warning('%s relay switches %d times within %.2f s of the last switch' % (AXES[axis], wearing, limits.wear_dwell))
+    stats['relay_toggles'] = counts
+    stats['min_relay_dwell'] = np.where(np.isinf(min_dwell), stats['duration'], min_dwell)
+    for axis in np.flatnonzero(counts > limits.max_toggles):
+        report.warning('%s relay switches %d times' % (AXES[axis], counts[axis]))
+
+    # Heat put into each coil
+    energy = np.einsum('ij,ij->i', columns, columns)*limits.resistance*period
+    stats['energy'] = energy
+    stats['mean_power'] = energy/stats['duration']
+    stats['peak_power'] = peak*peak*limits.resistance
+    for axis in np.flatnonzero(stats['mean_power'] > limits.max_power):
+        report.warning('%s coil averages %.0f W, above the %.0f W it can shed' % (AXES[axis], stats['mean_power'][axis], limits.max_power))
+
+    for axis in np.flatnonzero(np.abs(np.asarray(offsets, dtype=np.float64)) > limits.max_offset):
+        report.warning('%s offset of %g nT is larger than any field the cage should cancel' % (AXES[axis], offsets[axis]))
+
+    report.analysis_time = time.perf_counter() - start
+    return report
+
+#=============================================================================#
+#                                 Limit Guard                                 #
+#=============================================================================#
+
+# Checks the hard limits on the steps of a profile that arrive after analyzeProfile ran, so a run started while the
+# profile is still loading never plays a step that would have blocked it. CageProfile.append calls check() on every
+# chunk before it can be played; checked is the number of steps analyzeProfile already looked at.
+class LimitGuard:
+
+    def __init__(self, period, limits=None, checked=0):
+        self.period = period
+        self.limits = limits or SafetyLimits()
+        self.checked = checked
+        self.last_polarity = None
+        self.last_switch = [None]*3 # Step each relay last switched on
+
+    # Picks up where the relays were from the steps already checked
+    def begin(self, polarity):
+        polarity = polarity[:self.checked]
+        if not len(polarity): return
+        self.last_polarity = int(polarity[-1])
+        changed = polarity[1:] ^ polarity[:-1]
+        for axis in range(3):
+            switches = np.flatnonzero(changed & (1 << axis))
+            if len(switches): self.last_switch[axis] = int(switches[-1]) + 1
+
+    # Checks the compiled currents and polarity of the steps from start on.
+    # Raises Exception('Safety Limit Exceeded', message) on the first hard limit they break.
+    def check(self, currents, polarity, start):
+        limits = self.limits
+        finite = np.isfinite(currents)
+        if not finite.all():
+            step, axis = np.unravel_index(np.argmin(finite), finite.shape)
+            raise Exception('Safety Limit Exceeded', '%s current is not a number (step %d)' % (AXES[axis], start + step))
+        magnitude = np.abs(currents)
+        if len(magnitude) and magnitude.max() > limits.max_current:
+            step, axis = np.unravel_index(np.argmax(magnitude > limits.max_current), magnitude.shape)
+            raise Exception('Safety Limit Exceeded', '%s current %.2f A is above the %.2f A limit (step %d)'
+                % (AXES[axis], magnitude[step, axis], limits.max_current, start + step))
+        if len(polarity):
+            previous = polarity[0] if self.last_polarity is None else self.last_polarity
+            changed = polarity ^ np.concatenate(([previous], polarity[:-1]))
+            for axis in range(3):
+                switches = np.flatnonzero(changed & (1 << axis)) + start
+                steps = switches if self.last_switch[axis] is None else np.concatenate(([self.last_switch[axis]], switches))
+                if len(steps) > 1:
+                    dwell = np.diff(steps)*self.period
+                    if dwell.min() < limits.min_relay_dwell:
+                        raise Exception('Safety Limit Exceeded', '%s relay switches again after %.1f ms, faster than the %.0f ms it needs (step %d)'
+                            % (AXES[axis], dwell.min()*1000, limits.min_relay_dwell*1000, int(steps[1:][np.argmax(dwell < limits.min_relay_dwell)])))
+                if len(switches): self.last_switch[axis] = int(switches[-1])
+            self.last_polarity = int(polarity[-1])
+        self.checked = start + len(currents)
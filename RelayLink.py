@@ -0,0 +1,159 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Relay Link (RelayLink.py)
+#   Description:            Host side of the serial link to the Arduino relay controller (ArduinoRelayController.ino).
+#                           Sets the polarity of all three coils with one acknowledged byte per step.
+#   Inputs/Resources:       The Arduino's serial port (or any pyserial URL such as loop:// for testing)
+#   Output/Created files:   Relay command latency statistics
+#
+#   Notes:                  Frame protocol, one byte:   1 E S S S Z Y X
+#                             bit 7      always 1, which is how the firmware tells frames from the old characters
+#                             bit 6  E   1 = relays energized with the polarity below, 0 = all relays off ('l')
+#                             bit 5-3 S  sequence number, echoed back so a late acknowledgement is never mistaken
+#                             bit 2-0    polarity mask, bit set = field on that axis is negative
+#                           The firmware echoes the frame once the relays have switched.
+#                           Old firmware only understands the per-axis characters 'f'..'l' at 9600 baud, which is
+#                           used automatically if the frame probe goes unanswered.
+#                           The probe has to be harmless to the old sketch. A 115200 baud byte is over before a 9600
+#                           baud UART samples its first data bit, so all it can read from one is 0xFF, never 'f'..'l'.
+#                           Probes are all-off frames with sequence bit 2 set, which also makes the AVR's start bit
+#                           check fail so nothing is read at all, and they are spaced so two never fall in one character.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import time
+from array import array
+import serial
+from PlaybackEngine import StepTimingStats
+
+# Must match RELAY_BAUD in ArduinoRelayController.ino
+DEFAULT_BAUD = 115200
+LEGACY_BAUD = 9600
+
+FRAME_FLAG = 0x80
+ENABLE_FLAG = 0x40
+MASK_BITS = 0x07
+
+# The Arduino resets when the port is opened and needs a moment before it reads anything
+PROBE_TIMEOUT = 2.5
+ACK_TIMEOUT = 0.05
+PROBE_SEQUENCES = (4, 5, 6, 7) # Sequence bit 2 is the bit a 9600 baud UART checks its start bit on
+PROBE_SPACING = 0.002 # Two characters at LEGACY_BAUD
+
+# Builds a frame byte
+def encodeFrame(mask, sequence, enabled=True):
+    return FRAME_FLAG | (ENABLE_FLAG if enabled else 0) | ((sequence & 0x07) << 3) | (mask & MASK_BITS)
+
+# Returns (mask, sequence, enabled) from a frame byte
+def decodeFrame(frame):
+    return frame & MASK_BITS, (frame >> 3) & 0x07, bool(frame & ENABLE_FLAG)
+
+# Old protocol: the character for one axis and sign, chr(command + state + 100) with command (axis+1)*2
+def legacyCommand(axis, sign): return chr((axis + 1)*2 + sign + 100).encode('UTF-8')
+
+LEGACY_ALL_OFF = b'l'
+
+#=============================================================================#
+#                                  Relay Link                                 #
+#=============================================================================#
+
+class RelayLink:
+
+    # protocol is 'frame', 'legacy' or 'auto' (try frames, fall back to the old characters at 9600 baud)
+    def __init__(self, port, baud=DEFAULT_BAUD, protocol='auto', ack_timeout=ACK_TIMEOUT, serial_factory=serial.serial_for_url):
+        self.port = port
+        self.baud = baud
+        self.protocol = protocol
+        self.ack_timeout = ack_timeout
+        self.serial_factory = serial_factory
+        self.serial = None
+        self.sequence = 0
+        self.mask = None # Last acknowledged polarity mask, None when the relays are off or unknown
+        self.frames = 0
+        self.missed_acks = 0
+        self.latency = array('d')
+
+    # Opens the port and works out which protocol the firmware speaks
+    def open(self, probe_timeout=PROBE_TIMEOUT):
+        if self.protocol == 'legacy':
+            self.serial = self.serial_factory(self.port, baudrate=LEGACY_BAUD, timeout=0.1)
+            self.serial.write(LEGACY_ALL_OFF)
+            return self
+        self.serial = self.serial_factory(self.port, baudrate=self.baud, timeout=self.ack_timeout)
+        if self.probe(probe_timeout): self.protocol = 'frame'
+        elif self.protocol == 'auto':
+            self.serial.close()
+            self.protocol = 'legacy'
+            self.serial = self.serial_factory(self.port, baudrate=LEGACY_BAUD, timeout=0.1)
+            self.serial.write(LEGACY_ALL_OFF)
+        else: raise serial.SerialTimeoutException('Relay controller did not acknowledge')
+        # Unanswered probes while the Arduino was resetting aren't missed acknowledgements
+        self.missed_acks = 0
+        return self
+
+    # Sends all-off frames until one is acknowledged, which also tells us the Arduino has finished resetting
+    # Each probe is an all-off frame the old sketch can't read as one of its characters (see the notes).
+    def probe(self, timeout):
+        end = time.perf_counter() + timeout
+        attempt = 0
+        while time.perf_counter() < end:
+            sent = time.perf_counter()
+            if self.sendFrame(0, False, PROBE_SEQUENCES[attempt % len(PROBE_SEQUENCES)]): return True
+            attempt += 1
+            wait = sent + PROBE_SPACING - time.perf_counter()
+            if wait > 0: time.sleep(wait)
+        return False
+
+    def close(self):
+        if self.serial is not None: self.serial.close()
+        self.serial = None
+        self.mask = None
+
+    # Sends one frame and waits for its echo. Returns False if no acknowledgement came in time.
+    # Reads block for at most the port timeout, which is the acknowledgement timeout.
+    # sequence picks the sequence number instead of the next one.
+    def sendFrame(self, mask, enabled=True, sequence=None):
+        self.sequence = (self.sequence + 1) & 0x07 if sequence is None else sequence & 0x07
+        frame = encodeFrame(mask, self.sequence, enabled)
+        self.serial.reset_input_buffer()
+        start = time.perf_counter()
+        self.serial.write(bytes((frame,)))
+        self.frames += 1
+        end = start + self.ack_timeout
+        while True:
+            reply = self.serial.read(1)
+            if reply and reply[0] == frame:
+                self.latency.append(time.perf_counter() - start)
+                self.mask = mask if enabled else None
+                return True
+            # Anything else is a stale acknowledgement, keep reading until the timeout runs out
+            if not reply or time.perf_counter() >= end:
+                self.missed_acks += 1
+                self.mask = None
+                return False
+
+    # Sets the polarity of all three axes, bit set = negative
+    def setPolarity(self, mask):
+        mask = int(mask) & MASK_BITS
+        if self.protocol == 'frame': return self.sendFrame(mask)
+        self.serial.write(b''.join(legacyCommand(axis, (mask >> axis) & 1) for axis in range(3)))
+        self.mask = mask
+        return True
+
+    # Turns all the relays off
+    def allOff(self):
+        if self.protocol == 'frame': return self.sendFrame(0, False)
+        self.serial.write(LEGACY_ALL_OFF)
+        self.mask = None
+        return True
+
+    # Writes a raw old-style command, the character command + state + 100
+    def legacy(self, command, state): self.serial.write(chr(command + state + 100).encode('UTF-8'))
+
+    # Acknowledgement latency in milliseconds
+    def report(self):
+        percentile = StepTimingStats.percentile
+        return ('relay %s @ %d baud, ack p50/p99 %.2f/%.2f ms, %d missed'
+            % (self.protocol, LEGACY_BAUD if self.protocol == 'legacy' else self.baud,
+            percentile(self.latency, 50)*1e3, percentile(self.latency, 99)*1e3, self.missed_acks))
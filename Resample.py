@@ -0,0 +1,164 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Resample (Resample.py)
+#   Description:            Streaming resampling between ingest and compilation. Turns samples taken every
+#                           source_period into steps every target_period with linear or cubic interpolation,
+#                           averages them down when the source is denser than the steps, and can limit how fast
+#                           each coil's current changes.
+#   Inputs/Resources:       Chunks of (n, 3) x, y, z field samples (nT), e.g. from ProfileReader.chunks()
+#   Output/Created files:   Chunks of (m, 3) resampled samples, or a resampled csv file
+#
+#   Notes:                  Every stage is a generator that only keeps a few samples between chunks, so a profile
+#                           larger than memory can be resampled straight from one file into another:
+#                           python Resample.py in.csv out.csv --source-period 60 --target-period 0.5 --method cubic
+#                           Cubic is Catmull-Rom, which passes through every source sample. Decimation averages the
+#                           source samples within each step so detail the coils can't follow doesn't alias.
+#                           The dI/dt limit is in A/s and is converted to nT per step with the coil constants.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import sys
+import math
+import argparse
+import numpy as np
+from CageProfile import CAGE_CONSTANT, COIL_CONSTANTS, COIL_TURNS
+
+METHODS = ('linear', 'cubic')
+
+# Samples needed before and after a position by each way of evaluating it
+def window(method, ratio):
+    if ratio > 1: return int(math.ceil(ratio/2)), int(math.ceil(ratio/2))
+    if method == 'cubic': return 1, 2
+    return 0, 1
+
+# Values of samples (n, 3) at fractional sample positions
+def evaluate(samples, positions, method, ratio):
+    last = len(samples) - 1
+    if ratio > 1:
+        # Mean of the samples within half a step either side
+        totals = np.concatenate((np.zeros((1, 3)), np.cumsum(samples, axis=0)))
+        low = np.clip(np.ceil(positions - ratio/2).astype(np.int64), 0, last)
+        high = np.clip(np.floor(positions + ratio/2).astype(np.int64), 0, last)
+        return (totals[high + 1] - totals[low])/(high - low + 1)[:, None]
+    index = np.floor(positions).astype(np.int64)
+    fraction = (positions - index)[:, None]
+    p1 = samples[index]
+    p2 = samples[np.minimum(index + 1, last)]
+    if method == 'linear': return p1 + (p2 - p1)*fraction
+    p0 = samples[np.maximum(index - 1, 0)]
+    p3 = samples[np.minimum(index + 2, last)]
+    return 0.5*(2*p1 + (p2 - p0)*fraction + (2*p0 - 5*p1 + 4*p2 - p3)*fraction**2 + (3*p1 - p0 - 3*p2 + p3)*fraction**3)
+
+#=============================================================================#
+#                                    Stages                                   #
+#=============================================================================#
+
+# Resamples a stream of chunks, step k is at source sample k*ratio (ratio = target_period/source_period)
+def interpolate(chunks, ratio, method='linear'):
+    before, after = window(method, ratio)
+    history = np.empty((0, 3))
+    base = 0    # Source index of history[0]
+    step = 0    # Next output step
+    for chunk in chunks:
+        samples = np.concatenate((history, chunk)) if len(history) else np.asarray(chunk, dtype=np.float64)
+        last = base + len(samples) - 1
+        # Steps whose neighbourhood is complete
+        stop = int(math.floor((last - after)/ratio)) + 1 if last >= after else 0
+        if stop > step:
+            yield evaluate(samples, np.arange(step, stop)*ratio - base, method, ratio)
+            step = stop
+        keep = max(0, min(int(math.floor(step*ratio)) - before, last + 1) - base)
+        history = samples[keep:]
+        base += keep
+    # Whatever is left up to the last source sample, the edges are held
+    if len(history):
+        last = base + len(history) - 1
+        stop = int(math.floor(last/ratio + 1e-9)) + 1
+        if stop > step: yield evaluate(history, np.arange(step, stop)*ratio - base, method, ratio)
+
+# Limits the change between consecutive steps to max_step (nT, per axis). limiter.limited counts the steps changed.
+class SlewLimiter:
+
+    def __init__(self, max_step):
+        self.max_step = np.asarray(max_step, dtype=np.float64)
+        self.limited = 0
+
+    def __call__(self, chunks):
+        previous = None
+        for chunk in chunks:
+            if not len(chunk): continue
+            output = np.array(chunk, dtype=np.float64)
+            reference = output[0] if previous is None else previous
+            steps = np.abs(np.diff(np.concatenate((reference[None], output)), axis=0)) > self.max_step
+            bad = np.flatnonzero(steps.any(axis=1))
+            # Walks sample by sample only while the output is catching up with the input
+            index = int(bad[0]) if len(bad) else len(output)
+            while index < len(output):
+                prior = output[index - 1] if index else reference
+                target = chunk[index]
+                output[index] = prior + np.clip(target - prior, -self.max_step, self.max_step)
+                self.limited += 1
+                if (output[index] == target).all():
+                    rest = np.abs(np.diff(chunk[index:], axis=0)) > self.max_step
+                    bad = np.flatnonzero(rest.any(axis=1))
+                    if not len(bad): break
+                    index += 1 + int(bad[0])
+                else: index += 1
+            previous = output[-1]
+            yield output
+
+#=============================================================================#
+#                                  Resampler                                  #
+#=============================================================================#
+
+# The whole stage, called with a chunk iterator. max_slew is the dI/dt limit in A/s, one value or one per axis.
+class Resampler:
+
+    def __init__(self, source_period, target_period, method='linear', max_slew=None, coil_constants=COIL_CONSTANTS):
+        if method not in METHODS: raise Exception('Unknown Resampling Method')
+        if source_period <= 0 or target_period <= 0: raise Exception('Invalid Resampling Period')
+        self.source_period = source_period
+        self.target_period = target_period
+        self.method = method
+        self.ratio = target_period/source_period
+        self.scale = 1/self.ratio # Output steps per source sample, for size estimates
+        self.limiter = None
+        if max_slew is not None:
+            gains = np.array([CAGE_CONSTANT*1e-9*k/COIL_TURNS for k in coil_constants])
+            self.limiter = SlewLimiter(np.broadcast_to(np.asarray(max_slew, dtype=np.float64), (3,))*target_period/gains)
+
+    def __call__(self, chunks):
+        chunks = interpolate(chunks, self.ratio, self.method)
+        if self.limiter is not None: chunks = self.limiter(chunks)
+        return chunks
+
+    def report(self):
+        report = '%s resampling %g s -> %g s' % ('averaged' if self.ratio > 1 else self.method, self.source_period, self.target_period)
+        if self.limiter is not None: report += ', %d steps slew limited' % self.limiter.limited
+        return report
+
+# Writes chunks to a csv file the controller can load, one chunk at a time. Returns the number of rows.
+def writeProfileCSV(chunks, path, fmt='%.3f'):
+    rows = 0
+    with open(path, 'w', newline='') as file:
+        file.write('x (nT),y (nT),z (nT)\n')
+        for chunk in chunks:
+            np.savetxt(file, chunk, fmt=fmt, delimiter=',')
+            rows += len(chunk)
+    return rows
+
+if __name__ == "__main__":
+    from ProfileIngest import ProfileReader
+    parser = argparse.ArgumentParser(description='Resamples a field profile csv in bounded memory.')
+    parser.add_argument('source')
+    parser.add_argument('destination')
+    parser.add_argument('--source-period', type=float, required=True, help='seconds between rows of the source')
+    parser.add_argument('--target-period', type=float, required=True, help='seconds between rows of the result')
+    parser.add_argument('--method', choices=METHODS, default='linear')
+    parser.add_argument('--max-slew', type=float, help='dI/dt limit in A/s')
+    arguments = parser.parse_args()
+    resampler = Resampler(arguments.source_period, arguments.target_period, arguments.method, arguments.max_slew)
+    rows = writeProfileCSV(resampler(ProfileReader(arguments.source).chunks()), arguments.destination)
+    print('%d rows written, %s' % (rows, resampler.report()))
+    sys.exit(0)
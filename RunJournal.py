@@ -0,0 +1,369 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Run Journal (RunJournal.py)
+#   Description:            Append-only binary record of a run: when every step started, every command sent to the
+#                           Keithleys and the Arduino, and every readback, on the monotonic clock. A journal can be
+#                           read back as columnar numpy arrays, or replayed against the instruments with the timing
+#                           of the replay compared to the original.
+#   Inputs/Resources:       Records from the playback loop, the PSU dispatcher, the telemetry and the magnetometer
+#   Output/Created files:   <name>.hhcj journal files
+#
+#   Notes:                  File layout:  MAGIC | uint32 header length | JSON header | blocks
+#                           Block:        b'BLCK' | uint32 records | uint32 text bytes | uint32 0 | records | text
+#                           Records are fixed size (RECORD). Command text is kept in the block's text area and
+#                           referenced by offset and length, so the records stay fixed size.
+#                           Records go into preallocated buffers; a flusher thread writes full buffers (and the
+#                           partly full one every FLUSH_INTERVAL) so the playback loop never waits on the disk.
+#                           python RunJournal.py run.hhcj                            summary of a journal
+#                           python RunJournal.py run.hhcj --replay --simulate         replay it and compare timing
+#                           python RunJournal.py run.hhcj --replay --arduino COM3 --psu X Y Z
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import os
+import sys
+import mmap
+import json
+import time
+import struct
+import argparse
+import threading
+import numpy as np
+from queue import Queue, Empty
+from PlaybackEngine import DeadlineScheduler
+
+MAGIC = b'HHCJRNL1'
+JOURNAL_VERSION = 1
+BLOCK = struct.Struct('<4sIII')
+BLOCK_TAG = b'BLCK'
+EXTENSION = '.hhcj'
+
+# values holds what the record kind needs:
+#   STEP      deadline the step was due at
+#   PSU       a command written to a Keithley (the text), time to end is the write
+#   RELAY     mask, acknowledged (1/0), energized (1/0)
+#   READBACK  measured current, measured voltage (axis set), time to end is the query
+#   FIELD     magnetometer x, y, z (nT)
+#   EVENT     text only: run start, reconnects, the end of the run
+STEP, PSU, RELAY, READBACK, FIELD, EVENT = range(6)
+KINDS = ('step', 'psu', 'relay', 'readback', 'field', 'event')
+
+RECORD = np.dtype([('time', '<f8'), ('end', '<f8'), ('step', '<i8'), ('values', '<f8', (3,)),
+    ('text', '<i8'), ('length', '<u4'), ('kind', 'u1'), ('axis', 'i1')])
+# The same layout for the writer, packing into a bytearray is several times faster than assigning numpy records
+RECORD_STRUCT = struct.Struct('<ddqdddqIBb')
+
+BUFFER_RECORDS = 65536
+BUFFER_TEXT = 4*1024*1024
+BUFFER_COUNT = 4
+FLUSH_INTERVAL = 0.5
+
+#=============================================================================#
+#                                    Writer                                   #
+#=============================================================================#
+
+class JournalBuffer:
+
+    def __init__(self, records=BUFFER_RECORDS, text=BUFFER_TEXT):
+        self.capacity = records
+        self.records = bytearray(records*RECORD.itemsize)
+        self.text = bytearray(text)
+        self.count = 0
+        self.text_used = 0
+
+    def clear(self):
+        self.count = 0
+        self.text_used = 0
+
+class RunJournal:
+
+    # meta is stored in the header, e.g. the profile and period
+    def __init__(self, filename, meta=None, clock=time.perf_counter):
+        self.filename = filename
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.free = Queue()
+        for _index in range(BUFFER_COUNT - 1): self.free.put(JournalBuffer())
+        self.active = JournalBuffer()
+        self.full = Queue()
+        self.step = -1          # Step the records are currently tagged with
+        self.records = 0
+        self.grown = 0          # Buffers allocated because the flusher had fallen behind
+        self.flush_time = 0.0
+        self.closed = False
+        header = {'version': JOURNAL_VERSION, 'created': time.time(), 'clock': clock(), 'meta': meta or {}}
+        encoded = json.dumps(header).encode('UTF-8')
+        directory = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(directory, exist_ok=True)
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC + len(encoded).to_bytes(4, 'little') + encoded)
+        self.flusher = threading.Thread(target=self.flushLoop, name='JournalFlusher', daemon=True)
+        self.flusher.start()
+
+    # Adds one record. Called from the playback, PSU and telemetry threads, never touches the disk.
+    def add(self, kind, start, end=0.0, axis=-1, values=(0.0, 0.0, 0.0), text=None):
+        with self.lock:
+            buffer = self.active
+            if text is not None:
+                encoded = text.encode('UTF-8')
+                if buffer.text_used + len(encoded) > len(buffer.text):
+                    buffer = self.swap()
+                    if len(encoded) > len(buffer.text): buffer.text.extend(bytes(len(encoded)))
+                offset = buffer.text_used
+                buffer.text[offset:offset + len(encoded)] = encoded
+                buffer.text_used += len(encoded)
+                length = len(encoded)
+            else: offset, length = 0, 0
+            RECORD_STRUCT.pack_into(buffer.records, buffer.count*RECORD.itemsize, start, end, self.step,
+                values[0], values[1], values[2], offset, length, kind, axis)
+            buffer.count += 1
+            self.records += 1
+            if buffer.count == buffer.capacity: self.swap()
+
+    # Hands the active buffer to the flusher and takes a free one. Called with the lock held.
+    def swap(self):
+        if self.active.count or self.active.text_used: self.full.put(self.active)
+        try: self.active = self.free.get_nowait()
+        except Empty:
+            self.active = JournalBuffer()
+            self.grown += 1
+        return self.active
+
+    def stepStarted(self, index, start, deadline):
+        self.step = index
+        self.add(STEP, start, values=(deadline, 0.0, 0.0))
+
+    def command(self, axis, start, end, command): self.add(PSU, start, end, axis, text=command)
+
+    def relay(self, start, end, mask, acknowledged, energized=True):
+        self.add(RELAY, start, end, values=(mask, 1.0 if acknowledged else 0.0, 1.0 if energized else 0.0))
+
+    def readback(self, axis, start, end, current, voltage): self.add(READBACK, start, end, axis, (current, voltage, 0.0))
+
+    def field(self, time, sample): self.add(FIELD, time, values=sample)
+
+    def event(self, text): self.add(EVENT, self.clock(), text=text)
+
+    # Writes full buffers as they come, and the partly filled one every FLUSH_INTERVAL
+    def flushLoop(self):
+        while True:
+            try: buffer = self.full.get(timeout=FLUSH_INTERVAL)
+            except Empty:
+                with self.lock:
+                    if not self.active.count: continue
+                    self.swap()
+                continue
+            if buffer is None: break
+            start = time.perf_counter()
+            self.file.write(BLOCK.pack(BLOCK_TAG, buffer.count, buffer.text_used, 0))
+            self.file.write(memoryview(buffer.records)[:buffer.count*RECORD.itemsize])
+            self.file.write(memoryview(buffer.text)[:buffer.text_used])
+            self.file.flush()
+            self.flush_time += time.perf_counter() - start
+            buffer.clear()
+            self.free.put(buffer)
+
+    # Writes whatever is left and closes the file
+    def close(self):
+        with self.lock:
+            if self.closed: return
+            self.closed = True
+            self.swap()
+            self.full.put(None)
+        self.flusher.join()
+        self.file.close()
+
+    def report(self):
+        return '%d records journaled, %.1f ms writing, %d buffers added' % (self.records, self.flush_time*1e3, self.grown)
+
+#=============================================================================#
+#                                    Reader                                   #
+#=============================================================================#
+
+# A journal as one contiguous array per RECORD field, e.g. data['time'][data['kind'] == STEP]
+class JournalData:
+
+    def __init__(self, header, columns, text):
+        self.header = header
+        self.meta = header.get('meta', {})
+        self.columns = columns
+        self.text = text
+
+    def __len__(self): return len(self.columns['time'])
+
+    def __getitem__(self, column): return self.columns[column]
+
+    # Command or event text of a record
+    def textOf(self, index):
+        offset = int(self.columns['text'][index])
+        return self.text[offset:offset + int(self.columns['length'][index])].decode('UTF-8')
+
+    def indexes(self, kind, axis=None):
+        selected = self.columns['kind'] == kind
+        if axis is not None: selected &= self.columns['axis'] == axis
+        return np.flatnonzero(selected)
+
+    # Step index, start time and deadline of every step played
+    def steps(self):
+        rows = self.indexes(STEP)
+        return self.columns['step'][rows], self.columns['time'][rows], self.columns['values'][rows, 0]
+
+    # Time it took to write each command to the PSUs
+    def writeDurations(self):
+        rows = self.indexes(PSU)
+        return self.columns['end'][rows] - self.columns['time'][rows]
+
+    # Time, voltage and current of every APPL command sent to an axis
+    def appliedValues(self, axis):
+        times, voltages, currents = [], [], []
+        for index in self.indexes(PSU, axis):
+            command = self.textOf(index)
+            if not command.startswith('APPL'): continue
+            voltage, current = command[5:].split(',')[0:2]
+            times.append(self.columns['time'][index])
+            voltages.append(float(voltage))
+            currents.append(float(current))
+        return np.array(times), np.array(voltages), np.array(currents)
+
+    def summary(self):
+        counts = np.bincount(self.columns['kind'], minlength=len(KINDS))
+        summary = dict(('%s_records' % KINDS[kind], int(counts[kind])) for kind in range(len(KINDS)))
+        steps, start, deadline = self.steps()
+        if len(steps):
+            lateness = start - deadline
+            summary.update({'duration': float(start[-1] - start[0]), 'lateness_p50': float(np.percentile(lateness, 50)),
+                'lateness_p99': float(np.percentile(lateness, 99)), 'lateness_max': float(lateness.max())})
+        durations = self.writeDurations()
+        if len(durations):
+            summary.update({'write_p50': float(np.percentile(durations, 50)), 'write_p99': float(np.percentile(durations, 99))})
+        return summary
+
+# Reads a journal into one array per field. The file is mapped, so each record is only copied once.
+def readJournal(filename):
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0: raise Exception('Not a run journal')
+        content = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if content[:len(MAGIC)] != MAGIC: raise Exception('Not a run journal')
+        length = int.from_bytes(content[len(MAGIC):len(MAGIC) + 4], 'little')
+        position = len(MAGIC) + 4 + length
+        header = json.loads(content[len(MAGIC) + 4:position].decode('UTF-8'))
+        if header['version'] != JOURNAL_VERSION: raise Exception('Unsupported journal version')
+        pieces = dict((name, []) for name in RECORD.names)
+        texts = []
+        text_base = 0
+        records = None
+        # A journal cut short by a crash is read up to its last complete block
+        while position + BLOCK.size <= len(content):
+            tag, count, text_bytes, _reserved = BLOCK.unpack_from(content, position)
+            end = position + BLOCK.size + count*RECORD.itemsize + text_bytes
+            if tag != BLOCK_TAG or end > len(content): break
+            records = np.frombuffer(content, dtype=RECORD, count=count, offset=position + BLOCK.size)
+            for name in RECORD.names: pieces[name].append(records[name] + text_base if name == 'text' else records[name])
+            texts.append(content[end - text_bytes:end])
+            text_base += text_bytes
+            position = end
+        columns = dict((name, np.concatenate(pieces[name]) if pieces[name] else np.zeros((0,) + RECORD[name].shape, dtype=RECORD[name].base))
+            for name in RECORD.names)
+        # The mapping can only be closed once nothing points into it
+        del records, pieces
+    finally: content.close()
+    return JournalData(header, columns, b''.join(texts))
+
+#=============================================================================#
+#                                    Replay                                   #
+#=============================================================================#
+
+# Plays a journal's relay and PSU commands again on the same timeline, step by step. dispatcher is a
+# PSUDispatcher and relays a RelayLink (None skips them). The commands of each step go out the way the
+# playback loop sent them: relays first, then one concurrent write per axis per round.
+def replayJournal(data, dispatcher, relays=None, journal=None, clock=time.perf_counter):
+    kinds = data['kind']
+    times = data['time']
+    step_rows = data.indexes(STEP)
+    if not len(step_rows): raise Exception('Journal Has No Steps')
+    boundaries = list(step_rows) + [len(data)]
+    origin = times[step_rows[0]]
+    scheduler = DeadlineScheduler(1.0, clock=clock)
+    start = clock()
+    for number in range(len(step_rows)):
+        row = boundaries[number]
+        due = start + (times[row] - origin)
+        scheduler.waitUntil(due)
+        begin = clock()
+        if journal is not None: journal.stepStarted(int(data['step'][row]), begin, due)
+        rounds = []
+        for index in range(row + 1, boundaries[number + 1]):
+            kind = kinds[index]
+            if kind == RELAY and relays is not None:
+                mask, _acknowledged, energized = data['values'][index]
+                relay_start = clock()
+                acknowledged = relays.setPolarity(int(mask)) if energized else relays.allOff()
+                if journal is not None: journal.relay(relay_start, clock(), int(mask), acknowledged, energized)
+            elif kind == PSU:
+                axis = int(data['axis'][index])
+                position = sum(1 for commands in rounds if commands[axis] is not None)
+                if position == len(rounds): rounds.append([None]*len(dispatcher.instruments))
+                rounds[position][axis] = data.textOf(index)
+        for commands in rounds: dispatcher.write(commands)
+    return clock() - start
+
+# Compares the step timing and write durations of two journals of the same run
+def compareTiming(original, replay):
+    steps, start, _deadline = original.steps()
+    replay_steps, replay_start, _replay_deadline = replay.steps()
+    count = min(len(steps), len(replay_steps))
+    drift = (replay_start[:count] - replay_start[0]) - (start[:count] - start[0])
+    spacing = np.diff(replay_start[:count]) - np.diff(start[:count])
+    comparison = {'steps': count,
+        'drift_p50': float(np.percentile(np.abs(drift), 50)) if count else 0.0,
+        'drift_max': float(np.abs(drift).max()) if count else 0.0,
+        'spacing_p99': float(np.percentile(np.abs(spacing), 99)) if count > 1 else 0.0}
+    for name, data in (('original', original), ('replay', replay)):
+        durations = data.writeDurations()
+        comparison[name + '_write_p50'] = float(np.percentile(durations, 50)) if len(durations) else 0.0
+        comparison[name + '_write_p99'] = float(np.percentile(durations, 99)) if len(durations) else 0.0
+    return comparison
+
+def formatComparison(comparison):
+    c = comparison
+    return ('%d steps compared, start drift p50/max %.2f/%.2f ms, step spacing difference p99 %.2f ms, '
+        'write p50/p99 %.2f/%.2f ms original vs %.2f/%.2f ms replay'
+        % (c['steps'], c['drift_p50']*1e3, c['drift_max']*1e3, c['spacing_p99']*1e3,
+        c['original_write_p50']*1e3, c['original_write_p99']*1e3, c['replay_write_p50']*1e3, c['replay_write_p99']*1e3))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarizes a run journal, or replays it and compares the timing.')
+    parser.add_argument('journal')
+    parser.add_argument('--replay', action='store_true', help='send the journal to the instruments again')
+    parser.add_argument('--arduino', default='SIM', help='serial port of the relay Arduino')
+    parser.add_argument('--psu', nargs=3, default=('X', 'Y', 'Z'), metavar=('X', 'Y', 'Z'), help='VISA resources of the x, y and z PSUs')
+    parser.add_argument('--no-relays', action='store_true', help="don't switch the relays")
+    parser.add_argument('--simulate', action='store_true', help='replay against simulated instruments')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated write latency in ms')
+    parser.add_argument('--jitter', type=float, default=0.0, help='simulated write latency standard deviation in ms')
+    parser.add_argument('--output', help='journal of the replay (default <journal>-replay.hhcj)')
+    arguments = parser.parse_args()
+    original = readJournal(arguments.journal)
+    summary = original.summary()
+    print(json.dumps({'meta': original.meta, 'summary': summary}, indent=1))
+    if arguments.replay:
+        from InstrumentConnections import ConnectionManager
+        backend = None
+        if arguments.simulate:
+            from SimulatedInstruments import SimulatedBackend, LatencyModel
+            backend = SimulatedBackend(LatencyModel(arguments.latency/1000, arguments.jitter/1000))
+        connections = ConnectionManager(backend)
+        connections.open(arguments.arduino, arguments.psu)
+        output = arguments.output or os.path.splitext(arguments.journal)[0] + '-replay' + EXTENSION
+        journal = RunJournal(output, {'replay_of': os.path.abspath(arguments.journal)})
+        connections.dispatcher.journal = journal
+        try: replayJournal(original, connections.dispatcher, None if arguments.no_relays else connections.relays, journal)
+        finally:
+            journal.close()
+            connections.dispatcher.broadcast('APPL 0.00,0.00')
+            if not arguments.no_relays: connections.relays.allOff()
+            connections.close()
+        print(formatComparison(compareTiming(original, readJournal(output))))
+    sys.exit(0)
@@ -0,0 +1,230 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Run Queue (RunQueue.py)
+#   Description:            Plays a list of profiles back to back for test campaigns. Each entry is a profile file with
+#                           its offsets, rate of change and unit. The next entry is read, compiled and validated on a
+#                           background thread while the current one plays, and the instruments stay connected.
+#   Inputs/Resources:       A connected CageEngine and the .csv files of the campaign
+#   Output/Created files:   A .json file with the queue and how far it got, rewritten as the campaign runs
+#
+#   Notes:                  Every entry is pending, running, done or failed. After a crash, loading the queue file and
+#                           running it again continues the running entry from the last saved step.
+#                           A completed entry leaves the coils on its last step until the next one starts, so there is
+#                           no gap between profiles. Entries that fail to load or fail validation are skipped.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from HelmholtzCageEngine import convertUnit
+
+QUEUE_VERSION = 1
+SAVE_INTERVAL = 1.0 # How often the playing entry's position is saved (seconds)
+
+#=============================================================================#
+#                                    Entries                                  #
+#=============================================================================#
+
+class QueueEntry:
+
+    # unit is one of the GUI's rate of change units, e.g. 'second(s)'. position is the next step to play.
+    def __init__(self, path, offsets=(0.0, 0.0, 0.0), rate=1.0, unit='second(s)', status='pending', position=0, error=None):
+        if convertUnit(unit) < 0: raise Exception('Incorrect Units')
+        self.path = path
+        self.offsets = tuple(float(offset) for offset in offsets)
+        self.rate = float(rate)
+        self.unit = unit
+        self.status = status
+        self.position = position
+        self.error = error
+
+    # Seconds between steps
+    @property
+    def period(self): return convertUnit(self.unit)*self.rate/1000
+
+    def toDict(self):
+        return {'path': self.path, 'offsets': list(self.offsets), 'rate': self.rate, 'unit': self.unit,
+            'status': self.status, 'position': self.position, 'error': self.error}
+
+    @classmethod
+    def fromDict(cls, values): return cls(**values)
+
+#=============================================================================#
+#                                     Queue                                   #
+#=============================================================================#
+
+class RunQueue:
+
+    # filename is where the queue is saved, None keeps it in memory only
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = []
+        self.lock = threading.Lock()
+
+    # Loads a saved queue, or starts an empty one if the file doesn't exist yet
+    @classmethod
+    def load(cls, filename):
+        queue = cls(filename)
+        try:
+            with open(filename, 'r') as file: saved = json.load(file)
+        except FileNotFoundError: return queue
+        if saved.get('version') != QUEUE_VERSION: raise Exception('Unsupported Queue Version')
+        queue.entries = [QueueEntry.fromDict(values) for values in saved['entries']]
+        return queue
+
+    def add(self, path, offsets=(0.0, 0.0, 0.0), rate=1.0, unit='second(s)'):
+        entry = QueueEntry(os.path.abspath(path), offsets, rate, unit)
+        with self.lock: self.entries.append(entry)
+        self.save()
+        return entry
+
+    def __len__(self): return len(self.entries)
+
+    # Indexes of the entries still to be played, in order
+    def remaining(self): return [index for index, entry in enumerate(self.entries) if entry.status in ('pending', 'running')]
+
+    # Puts every entry back to pending
+    def reset(self):
+        with self.lock:
+            for entry in self.entries:
+                entry.status, entry.position, entry.error = 'pending', 0, None
+        self.save()
+
+    # Writes the queue out, a crash part way through leaves the previous file
+    def save(self):
+        if self.filename is None: return
+        with self.lock: saved = {'version': QUEUE_VERSION, 'entries': [entry.toDict() for entry in self.entries]}
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        os.makedirs(directory, exist_ok=True)
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'w') as file: json.dump(saved, file, indent=1)
+        os.replace(temporary, self.filename)
+
+    def report(self):
+        counts = {}
+        for entry in self.entries: counts[entry.status] = counts.get(entry.status, 0) + 1
+        return ', '.join('%d %s' % (counts[status], status) for status in ('done', 'failed', 'running', 'pending') if status in counts)
+
+#=============================================================================#
+#                                  Queue Runner                               #
+#=============================================================================#
+
+# Plays the remaining entries of a queue on the engine, one after the other. on_entry(index, entry) is called
+# when an entry starts playing, on_state and on_step are passed to each run and on_done() is called once the
+# campaign is over; all of them are called from worker threads.
+# The runner stops at the first run that is stopped or ends in an error, leaving that entry to be resumed.
+class QueueRunner(threading.Thread):
+
+    def __init__(self, engine, queue, lead_in=1.0, debug=False, on_entry=None, on_state=None, on_step=None, on_done=None, clock=time.perf_counter):
+        threading.Thread.__init__(self, name='QueueRunner', daemon=True)
+        self.engine = engine
+        self.queue = queue
+        self.lead_in = lead_in
+        self.debug = debug
+        self.on_entry = on_entry
+        self.on_state = on_state
+        self.on_step = on_step
+        self.on_done = on_done
+        self.clock = clock
+        self.compiler = ThreadPoolExecutor(max_workers=1, thread_name_prefix='QueuePrefetch')
+        self.stop_requested = False
+        self.error = None
+        self.reports = [] # Engine report of each entry played
+        # Busy time is from each entry's first step until it completed, gaps are from one entry completing until the next's first step
+        self.lead_time = 0.0
+        self.first_step = None
+        self.completed = None
+        self.busy_time = 0.0
+        self.gaps = []
+        self.campaign_start = None
+        self.campaign_end = None
+
+    def stop(self):
+        self.stop_requested = True
+        self.engine.stop()
+
+    def prepare(self, entry): return self.engine.prepareProfile(entry.path, entry.offsets, entry.period)
+
+    def run(self):
+        remaining = self.queue.remaining()
+        prefetched = {}
+        held = False
+        try:
+            if remaining: prefetched[remaining[0]] = self.compiler.submit(self.prepare, self.queue.entries[remaining[0]])
+            for number, index in enumerate(remaining):
+                if self.stop_requested: break
+                entry = self.queue.entries[index]
+                try:
+                    reader, profile, validation = prefetched.pop(index).result()
+                    if validation.blocked: raise Exception(validation.summary())
+                except Exception as error:
+                    entry.status, entry.error = 'failed', str(error.args[0]) if error.args else repr(error)
+                    self.queue.save()
+                    if number + 1 < len(remaining): prefetched[remaining[number + 1]] = self.compiler.submit(self.prepare, self.queue.entries[remaining[number + 1]])
+                    continue
+                # The next file is read and compiled while this one plays
+                last = number + 1 == len(remaining)
+                if not last: prefetched[remaining[number + 1]] = self.compiler.submit(self.prepare, self.queue.entries[remaining[number + 1]])
+                if not self.play(index, entry, reader, profile, validation, hold=not last):
+                    held = False
+                    break
+                held = not last
+        except Exception as error: self.error = error
+        finally:
+            self.compiler.shutdown(wait=False)
+            for future in prefetched.values(): future.cancel()
+            # The last entry played held its outputs for one that never came
+            if held:
+                try: self.engine.clearOutputs()
+                except Exception as error: self.error = self.error or error
+            self.campaign_end = self.completed
+            self.queue.save()
+            if self.on_done is not None: self.on_done()
+
+    # Plays one entry, saving its position as it goes. Returns whether it completed.
+    def play(self, index, entry, reader, profile, validation, hold):
+        self.engine.useProfile(reader, profile, entry.offsets, entry.period, validation)
+        self.first_step = None
+        entry.status = 'running'
+        self.queue.save()
+        if self.on_entry is not None: self.on_entry(index, entry)
+        if self.stop_requested: return False
+        self.lead_time = self.lead_in if self.completed is None else 0.0
+        worker = self.engine.start(entry.period, on_step=self.on_step, on_state=self.stateChanged,
+            lead_in=self.lead_time, debug=self.debug, first_step=min(entry.position, len(profile) - 1), hold=hold)
+        while worker.is_alive():
+            worker.join(SAVE_INTERVAL)
+            entry.position = worker.index
+            self.queue.save()
+        self.reports.append(self.engine.report())
+        if worker.state != 'complete':
+            if worker.error is not None: entry.error = str(worker.error.args[0]) if worker.error.args else repr(worker.error)
+            return False
+        entry.status, entry.position = 'done', 0
+        self.queue.save()
+        return True
+
+    # Runs on the playback worker thread. A run is 'running' from the start of its lead in.
+    def stateChanged(self, state):
+        if state == 'running' and self.first_step is None:
+            self.first_step = self.clock() + self.lead_time
+            if self.campaign_start is None: self.campaign_start = self.first_step
+            if self.completed is not None: self.gaps.append(self.first_step - self.completed)
+        elif state == 'complete':
+            self.completed = self.clock()
+            if self.first_step is not None: self.busy_time += self.completed - self.first_step
+        if self.on_state is not None: self.on_state(state)
+
+    # Share of the campaign the coils were playing a profile, from its first step to its last entry completing
+    def utilization(self):
+        if self.campaign_start is None or self.campaign_end is None or self.campaign_end <= self.campaign_start: return 0.0
+        return self.busy_time/(self.campaign_end - self.campaign_start)
+
+    def report(self):
+        report = 'queue %s, %.1f%% utilization' % (self.queue.report(), self.utilization()*100)
+        if self.gaps: report += ', transitions max %.1f ms' % (max(self.gaps)*1e3)
+        return report
@@ -0,0 +1,248 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              STK Export (STKExport.py)
+#   Description:            Pulls the magnetic field along a satellite's orbit from STK, or from a dipole model when
+#                           STK isn't available, and writes it straight into a compiled profile the controller maps.
+#                           The scenario is fetched in time windows that are compiled and written as they arrive.
+#   Inputs/Resources:       An open STK 11 scenario with the satellites, or nothing for the dipole model
+#   Output/Created files:   <Scenario>_<Satellite>_MagFieldData.hhcp, and the .csv next to it if asked for
+#
+#   Notes:                  Written by Gavin Brown - gavinb11@vt.edu, moved out of STKMagGeneration so it can be
+#                           benchmarked without STK.
+#                           python STKExport.py --satellite Sat1 Sat2 --step 10 --csv
+#                           python STKExport.py --dipole --duration 86400 --step 1 (synthetic, no STK needed)
+#                           Windows are fetched on a second thread while the last one is written. Several satellites
+#                           are exported in parallel; STK answers one request at a time, so its calls are serialized
+#                           and only the compiling and writing overlap.
+#                           STK's date unit is switched to EpSec for each request so the windows can be worked out
+#                           in seconds, and put back straight after.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import os
+import csv
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from ProfileCache import CompiledProfileWriter, EXTENSION
+from CageProfile import DEFAULT_VOLTAGE, COIL_CONSTANTS
+
+#rowColumnTitle = ['Mag x (nT)', 'Mag y (nT)', 'Mag z (nT)']
+COLUMN_TITLES = ['x (nT)', 'y (nT)', 'z (nT)']
+WINDOW_ROWS = 100000 # Samples fetched from the provider at a time
+STK_APPLICATION = "STK11.Application"
+MAG_FIELD_PATH = "Vectors(VNC)//MagField(WMM)"
+
+# Dipole model
+EARTH_RADIUS = 6371.2e3     # m
+EARTH_MU = 3.986004418e14   # m^3/s^2
+EARTH_RATE = 7.2921159e-5   # rad/s
+DIPOLE_FIELD = 29404.8      # Field at the equator on the surface (nT)
+DIPOLE_TILT = 9.4           # Degrees between the dipole and the rotation axis
+
+# Exporting Magnetic Field Data to a CSV File
+def writeMagFieldCSV(csvFileName, magx, magy, magz):
+    with open(csvFileName, "w", newline='') as csvfile:
+        filewriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        filewriter.writerow(COLUMN_TITLES)
+        for i, value in enumerate(magx):
+            magxcurr = magx[i]
+            magycurr = magy[i]
+            magzcurr = magz[i]
+            rowcurr = [str(magxcurr), str(magycurr), str(magzcurr)]
+            filewriter.writerow(rowcurr)
+    return csvFileName
+
+#=============================================================================#
+#                                   Providers                                 #
+#=============================================================================#
+
+# Where the field samples come from. Times are seconds, the field is x, y, z in the VNC frame (nT).
+class FieldDataProvider(ABC):
+
+    # First and last time of the scenario
+    @abstractmethod
+    def span(self): pass
+
+    # (rows, 3) samples at start, start + step, ... Fewer rows are returned if the scenario ends first.
+    @abstractmethod
+    def window(self, start, rows, step): pass
+
+    # Output file name without the extension
+    @abstractmethod
+    def outputName(self): pass
+
+    def close(self): pass
+
+# Fetches the field from the satellite in the open STK scenario. Each thread connects on its own.
+class STKProvider(FieldDataProvider):
+
+    lock = threading.Lock() # STK handles one request at a time
+
+    def __init__(self, satellite, application=STK_APPLICATION):
+        self.satellite = satellite
+        self.application = application
+        self.local = threading.local()
+
+    # Getting the open STK scenario and the satellite's magnetic field data provider
+    def connect(self):
+        if getattr(self.local, 'provider', None) is not None: return self.local
+        import comtypes
+        from comtypes.client import GetActiveObject
+        comtypes.CoInitialize()
+        app = GetActiveObject(self.application)
+        app.Visible = True
+        app.UserControl = True
+        root = app.Personality2
+        from comtypes.gen import STKObjects
+        sc = root.CurrentScenario
+        self.local.root = root
+        self.local.scenario = sc.QueryInterface(STKObjects.IAgScenario)
+        self.local.name = sc.InstanceName
+        sat = sc.Children.Item(self.satellite)
+        self.local.provider = sat.DataProviders.GetDataPrvTimeVarFromPath(MAG_FIELD_PATH)
+        return self.local
+
+    # Runs function(connection) with STK's dates in EpSec, putting the user's unit back afterwards
+    def call(self, function):
+        with self.lock:
+            local = self.connect()
+            units = local.root.UnitPreferences
+            previous = units.GetCurrentUnitAbbrv('DateFormat')
+            units.SetCurrentUnit('DateFormat', 'EpSec')
+            try: return function(local)
+            finally: units.SetCurrentUnit('DateFormat', previous)
+
+    def span(self):
+        def span(local):
+            local.root.Rewind()
+            return float(local.scenario.StartTime), float(local.scenario.StopTime)
+        return self.call(span)
+
+    def window(self, start, rows, step):
+        results = self.call(lambda local: local.provider.ExecElements(start, start + (rows - 1)*step, step, ['x', 'y', 'z']))
+        with self.lock: columns = [np.asarray(results.DataSets.Item(axis).GetValues(), dtype=np.float64) for axis in range(3)]
+        length = min(rows, *(len(column) for column in columns))
+        return np.column_stack([column[:length] for column in columns])
+
+    def outputName(self):
+        with self.lock: return self.connect().name + '_' + self.satellite + '_MagFieldData'
+
+# Field of a tilted dipole rotating with the Earth, seen from a circular orbit. For trying the export and
+# the controller without STK; the shape is right but it is no substitute for WMM.
+class DipoleProvider(FieldDataProvider):
+
+    def __init__(self, name='Dipole', duration=86400.0, altitude=420e3, inclination=51.6, raan=0.0):
+        self.name = name
+        self.duration = duration
+        self.radius = EARTH_RADIUS + altitude
+        self.inclination = np.radians(inclination)
+        self.raan = np.radians(raan)
+        self.motion = np.sqrt(EARTH_MU/self.radius**3)
+
+    def span(self): return 0.0, self.duration
+
+    def window(self, start, rows, step):
+        rows = max(0, min(rows, int(np.floor((self.duration - start)/step + 1e-9)) + 1))
+        t = start + step*np.arange(rows)
+        # Position and velocity directions in an inertial frame
+        u = self.motion*t
+        cos_u, sin_u = np.cos(u), np.sin(u)
+        ci, si, cr, sr = np.cos(self.inclination), np.sin(self.inclination), np.cos(self.raan), np.sin(self.raan)
+        position = np.column_stack([cr*cos_u - sr*ci*sin_u, sr*cos_u + cr*ci*sin_u, si*sin_u])
+        velocity = np.column_stack([-cr*sin_u - sr*ci*cos_u, -sr*sin_u + cr*ci*cos_u, si*cos_u])
+        normal = np.array([sr*si, -cr*si, ci])
+        # The dipole points to the southern hemisphere and turns with the Earth
+        tilt = np.radians(DIPOLE_TILT)
+        spin = EARTH_RATE*t
+        moment = -np.column_stack([np.sin(tilt)*np.cos(spin), np.sin(tilt)*np.sin(spin), np.full(rows, np.cos(tilt))])
+        along = np.einsum('ij,ij->i', moment, position)[:, None]
+        field = DIPOLE_FIELD*(EARTH_RADIUS/self.radius)**3*(3*along*position - moment)
+        conormal = np.cross(velocity, normal)
+        return np.column_stack([np.einsum('ij,ij->i', field, velocity), field @ normal, np.einsum('ij,ij->i', field, conormal)])
+
+    def outputName(self): return self.name + '_MagFieldData'
+
+#=============================================================================#
+#                                    Export                                   #
+#=============================================================================#
+
+# Appends the samples to a .csv the controller can read, a window at a time
+class CSVWriter:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'w', newline='')
+        self.file.write(','.join(COLUMN_TITLES) + '\n')
+
+    def write(self, chunk): np.savetxt(self.file, chunk, fmt='%.12g', delimiter=',')
+
+    def close(self):
+        self.file.close()
+        return self.filename
+
+# Exports a provider's field every step seconds into directory. The next window is fetched while the last one
+# is compiled and written. offsets, voltage and coil_constants are compiled in like CageProfile.compile.
+# progress(rows, total) is called after every window. Returns the compiled profile's file name.
+def exportField(provider, step, directory='.', csv_file=False, offsets=(0, 0, 0), voltage=DEFAULT_VOLTAGE,
+        coil_constants=COIL_CONSTANTS, window_rows=WINDOW_ROWS, progress=None):
+    if step <= 0: raise Exception('Incorrect Step Size')
+    start, stop = provider.span()
+    total = int(np.floor((stop - start)/step + 1e-9)) + 1
+    name = os.path.join(directory, provider.outputName())
+    meta = {'source': 'STKExport', 'provider': type(provider).__name__, 'start': start, 'step': step}
+    writer = CompiledProfileWriter(name + EXTENSION, total, offsets, voltage, coil_constants, meta)
+    side = CSVWriter(name + '.csv') if csv_file else None
+    fetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='STKFetch')
+    try:
+        fetch = lambda first: provider.window(start + first*step, min(window_rows, total - first), step)
+        pending = fetcher.submit(fetch, 0)
+        for first in range(0, total, window_rows):
+            chunk = pending.result()
+            if first + window_rows < total: pending = fetcher.submit(fetch, first + window_rows)
+            writer.write(chunk)
+            if side is not None: side.write(chunk)
+            if progress is not None: progress(writer.rows, total)
+            if len(chunk) < min(window_rows, total - first): break
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        fetcher.shutdown(wait=True)
+        if side is not None: side.close()
+        provider.close()
+    return writer.close()
+
+# Exports several providers at once. Returns their compiled profiles' file names in the same order.
+def exportSatellites(providers, step, directory='.', workers=None, **options):
+    with ThreadPoolExecutor(max_workers=workers or len(providers) or 1, thread_name_prefix='STKExport') as pool:
+        futures = [pool.submit(exportField, provider, step, directory, **options) for provider in providers]
+        return [future.result() for future in futures]
+
+#=============================================================================#
+#                                 Command Line                                #
+#=============================================================================#
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description='Exports the magnetic field along satellite orbits to compiled profiles.')
+    parser.add_argument('--satellite', nargs='+', default=[], help='names of the satellites in the open STK scenario')
+    parser.add_argument('--dipole', action='store_true', help='use the dipole model instead of STK')
+    parser.add_argument('--duration', type=float, default=86400.0, help='length of the dipole model run in seconds')
+    parser.add_argument('--step', type=float, required=True, help='seconds between samples')
+    parser.add_argument('--output-dir', default='.', help='directory the files are written to')
+    parser.add_argument('--csv', action='store_true', help='write a .csv next to every compiled profile')
+    parser.add_argument('--offsets', nargs=3, type=float, default=(0.0, 0.0, 0.0), metavar=('X', 'Y', 'Z'), help='field offsets in nT')
+    parser.add_argument('--voltage', type=float, default=DEFAULT_VOLTAGE, help='PSU voltage limit')
+    arguments = parser.parse_args()
+    if arguments.dipole: providers = [DipoleProvider(name, arguments.duration) for name in (arguments.satellite or ['Dipole'])]
+    else: providers = [STKProvider(name) for name in arguments.satellite]
+    if not providers: parser.error('give --satellite or --dipole')
+    start = time.perf_counter()
+    for filename in exportSatellites(providers, arguments.step, arguments.output_dir, csv_file=arguments.csv,
+            offsets=arguments.offsets, voltage=arguments.voltage):
+        print(filename)
+    print('exported in %.2f s' % (time.perf_counter() - start))
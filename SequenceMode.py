@@ -0,0 +1,161 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Sequence Mode (SequenceMode.py)
+#   Description:            Hardware timed execution. Windows of the profile are uploaded into the PSUs' list memory
+#                           and triggered on all three together, so the step timing comes from the instruments
+#                           instead of the PC. Anything that can't be expressed as a list is streamed step by step.
+#   Inputs/Resources:       A compiled CageProfile, a PSUDispatcher and the per-step streaming function
+#   Output/Created files:   List uploads and triggers for the three PSUs
+#
+#   Notes:                  A window never spans a polarity change since the relays can't be switched by the PSUs.
+#                           The list carries current magnitudes, the sign is set by the relays before the trigger.
+#                           The next window's commands are built on a background thread while the current one plays,
+#                           but the upload itself can't be: the 2260B has a single list, and rewriting it while it
+#                           plays changes the points being played. So the list isn't double buffered on the PSUs; the
+#                           coils hold the last point of a window while the next one is uploaded and triggered, and
+#                           that gap is measured for every window boundary (report(), helmholtz_sequence_gap_seconds).
+#                           The command templates are in LIST_COMMANDS so they can be matched to the PSU firmware.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from Instrumentation import Histogram
+
+# SCPI list subsystem commands. {voltages}, {currents} and {dwell} are filled in per window.
+LIST_COMMANDS = {
+    'upload': 'LIST:VOLT {voltages};:LIST:CURR {currents};:LIST:DWEL {dwell};:LIST:COUN 1;'
+        ':VOLT:MODE LIST;:CURR:MODE LIST;:TRIG:SOUR BUS;:INIT',
+    'trigger': '*TRG',
+    'abort': 'ABOR;:VOLT:MODE FIX;:CURR:MODE FIX',
+}
+
+#=============================================================================#
+#                               Sequence Limits                               #
+#=============================================================================#
+
+class SequenceLimits:
+
+    # max_points    list memory per PSU
+    # min_dwell     shortest time a list point can be held (seconds)
+    # resolution    dwell times must be a multiple of this (seconds)
+    # min_points    windows shorter than this are streamed, an upload isn't worth it
+    def __init__(self, max_points=512, min_dwell=0.01, resolution=0.001, min_points=4):
+        self.max_points = max_points
+        self.min_dwell = min_dwell
+        self.resolution = resolution
+        self.min_points = min_points
+
+    # Whether a step period can be played from list memory at all
+    def supportsPeriod(self, period):
+        if period < self.min_dwell: return False
+        ticks = period/self.resolution
+        return abs(ticks - round(ticks)) < 1e-6
+
+#=============================================================================#
+#                               Window Planning                               #
+#=============================================================================#
+
+# Returns the end (exclusive) of the list window starting at a step: at most max_points long and
+# never crossing a polarity change
+def windowEnd(profile, start, limits):
+    stop = min(len(profile), start + limits.max_points)
+    polarity = profile.polarity[start:stop]
+    changes = np.flatnonzero(polarity != polarity[0])
+    return start + int(changes[0]) if len(changes) else stop
+
+# Builds the upload command of one axis for steps start..stop-1
+def compileWindow(profile, start, stop, period, axis):
+    currents = np.abs(profile.currents[start:stop, axis])
+    return LIST_COMMANDS['upload'].format(
+        voltages=','.join([profile.voltage_text]*(stop - start)),
+        currents=','.join(['%.2f' % value for value in currents]),
+        dwell='%g' % period)
+
+#=============================================================================#
+#                               Sequence Player                               #
+#=============================================================================#
+
+class SequencePlayer:
+
+    # stream_step(index) plays one step the normal way and set_polarity(mask) switches the relays.
+    # invalidate() is called whenever the PSUs' setpoints change behind the streaming path's back.
+    # playStep is meant to be given to PlaybackWorker in place of stream_step.
+    # gap_timer is an Instrumentation.Histogram the window boundary gaps are also observed into.
+    def __init__(self, profile, period, psu, stream_step, set_polarity, limits=None, invalidate=None, gap_timer=None):
+        self.profile = profile
+        self.period = period
+        self.psu = psu
+        self.stream_step = stream_step
+        self.set_polarity = set_polarity
+        self.limits = limits or SequenceLimits()
+        self.invalidate = invalidate
+        self.enabled = self.limits.supportsPeriod(period)
+        self.list_active = False
+        self.compiler = ThreadPoolExecutor(max_workers=1, thread_name_prefix='SequenceCompiler')
+        self.prepared = {} # Window start -> future of (stop, commands)
+        self.windows = 0
+        self.streamed = 0
+        self.upload_time = 0.0
+        self.gaps = Histogram('helmholtz_sequence_gap_seconds') # Relays, upload and trigger of each window, while the coils hold the last one
+        self.max_gap = 0.0
+        self.gap_timer = gap_timer
+
+    # Builds the commands of the window starting at a step
+    def prepare(self, start):
+        stop = windowEnd(self.profile, start, self.limits)
+        if stop - start < self.limits.min_points: return stop, None
+        return stop, [compileWindow(self.profile, start, stop, self.period, axis) for axis in range(3)]
+
+    # Starts building a window in the background
+    def prefetch(self, start):
+        if self.enabled and start < len(self.profile) and start not in self.prepared:
+            self.prepared[start] = self.compiler.submit(self.prepare, start)
+
+    # Plays the step at index. Returns the index of the next step the worker should wait for.
+    def playStep(self, index):
+        if not self.enabled: return self.streamStep(index)
+        future = self.prepared.pop(index, None)
+        stop, commands = future.result() if future is not None else self.prepare(index)
+        self.prepared.clear()
+        if commands is None: return self.streamStep(index)
+        start = time.perf_counter()
+        # Relays first, then every PSU gets its list and all three are triggered together
+        self.set_polarity(int(self.profile.polarity[index]))
+        self.psu.write(commands)
+        self.psu.broadcast(LIST_COMMANDS['trigger'])
+        gap = time.perf_counter() - start
+        self.upload_time += gap
+        self.gaps.observe(gap)
+        if self.gap_timer is not None: self.gap_timer.observe(gap)
+        self.max_gap = max(self.max_gap, gap)
+        self.list_active = True
+        if self.invalidate is not None: self.invalidate()
+        self.windows += 1
+        self.prefetch(stop)
+        return stop
+
+    def streamStep(self, index):
+        if self.list_active: self.abort()
+        self.stream_step(index)
+        self.streamed += 1
+        self.prefetch(index + 1)
+        return index + 1
+
+    # Stops any list that is playing and puts the PSUs back into fixed mode
+    def abort(self):
+        self.psu.broadcast(LIST_COMMANDS['abort'])
+        self.list_active = False
+        if self.invalidate is not None: self.invalidate()
+
+    def shutdown(self): self.compiler.shutdown(wait=False)
+
+    def report(self):
+        report = ('%d list windows, %d streamed steps, %.1f ms uploading'
+            % (self.windows, self.streamed, self.upload_time*1000))
+        # The quantiles are bucket bounds, capped at the largest gap seen
+        if self.windows: report += (', window gap p50/p99/max %.2f/%.2f/%.2f ms'
+            % (min(self.gaps.quantile(0.5), self.max_gap)*1000, min(self.gaps.quantile(0.99), self.max_gap)*1000, self.max_gap*1000))
+        return report
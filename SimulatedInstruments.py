@@ -0,0 +1,522 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Simulated Instruments (SimulatedInstruments.py)
+#   Description:            Stand-ins for the Keithley 2260B PSUs and the relay Arduino so the playback path can be
+#                           exercised and load tested without hardware. Parses the SCPI subset the controller sends
+#                           and the relay protocol, and records the latest RECEIVED_LOG commands received.
+#   Inputs/Resources:       SCPI command strings, relay frame bytes
+#   Output/Created files:   A log of (time, command) per instrument and the modelled coil currents
+#
+#   Notes:                  List memory is limited like on the real supplies: uploading more points than fit
+#                           puts error -223 "Too much data" in the error queue and leaves the list unchanged.
+#                           SimulatedBackend plugs in where visa.ResourceManager and serial.serial_for_url are
+#                           used (CageEngine(backend=...)). Write latency, jitter and timeouts come from a
+#                           LatencyModel, the measured current follows the coil's L/R time constant.
+#                           SimulatedMagnetometer streams the field the simulated coils make plus ambient field,
+#                           drift and noise, in the "x,y,z" line format Magnetometer.py reads.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import time
+import math
+import random
+import threading
+from collections import deque
+from CageProfile import CAGE_CONSTANT, COIL_CONSTANTS, COIL_TURNS
+
+# Long SCPI keywords and their short forms, both are accepted in any case
+KEYWORDS = {
+    'ABORT': 'ABOR', 'SYSTEM': 'SYST', 'PRESET': 'PRES', 'DISPLAY': 'DISP', 'OUTPUT': 'OUTP', 'STATE': 'STAT',
+    'APPLY': 'APPL', 'MEASURE': 'MEAS', 'CURRENT': 'CURR', 'VOLTAGE': 'VOLT', 'DWELL': 'DWEL', 'COUNT': 'COUN',
+    'TRIGGER': 'TRIG', 'SOURCE': 'SOUR', 'INITIATE': 'INIT', 'ERROR': 'ERR', 'SCALAR': 'SCAL', 'IMMEDIATE': 'IMM',
+}
+
+DEFAULT_LIST_MEMORY = 512
+
+# Entries of the received log each instrument keeps, the oldest are dropped so a long load test doesn't grow the memory
+RECEIVED_LOG = 100000
+
+# Rough figures for one cage coil, used by CoilModel
+COIL_RESISTANCE = 6.0   # ohms
+COIL_INDUCTANCE = 0.05  # henries
+
+# Raised when a simulated write or query times out, like a VISA timeout error
+class SimulatedTimeout(IOError): pass
+
+# Returns the short upper case form of a command header such as 'DISPlay:MENU:NAME' -> 'DISP:MENU:NAME'
+def shortHeader(nodes):
+    short = []
+    for node in nodes:
+        node = node.upper()
+        query = node.endswith('?')
+        if query: node = node[:-1]
+        for long_form, short_form in KEYWORDS.items():
+            if node == long_form or node == short_form:
+                node = short_form
+                break
+        short.append(node + '?' if query else node)
+    return ':'.join(short)
+
+# Splits a message into (header, arguments) pairs, resolving relative headers after ';' like an instrument does
+def parseMessage(message):
+    commands = []
+    prefix = []
+    for part in message.split(';'):
+        part = part.strip()
+        if not part: continue
+        header, _space, arguments = part.partition(' ')
+        if header.startswith('*'):
+            commands.append((header.upper(), arguments.strip()))
+            continue
+        if header.startswith(':'): nodes = header[1:].split(':')
+        else: nodes = prefix + header.split(':')
+        prefix = nodes[:-1]
+        commands.append((shortHeader(nodes), arguments.strip()))
+    return commands
+
+#=============================================================================#
+#                                    Models                                   #
+#=============================================================================#
+
+class LatencyModel:
+
+    # latency       mean time a write takes to reach the instrument (seconds)
+    # jitter        standard deviation of that time (seconds)
+    # timeout_rate  fraction of writes that are lost and time out
+    # timeout       how long a lost write blocks before the timeout is raised (seconds)
+    def __init__(self, latency=0.0, jitter=0.0, timeout_rate=0.0, timeout=0.5, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.lock = threading.Lock() # Shared between the dispatcher's threads
+
+    def delay(self):
+        if self.jitter <= 0: return self.latency
+        with self.lock: return max(0.0, self.random.gauss(self.latency, self.jitter))
+
+    def timedOut(self):
+        if self.timeout_rate <= 0: return False
+        with self.lock: return self.random.random() < self.timeout_rate
+
+    # Blocks like the transfer would, raises SimulatedTimeout if the message is lost
+    def transfer(self):
+        if self.timedOut():
+            time.sleep(self.timeout)
+            raise SimulatedTimeout('Timeout expired before operation completed')
+        delay = self.delay()
+        if delay > 0: time.sleep(delay)
+
+# First order response of a coil driven by a current limited supply
+class CoilModel:
+
+    def __init__(self, resistance=COIL_RESISTANCE, inductance=COIL_INDUCTANCE):
+        self.resistance = resistance
+        self.inductance = inductance
+        self.tau = inductance/resistance if resistance > 0 else 0.0
+
+    # Current the supply can actually drive: the setpoint, unless the voltage limit is reached first
+    def target(self, voltage, current):
+        if self.resistance <= 0: return current
+        limit = abs(voltage)/self.resistance
+        return max(-limit, min(limit, current))
+
+    # Coil current dt seconds after a step from current to target
+    def respond(self, current, target, dt):
+        if self.tau <= 0: return target
+        if dt <= 0: return current
+        return target + (current - target)*math.exp(-dt/self.tau)
+
+    # Terminal voltage at a coil current on the way to target
+    def voltage(self, current, target):
+        return self.resistance*current + self.inductance*((target - current)/self.tau if self.tau > 0 else 0.0)
+
+#=============================================================================#
+#                              Simulated Keithley                             #
+#=============================================================================#
+
+class SimulatedKeithley:
+
+    def __init__(self, name='2260B', list_memory=DEFAULT_LIST_MEMORY, clock=time.perf_counter, latency=None, coil=None):
+        self.name = name
+        self.list_memory = list_memory
+        self.clock = clock
+        self.latency = latency or LatencyModel()
+        self.coil = coil or CoilModel()
+        self.lock = threading.Lock()
+        self.received = deque(maxlen=RECEIVED_LOG)  # (time, message) of the latest writes and queries
+        self.errors = []    # SCPI error queue
+        self.closed = False
+        self.timeout = 2000 # VISA session timeout in milliseconds, kept for compatibility
+        self.coil_current = 0.0
+        self.coil_target = 0.0
+        self.coil_time = clock()
+        self.preset()
+
+    def preset(self):
+        self.output = False
+        self.voltage = 0.0
+        self.current = 0.0
+        self.mode = 'FIX'
+        self.list_voltages = []
+        self.list_currents = []
+        self.list_dwell = 0.0
+        self.list_count = 1
+        self.trigger_source = 'IMM'
+        self.initiated = False
+        self.list_start = None
+        self.triggers = 0
+
+    def error(self, code, text): self.errors.append('%d,"%s"' % (code, text))
+
+    # Reads a comma separated list of numbers
+    @staticmethod
+    def numbers(arguments): return [float(value) for value in arguments.split(',') if value.strip()]
+
+    def write(self, message):
+        if self.closed: raise IOError('Session closed')
+        self.latency.transfer()
+        now = self.clock()
+        with self.lock:
+            self.received.append((now, message))
+            self.settle(now)
+            for header, arguments in parseMessage(message): self.execute(header, arguments, now)
+            self.settle(now)
+        return len(message)
+
+    def query(self, message):
+        if self.closed: raise IOError('Session closed')
+        self.latency.transfer()
+        now = self.clock()
+        with self.lock:
+            self.received.append((now, message))
+            replies = []
+            for header, arguments in parseMessage(message):
+                if header.endswith('?'): replies.append(self.answer(header[:-1], now))
+                else: self.execute(header, arguments, now)
+            return ';'.join(replies)
+
+    def close(self): self.closed = True
+
+    # Carries out one command
+    def execute(self, header, arguments, now):
+        try:
+            if header == 'APPL':
+                values = self.numbers(arguments)
+                self.voltage, self.current = values[0], values[1]
+            elif header == 'ABOR':
+                self.initiated = False
+                self.list_start = None
+            elif header == 'SYST:PRES' or header == '*RST': self.preset()
+            elif header == 'OUTP:STAT' or header == 'OUTP': self.output = arguments.upper() in ('ON', '1')
+            elif header.endswith('DISP:MENU:NAME'): pass # Relative to SYST: in Connect's compound command
+            elif header == 'VOLT' or header == 'VOLT:LEV': self.voltage = float(arguments)
+            elif header == 'CURR' or header == 'CURR:LEV': self.current = float(arguments)
+            elif header in ('LIST:VOLT', 'LIST:CURR'):
+                values = self.numbers(arguments)
+                if len(values) > self.list_memory:
+                    self.error(-223, 'Too much data')
+                    return
+                if header == 'LIST:VOLT': self.list_voltages = values
+                else: self.list_currents = values
+            elif header == 'LIST:DWEL': self.list_dwell = float(arguments)
+            elif header == 'LIST:COUN': self.list_count = int(float(arguments))
+            elif header in ('VOLT:MODE', 'CURR:MODE'): self.mode = arguments.upper()[0:4]
+            elif header == 'TRIG:SOUR': self.trigger_source = arguments.upper()[0:3]
+            elif header == 'INIT' or header == 'INIT:IMM':
+                if self.mode == 'LIST' and len(self.list_currents) != len(self.list_voltages): self.error(-221, 'Settings conflict')
+                else:
+                    self.initiated = True
+                    if self.trigger_source == 'IMM': self.list_start = now
+            elif header == '*TRG':
+                if self.initiated and self.mode == 'LIST':
+                    self.list_start = now
+                    self.triggers += 1
+            elif header == '*CLS': self.errors = []
+            else: self.error(-113, 'Undefined header')
+        except (ValueError, IndexError): self.error(-104, 'Data type error')
+
+    # Answers one query
+    def answer(self, header, now):
+        if header == '*IDN': return 'Simulated,' + self.name + ',0,1.0'
+        if header == '*OPC': return '1'
+        if header == 'SYST:ERR': return self.errors.pop(0) if self.errors else '0,"No error"'
+        current = self.settle(now)
+        voltage = self.coil.voltage(current, self.coil_target) if self.output else 0.0
+        if header == 'MEAS:CURR' or header == 'MEAS:SCAL:CURR': return '%.4f' % current
+        if header == 'MEAS:VOLT' or header == 'MEAS:SCAL:VOLT': return '%.4f' % voltage
+        if header == 'OUTP:STAT' or header == 'OUTP': return '1' if self.output else '0'
+        self.error(-113, 'Undefined header')
+        return ''
+
+    # Voltage and current the PSU is set to at a given time, following the list if one is playing
+    def setpoint(self, now=None):
+        if now is None: now = self.clock()
+        if self.mode == 'LIST' and self.list_start is not None and self.list_currents and self.list_dwell > 0:
+            index = min(int((now - self.list_start)/self.list_dwell), len(self.list_currents)*self.list_count - 1)
+            index %= len(self.list_currents)
+            return self.list_voltages[index], self.list_currents[index]
+        return self.voltage, self.current
+
+    # Coil current right now, for models reading the instrument from outside
+    def coilCurrent(self, now=None):
+        if now is None: now = self.clock()
+        with self.lock: return self.settle(now)
+
+    # When the setpoint last changed on its own, which only happens while a list is playing
+    def listStepTime(self, now):
+        if self.mode == 'LIST' and self.list_start is not None and self.list_dwell > 0:
+            steps = min(int((now - self.list_start)/self.list_dwell), len(self.list_currents)*self.list_count - 1)
+            return max(self.coil_time, self.list_start + steps*self.list_dwell)
+        return now
+
+    # Brings the coil current up to date and returns it. Called before every command so a new setpoint
+    # starts from wherever the coil had got to.
+    def settle(self, now):
+        voltage, current = self.setpoint(now)
+        target = self.coil.target(voltage, current) if self.output else 0.0
+        if target != self.coil_target:
+            changed = self.listStepTime(now)
+            self.coil_current = self.coil.respond(self.coil_current, self.coil_target, changed - self.coil_time)
+            self.coil_time = changed
+            self.coil_target = target
+        return self.coil.respond(self.coil_current, self.coil_target, now - self.coil_time)
+
+#=============================================================================#
+#                              Simulated Arduino                              #
+#=============================================================================#
+
+# Relay controller running ArduinoRelayController.ino behind a pyserial style port. firmware='legacy' models
+# the old sketch that only knows 'f'..'l' at 9600 baud.
+class SimulatedArduino:
+
+    def __init__(self, port='SIM', firmware='frame', settle=0.010, latency=None, boot_time=0.0, clock=time.perf_counter):
+        self.port = port
+        self.firmware = firmware
+        self.baud = 9600 if firmware == 'legacy' else 115200 # RELAY_BAUD
+        self.settle_time = settle
+        self.latency = latency or LatencyModel()
+        self.boot_time = boot_time
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.received = deque(maxlen=RECEIVED_LOG)  # (time, byte) of the latest bytes written
+        self.relays = [None]*3 # Sign per axis, 0 positive, 1 negative, None off
+        self.last_state = -1
+        self.pending = []   # (time the byte can be read, byte)
+        self.busy_until = 0.0
+        self.is_open = False
+        self.baudrate = self.baud
+        self.timeout = None
+        self.booted = 0.0
+        self.drop_acks = 0  # Number of the next acknowledgements lost on the wire, the relays still switch
+
+    # Opens the port, which resets the board like a real Arduino. Like a COM port it can only be open once.
+    def open(self, baudrate=9600, timeout=None):
+        with self.lock:
+            if self.is_open: raise IOError('Port already open')
+            self.baudrate = baudrate
+            self.timeout = timeout
+            self.pending = []
+            self.is_open = True
+            self.booted = self.clock() + self.boot_time
+            self.busy_until = self.booted
+        return self
+
+    def close(self): self.is_open = False
+
+    def reset_input_buffer(self):
+        with self.lock: self.pending = [(ready, byte) for ready, byte in self.pending if ready > self.clock()]
+
+    def flush(self): pass
+
+    @property
+    def in_waiting(self):
+        now = self.clock()
+        with self.lock: return sum(1 for ready, _byte in self.pending if ready <= now)
+
+    # Time one byte takes on the wire
+    def byteTime(self): return 10.0/self.baudrate
+
+    def write(self, data):
+        if not self.is_open: raise IOError('Port not open')
+        self.latency.transfer()
+        now = self.clock()
+        with self.lock:
+            for byte in bytes(data):
+                self.received.append((now, byte))
+                arrival = now + self.byteTime()
+                # Bytes at the wrong baud rate or before the sketch is running are garbage to the firmware
+                if self.baudrate != self.baud or arrival < self.booted: continue
+                self.busy_until = max(self.busy_until, arrival)
+                self.handle(byte)
+        return len(data)
+
+    # Runs one byte through the firmware's loop()
+    def handle(self, byte):
+        if byte & 0x80:
+            if self.firmware == 'legacy': return
+            state = byte & 0x47
+            if state != self.last_state:
+                self.relays = [(byte >> axis) & 1 for axis in range(3)] if byte & 0x40 else [None]*3
+                self.last_state = state
+                self.busy_until += self.settle_time
+            if self.drop_acks:
+                self.drop_acks -= 1
+                return
+            self.pending.append((self.busy_until + self.byteTime(), byte))
+            return
+        self.last_state = -1
+        command = chr(byte)
+        if 'f' <= command <= 'k':
+            value = ord(command) - ord('f')
+            self.relays[value//2] = value % 2
+        elif command == 'l': self.relays = [None]*3
+
+    # Reads like pyserial: waits up to the port timeout for size bytes
+    def read(self, size=1):
+        end = None if self.timeout is None else self.clock() + self.timeout
+        data = bytearray()
+        while len(data) < size:
+            now = self.clock()
+            with self.lock:
+                while self.pending and self.pending[0][0] <= now and len(data) < size:
+                    data.append(self.pending.pop(0)[1])
+                next_ready = self.pending[0][0] if self.pending else None
+            if len(data) >= size: break
+            if end is not None and now >= end: break
+            wait = 0.001 if next_ready is None else next_ready - now
+            if end is not None: wait = min(wait, end - now)
+            if wait > 0: time.sleep(wait)
+        return bytes(data)
+
+    # Polarity mask the relays are in, None if any axis is off
+    def mask(self):
+        if None in self.relays: return None
+        return sum(sign << axis for axis, sign in enumerate(self.relays))
+
+#=============================================================================#
+#                            Simulated Magnetometer                           #
+#=============================================================================#
+
+# Magnetometer in the middle of the cage. coils are the x, y, z SimulatedKeithleys and relay the SimulatedArduino
+# that sets their direction. ambient is the field with the coils off and drift how fast it changes (nT, nT/s).
+# coupling is a 3x3 matrix of nT per amp where coil j also makes a field on the other axes, for calibration sweeps.
+class SimulatedMagnetometer:
+
+    def __init__(self, coils, relay, ambient=(0.0, 0.0, 0.0), drift=(0.0, 0.0, 0.0), noise=5.0, rate=100.0,
+            coil_constants=COIL_CONSTANTS, coupling=None, seed=None, clock=time.perf_counter):
+        self.coils = coils
+        self.relay = relay
+        self.ambient = ambient
+        self.drift = drift
+        self.noise = noise
+        self.period = 1.0/rate
+        # nT per amp, the inverse of the open loop formula
+        self.field_per_amp = [COIL_TURNS/(CAGE_CONSTANT*1e-9*k) for k in coil_constants]
+        self.coupling = None if coupling is None else [[float(value) for value in row] for row in coupling]
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.started = clock()
+        self.next_sample = self.started
+        self.timeout = None
+        self.is_open = False
+
+    def open(self, baudrate=None, timeout=None):
+        self.timeout = timeout
+        self.next_sample = self.clock()
+        self.is_open = True
+        return self
+
+    def close(self): self.is_open = False
+
+    def reset_input_buffer(self): self.next_sample = max(self.next_sample, self.clock())
+
+    # Field at the sensor (nT)
+    def field(self, now):
+        currents = []
+        for axis in range(3):
+            sign = self.relay.relays[axis] if self.relay is not None else 0
+            # With the relays off the coil isn't connected
+            currents.append(0.0 if sign is None else abs(self.coils[axis].coilCurrent(now))*(-1 if sign else 1))
+        field = []
+        for axis in range(3):
+            if self.coupling is None: coil = currents[axis]*self.field_per_amp[axis]
+            else: coil = sum(self.coupling[axis][source]*currents[source] for source in range(3))
+            field.append(coil + self.ambient[axis] + self.drift[axis]*(now - self.started) + self.random.gauss(0.0, self.noise))
+        return field
+
+    # Waits for the next sample like the sensor's output rate, or returns b'' when the port timeout runs out first
+    def readline(self):
+        if not self.is_open: raise IOError('Port not open')
+        now = self.clock()
+        wait = self.next_sample - now
+        if self.timeout is not None and wait > self.timeout:
+            time.sleep(self.timeout)
+            return b''
+        if wait > 0: time.sleep(wait)
+        now = self.clock()
+        self.next_sample = max(self.next_sample + self.period, now)
+        return ('%.1f,%.1f,%.1f\r\n' % tuple(self.field(now))).encode('ascii')
+
+#=============================================================================#
+#                              Simulated Backend                              #
+#=============================================================================#
+
+class SimulatedResourceManager:
+
+    def __init__(self, backend): self.backend = backend
+
+    def list_resources(self, query='?*::INSTR'): return tuple(self.backend.instruments)
+
+    def open_resource(self, name, **kwargs):
+        instrument = self.backend.instrument(name)
+        instrument.closed = False
+        return instrument
+
+    def close(self): pass
+
+# Hands out simulated PSUs and Arduinos by resource name and port, so a reconnect gets the same instrument back.
+# resourceManager() replaces visa.ResourceManager() and serial() replaces serial.serial_for_url.
+class SimulatedBackend:
+
+    def __init__(self, latency=None, coil=None, relay_latency=None, firmware='frame', settle=0.010, list_memory=DEFAULT_LIST_MEMORY, clock=time.perf_counter):
+        self.latency = latency or LatencyModel()
+        self.coil = coil or CoilModel()
+        self.relay_latency = relay_latency or LatencyModel()
+        self.firmware = firmware
+        self.settle = settle
+        self.list_memory = list_memory
+        self.clock = clock
+        self.instruments = {}
+        self.arduinos = {}
+        self.magnetometers = {}
+
+    def instrument(self, name):
+        if name not in self.instruments:
+            self.instruments[name] = SimulatedKeithley(name, self.list_memory, self.clock, self.latency, self.coil)
+        return self.instruments[name]
+
+    def arduino(self, port):
+        if port not in self.arduinos:
+            self.arduinos[port] = SimulatedArduino(port, self.firmware, self.settle, self.relay_latency, clock=self.clock)
+        return self.arduinos[port]
+
+    # Puts a magnetometer on a port, measuring the coils of the given PSUs switched by the Arduino on relay_port
+    def addMagnetometer(self, port, psu_names, relay_port, **kwargs):
+        coils = [self.instrument(name) for name in psu_names]
+        self.magnetometers[port] = SimulatedMagnetometer(coils, self.arduino(relay_port), clock=self.clock, **kwargs)
+        return self.magnetometers[port]
+
+    def resourceManager(self): return SimulatedResourceManager(self)
+
+    def serial(self, port, baudrate=9600, timeout=None, **kwargs):
+        if port in self.magnetometers: return self.magnetometers[port].open(baudrate, timeout)
+        return self.arduino(port).open(baudrate, timeout)
+
+    # The latest RECEIVED_LOG entries each instrument received, by resource name or port
+    def recording(self):
+        recording = {name: list(instrument.received) for name, instrument in self.instruments.items()}
+        recording.update({port: list(arduino.received) for port, arduino in self.arduinos.items()})
+        return recording
@@ -0,0 +1,69 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              UI Modules (UiModules.py)
+#   Description:            Loads the Qt Designer forms from pregenerated Python modules instead of parsing the .ui
+#                           XML on every launch. A module is regenerated whenever its .ui file is newer.
+#   Inputs/Resources:       HelmholtzCageController.ui, STKWizard.ui
+#   Output/Created files:   HelmholtzCageController_ui.py, STKWizard_ui.py next to the .ui files
+#
+#   Notes:                  The generated modules aren't committed (*_ui.py is in .gitignore). The first launch of a
+#                           checkout writes them; run "python UiModules.py" after checking out or editing a form to
+#                           generate every module up front.
+#                           If a module can't be written (read-only install) the form is loaded with
+#                           uic.loadUiType like before.
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import os
+import sys
+import importlib
+import xml.etree.ElementTree as ElementTree
+from PyQt5 import QtWidgets
+
+UI_FILES = ("HelmholtzCageController.ui", "STKWizard.ui")
+MODULE_SUFFIX = "_ui"
+
+# Name of the pregenerated module for a .ui file, e.g. STKWizard.ui -> STKWizard_ui
+def moduleName(ui_file): return os.path.splitext(os.path.basename(ui_file))[0] + MODULE_SUFFIX
+
+def modulePath(ui_file): return os.path.join(os.path.dirname(os.path.abspath(ui_file)), moduleName(ui_file) + '.py')
+
+def isCurrent(ui_file):
+    path = modulePath(ui_file)
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(ui_file)
+
+# Writes the Python module for a form. The Qt class the form is built on is recorded as BASE_CLASS.
+# The module is written to a temporary file and swapped in, so a launch that fails or races another one
+# never leaves a half written module to be imported.
+def generate(ui_file):
+    from PyQt5 import uic
+    base_class = ElementTree.parse(ui_file).getroot().find('widget').get('class')
+    path = modulePath(ui_file)
+    temporary = path + '.%d.tmp' % os.getpid()
+    try:
+        with open(temporary, 'w') as module:
+            uic.compileUi(ui_file, module)
+            module.write("\nBASE_CLASS = %r\n" % base_class)
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary): os.remove(temporary)
+
+# Same as uic.loadUiType: returns the generated form class and the Qt base class
+def loadUiType(ui_file):
+    if not isCurrent(ui_file):
+        try: generate(ui_file)
+        except (OSError, ImportError):
+            from PyQt5 import uic
+            return uic.loadUiType(ui_file)
+        importlib.invalidate_caches()
+    directory = os.path.dirname(os.path.abspath(ui_file))
+    if directory not in sys.path: sys.path.append(directory)
+    module = importlib.import_module(moduleName(ui_file))
+    form_class = next(getattr(module, name) for name in dir(module) if name.startswith('Ui_'))
+    return form_class, getattr(QtWidgets, module.BASE_CLASS)
+
+if __name__ == "__main__":
+    for ui_file in UI_FILES:
+        generate(ui_file)
+        print('Generated ' + modulePath(ui_file))
@@ -0,0 +1,71 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Test Setup (tests/conftest.py)
+#   Description:            Shared fixtures for the tests, which run against the simulated instruments
+#   Inputs/Resources:       pytest
+#   Output/Created files:   Profiles and caches in pytest's temporary directories
+#
+#   Notes:                  The modules live in the repository root, not in a package
+
+#=============================================================================#
+#                                     Setup                                   #
+#=============================================================================#
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+
+from HelmholtzCageEngine import CageEngine
+from ProfileCache import ProfileCache
+from SimulatedInstruments import SimulatedBackend
+
+ARDUINO = 'COM3'
+PSUS = ('X', 'Y', 'Z')
+
+# Rows of a profile that takes more than one ProfileIngest.CHUNK_BYTES chunk
+LARGE_ROWS = 320000
+
+#=============================================================================#
+#                                   Fixtures                                  #
+#=============================================================================#
+
+# Writes a .csv profile of rows (x, y, z) in nT and returns its path
+def writeProfile(path, rows):
+    with open(path, 'w') as file:
+        file.write('x (nT),y (nT),z (nT)\n')
+        for row in rows: file.write('%s,%s,%s\n' % tuple(row))
+    return str(path)
+
+# Writes a smooth profile of rows steps. The x value of bad_row is replaced with text that isn't a number.
+def writeLargeProfile(path, rows=LARGE_ROWS, bad_row=None):
+    steps = np.arange(rows)
+    field = np.column_stack([20000 + 1000*np.sin(steps/5000), 15000 + 500*np.cos(steps/7000), np.full(rows, -10000.0)])
+    with open(path, 'w') as file:
+        file.write('x (nT),y (nT),z (nT)\n')
+        for start in range(0, rows, 65536):
+            lines = ['%.3f,%.3f,%.3f\n' % tuple(row) for row in field[start:start + 65536]]
+            if bad_row is not None and start <= bad_row < start + 65536: lines[bad_row - start] = 'abc,1,1\n'
+            file.writelines(lines)
+    return str(path)
+
+@pytest.fixture
+def backend(): return SimulatedBackend()
+
+# Engine on the simulated instruments, with its profile cache in a temporary directory
+@pytest.fixture
+def engine(backend, tmp_path):
+    engine = CageEngine(use_cache=False, backend=backend)
+    engine.cache = ProfileCache(str(tmp_path/'cache'))
+    engine.telemetry_rate = 0
+    yield engine
+    engine.stop()
+    engine.wait(5)
+    engine.disconnect()
+
+@pytest.fixture
+def connected(engine):
+    engine.connect(ARDUINO, PSUS)
+    return engine
@@ -0,0 +1,45 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              CLI Tests (tests/test_cli.py)
+#   Description:            Runs HelmholtzCageCLI.py --simulate on files that take more than one chunk to load
+#   Inputs/Resources:       pytest's temporary directories
+#   Output/Created files:   Profiles, and the cache and calibrations under a temporary home directory
+
+import os
+import sys
+import subprocess
+from conftest import ROOT, LARGE_ROWS, writeLargeProfile
+
+# The run plays a step every 10 us so the skip policy gets through the file in a few seconds
+def runCli(home, path):
+    environment = dict(os.environ, HOME=str(home), USERPROFILE=str(home))
+    command = [sys.executable, os.path.join(ROOT, 'HelmholtzCageCLI.py'), path, '--simulate', '--arduino', 'COM3',
+        '--psu', 'X', 'Y', 'Z', '--rate', '0.01', '--unit', 'ms']
+    return subprocess.run(command, cwd=str(home), env=environment, capture_output=True, text=True, timeout=120)
+
+def cacheEntries(home):
+    directory = os.path.join(str(home), '.HelmholtzCage', 'profiles')
+    return [name for name in os.listdir(directory) if name.endswith('.hhcp')] if os.path.isdir(directory) else []
+
+# The run starts on the first chunk, the rest is checked as it loads, and the next run maps it from the cache
+def test_largeProfile(tmp_path):
+    path = writeLargeProfile(tmp_path/'large.csv')
+    first = runCli(tmp_path, path)
+    assert first.returncode == 0, first.stdout + first.stderr
+    assert 'Profile still loading' in first.stdout
+    assert 'Simulation complete' in first.stdout
+    assert len(cacheEntries(tmp_path)) == 1
+
+    second = runCli(tmp_path, path)
+    assert second.returncode == 0, second.stdout + second.stderr
+    assert 'Profile still loading' not in second.stdout
+    assert '%d steps checked' % LARGE_ROWS in second.stdout
+    assert 'Simulation complete' in second.stdout
+
+# A bad row after the first chunk stops the run with the load error and nothing is cached
+def test_largeProfileWithBadRow(tmp_path):
+    path = writeLargeProfile(tmp_path/'bad.csv', bad_row=LARGE_ROWS - 1000)
+    result = runCli(tmp_path, path)
+    assert result.returncode == 1
+    assert 'Error: Invalid Data' in result.stdout
+    assert not cacheEntries(tmp_path)
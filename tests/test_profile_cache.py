@@ -0,0 +1,70 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Profile Cache Tests (tests/test_profile_cache.py)
+#   Description:            A compiled profile is cached once it has loaded in full and mapped from the cache by the
+#                           next engine. A load that fails is never cached.
+#   Inputs/Resources:       pytest's temporary directories
+#   Output/Created files:   Profiles and a cache in pytest's temporary directory
+
+import threading
+import numpy as np
+import pytest
+from HelmholtzCageEngine import CageEngine
+from ProfileCache import ProfileCache
+from conftest import LARGE_ROWS, writeProfile, writeLargeProfile
+
+OFFSETS = (0, 0, 0)
+
+# Loads a file on the loader thread like the GUI and CLI do, waits for it and returns the error it ended with
+def load(engine, path):
+    done = threading.Event()
+    errors = []
+    engine.openProfile(path)
+    profile, cached = engine.loadProfile(on_done=lambda error: (errors.append(error), done.set()))
+    if not cached: assert done.wait(30)
+    return cached, errors[0] if errors else None
+
+def cachedEngine(tmp_path):
+    engine = CageEngine(use_cache=False)
+    engine.cache = ProfileCache(str(tmp_path/'cache'))
+    return engine
+
+def entries(tmp_path): return [entry for entry in (tmp_path/'cache').iterdir() if entry.suffix == '.hhcp']
+
+def test_roundTrip(tmp_path):
+    path = writeProfile(tmp_path/'steady.csv', [(1000 + step, 2000, -3000) for step in range(100)])
+    first = cachedEngine(tmp_path)
+    assert load(first, path) == (False, None)
+    currents = np.array(first.compileProfile(OFFSETS).currents)
+    first.profileLoaded()
+    assert len(entries(tmp_path)) == 1
+
+    second = cachedEngine(tmp_path)
+    assert load(second, path) == (True, None)
+    profile = second.compileProfile(OFFSETS)
+    assert len(profile) == 100
+    assert np.array_equal(np.array(profile.currents), currents)
+    assert not second.validate(1.0).blocked
+
+# The first chunk loads, the second one stops at the bad row
+def test_failedLoadIsNotCached(tmp_path):
+    path = writeLargeProfile(tmp_path/'bad.csv', bad_row=LARGE_ROWS - 1000)
+    for _attempt in range(2):
+        engine = cachedEngine(tmp_path)
+        cached, error = load(engine, path)
+        assert not cached
+        assert error.args[0] == 'Invalid Data'
+        assert 0 < len(engine.profile) < LARGE_ROWS
+        with pytest.raises(Exception) as raised: engine.compileProfile(OFFSETS)
+        assert raised.value.args[0] == 'Invalid Data'
+        engine.profileLoaded()
+        assert not entries(tmp_path)
+
+def test_emptyProfileIsNotCached(tmp_path):
+    path = writeProfile(tmp_path/'empty.csv', [])
+    engine = cachedEngine(tmp_path)
+    assert load(engine, path) == (False, None)
+    engine.compileProfile(OFFSETS)
+    engine.profileLoaded()
+    assert not entries(tmp_path)
+    assert engine.validate(1.0).blocked
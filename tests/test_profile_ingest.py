@@ -0,0 +1,22 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Profile Ingest Tests (tests/test_profile_ingest.py)
+#   Description:            The chunk parser against the row formats Extract has to read or reject
+#   Inputs/Resources:       None
+#   Output/Created files:   None
+
+import pytest
+from ProfileIngest import parseChunk
+
+@pytest.mark.parametrize('block', [b'1,2,3\n4,5,6\n', b'1,2,3\r\n4,5,6', b'"1.0","2.0","3.0"\n"4","5","6"\n', b'1, 2 ,3\n\n4,5,6\n'])
+def test_parsed(block): assert parseChunk(block, 3).tolist() == [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]
+
+@pytest.mark.parametrize('block', [b'1,,3\n', b'1, ,3\n', b'1,2\n', b'1,2,3,4\n', b',2,3\n'])
+def test_unbalanced(block):
+    with pytest.raises(Exception) as error: parseChunk(block, 3)
+    assert error.value.args[0] == 'Unbalanced Data'
+
+@pytest.mark.parametrize('block', [b'abc,2,3\n', b'1,nan,3\n', b'inf,2,3\n', b'1,2,-inf\n', b'"1",NaN,"3"\n'])
+def test_invalid(block):
+    with pytest.raises(Exception) as error: parseChunk(block, 3)
+    assert error.value.args[0] == 'Invalid Data'
@@ -0,0 +1,41 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Relay Acknowledgement Tests (tests/test_relay_ack.py)
+#   Description:            A relay frame whose acknowledgement is lost is sent again, and the PSUs are only
+#                           written once the relays are known to have switched
+#   Inputs/Resources:       The simulated Arduino and PSUs
+#   Output/Created files:   None
+
+import pytest
+from conftest import ARDUINO, PSUS, writeProfile
+
+def appls(backend):
+    return sum(1 for name in PSUS for _time, message in backend.instruments[name].received if message.startswith('APPL'))
+
+def test_missedAckIsRetried(connected, backend):
+    connected.setCurrents([1.0, 1.0, 1.0])
+    backend.arduinos[ARDUINO].drop_acks = 1
+    connected.setCurrents([-1.0, 1.0, 1.0])
+    assert backend.arduinos[ARDUINO].mask() == 1
+    assert connected.relays.missed_acks == 1
+    assert connected.commandedCurrents() == [-1.0, 1.0, 1.0]
+
+def test_secondMissedAckHoldsThePsus(connected, backend):
+    connected.setCurrents([1.0, 1.0, 1.0])
+    written = appls(backend)
+    backend.arduinos[ARDUINO].drop_acks = 2
+    with pytest.raises(Exception) as error: connected.setCurrents([-2.0, 1.0, 1.0])
+    assert error.value.args[0] == 'No Arduino Acknowledgement'
+    assert appls(backend) == written
+
+def test_runStopsOnMissedAcks(connected, backend, tmp_path):
+    path = writeProfile(tmp_path/'steady.csv', [(-1000, 1000, 1000)]*5)
+    connected.openProfile(path)
+    connected.loadProfile(background=False)
+    connected.compileProfile((0, 0, 0))
+    backend.arduinos[ARDUINO].drop_acks = 1000
+    connected.start(0.05)
+    connected.wait(10)
+    assert connected.worker.error.args[0] == 'No Arduino Acknowledgement'
+    # Nothing but the clear reached the PSUs once the relays stopped answering
+    for name in PSUS: assert [message for _time, message in backend.instruments[name].received if message.startswith('APPL')] == ['APPL 0.00,0.00']
@@ -0,0 +1,49 @@
+
+#   File type:              Sim Lab Python Source File
+#   File name:              Sequence Mode Tests (tests/test_sequence_mode.py)
+#   Description:            Plays a profile from the PSU lists on the simulated instruments, with a pause in the middle
+#   Inputs/Resources:       The simulated Arduino and PSUs
+#   Output/Created files:   A profile in pytest's temporary directory
+
+import time
+from HelmholtzCageEngine import CageEngine
+from conftest import ARDUINO, PSUS, writeProfile
+
+PERIOD = 0.01
+
+def sequenceEngine(backend, tmp_path, steps):
+    engine = CageEngine(execution_mode='sequence', use_cache=False, backend=backend)
+    engine.telemetry_rate = 0
+    engine.connect(ARDUINO, PSUS)
+    # The x field turns round half way, which splits the profile into two list windows
+    engine.openProfile(writeProfile(tmp_path/'ramp.csv', [(1000 + step if step < steps//2 else -1000 - step, 2000, 3000) for step in range(steps)]))
+    engine.loadProfile(background=False)
+    engine.compileProfile((0, 0, 0))
+    return engine
+
+def test_sequencePlaysEachWindowOnce(backend, tmp_path):
+    engine = sequenceEngine(backend, tmp_path, 200)
+    try:
+        engine.start(PERIOD)
+        engine.wait(10)
+        assert engine.worker.error is None
+        assert engine.sequence_player.windows == 2
+        assert engine.sequence_player.streamed == 0
+    finally: engine.disconnect()
+
+# Resuming uploads one window from the step the run was paused on and carries on after it
+def test_resumeUploadsOnce(backend, tmp_path):
+    engine = sequenceEngine(backend, tmp_path, 200)
+    try:
+        engine.start(PERIOD)
+        time.sleep(0.4)
+        engine.pause()
+        while engine.worker.state != 'paused': time.sleep(0.01)
+        engine.resume()
+        engine.wait(10)
+        assert engine.worker.error is None
+        assert engine.worker.state == 'complete'
+        # The first window, the rest of it again on resuming, then the second window
+        assert engine.sequence_player.windows == 3
+        assert engine.sequence_player.streamed == 0
+    finally: engine.disconnect()